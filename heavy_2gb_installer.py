@@ -5,6 +5,7 @@ Automatically runs in background - installs/uninstalls heavy apps in 2GB batches
 Batch size: Max 2GB, Apps: 500MB+ each, Delay: 7-16 minutes
 """
 
+import asyncio
 import subprocess
 import random
 import time
@@ -13,208 +14,198 @@ import os
 import logging
 import atexit
 import signal
+import threading
+import json
+import re
+import glob
+import hashlib
+import http.client
+import heapq
+import itertools
+import math
+import shutil
+import stat
+import socket
+import sqlite3
+import mmap
+import struct
+import tempfile
+import zlib
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from urllib.request import urlopen
 
 # Global flag for graceful shutdown
 shutdown_flag = False
+shutdown_event = None  # asyncio.Event mirroring shutdown_flag inside the orchestrator
+disk_critical_event = None  # asyncio.Event set while the sampler reports critical disk space
 pid_file = "/tmp/heavy_2gb_installer.pid"
 log_file = "/tmp/heavy_2gb_installer.log"
+config_file = "/etc/heavy_2gb_installer.json"
+apt_lists_dir = "/var/lib/apt/lists"
+dpkg_status_file = "/var/lib/dpkg/status"
+# State the root daemon acts on lives in a directory only root can write (see ensure_state_dir)
+state_dir = "/var/lib/heavy_2gb_installer"
+size_cache_file = os.path.join(state_dir, "sizes.json")
+apt_archives_dir = "/var/cache/apt/archives"
+archive_cache_file = os.path.join(state_dir, "archives.json")
+metrics_file = os.path.join(state_dir, "metrics.jsonl")
+journal_file = os.path.join(state_dir, "journal.db")
+control_socket = "/run/heavy_2gb_installer.sock"
+temp_directories = ["/tmp", "/var/tmp"]   # swept for our own stale temporary files by cleanup
 
-# Heavy applications (500MB+ each) for Ubuntu 24.04 - verified package names
-HEAVY_APPS = [
-    # Development IDEs & Tools (Large)
-    'code',                          # Visual Studio Code ~500MB
-    'intellij-idea-community',      # IntelliJ IDEA ~800MB
-    'pycharm-community',            # PyCharm ~700MB
-    'eclipse',                      # Eclipse IDE ~600MB
-    'qtcreator',                    # Qt Creator ~500MB
-    'android-studio',               # Android Studio ~2GB
-    
-    # Graphics & 3D Software
-    'blender',                      # Blender ~600MB
-    'krita',                        # Krita ~500MB
-    'gimp',                         # GIMP ~500MB
-    'inkscape',                     # Inkscape ~500MB
-    'freecad',                      # FreeCAD ~700MB
-    'openscad',                     # OpenSCAD ~500MB
-    
-    # Video Editing & Production
-    'kdenlive',                     # Kdenlive ~600MB
-    'shotcut',                      # Shotcut ~500MB
-    'openshot',                     # OpenShot ~600MB
-    'olive-editor',                 # Olive Editor ~500MB
-    
-    # Audio Production
-    'ardour',                       # Ardour ~600MB
-    'lmms',                         # LMMS ~500MB
-    'mixxx',                        # Mixxx ~500MB
-    'audacity',                     # Audacity ~500MB
-    
-    # Office Suites
-    'libreoffice',                  # LibreOffice ~700MB
-    
-    # Virtualization & Containers
-    'virtualbox',                   # VirtualBox ~200MB
-    'virtualbox-ext-pack',          # VirtualBox Extension Pack ~50MB
-    'qemu-system',                  # QEMU system ~500MB
-    'qemu-kvm',                     # QEMU KVM ~300MB
-    'libvirt-daemon-system',        # Libvirt ~400MB
-    'virt-manager',                 # Virt Manager ~300MB
-    'docker.io',                    # Docker ~300MB
-    'docker-compose',               # Docker Compose ~50MB
-    'podman',                       # Podman ~400MB
-    
-    # Databases
-    'mysql-server',                 # MySQL Server ~500MB
-    'postgresql',                   # PostgreSQL ~600MB
-    'mariadb-server',               # MariaDB Server ~500MB
-    
-    # Web Servers
-    'apache2',                      # Apache2 ~500MB
-    'nginx',                        # Nginx ~400MB
-    'tomcat9',                      # Tomcat9 ~600MB
-    
-    # Cloud & Big Data
-    'hadoop',                       # Hadoop ~800MB
-    'elasticsearch',                # Elasticsearch ~600MB
-    
-    # Games
-    'steam-installer',              # Steam ~500MB
-    'lutris',                       # Lutris ~300MB
-    'wine',                         # Wine ~600MB
-    
-    # Emulators
-    'retroarch',                    # RetroArch ~500MB
-    'dolphin-emu',                  # Dolphin Emulator ~300MB
-    
-    # Browsers
-    'firefox',                      # Firefox ~400MB
-    'google-chrome-stable',         # Google Chrome ~300MB
-    'chromium-browser',             # Chromium ~400MB
-    
-    # Communication
-    'discord',                      # Discord ~200MB
-    'slack',                        # Slack ~300MB
-    
-    # CAD & Engineering
-    'freecad',                      # FreeCAD ~700MB
-    'librecad',                     # LibreCAD ~500MB
-    
-    # Science & Research
-    'octave',                       # Octave ~500MB
-    'maxima',                       # Maxima ~400MB
-    'geogebra',                     # GeoGebra ~500MB
-    
-    # Media Players
-    'vlc',                          # VLC ~400MB
-    'mpv',                          # MPV ~300MB
-    
-    # Security
-    'clamav',                       # ClamAV ~300MB
-    'wireshark',                    # Wireshark ~400MB
-    
-    # Network Tools
-    'nmap',                         # Nmap ~200MB
-    
-    # Package Managers
-    'snapd',                        # Snapd ~100MB
-    'flatpak',                      # Flatpak ~200MB
-    
-    # Additional Heavy Packages
-    'openjdk-17-jdk',               # OpenJDK 17 ~500MB
-    'openjdk-21-jdk',               # OpenJDK 21 ~500MB
-    'gcc-12',                       # GCC 12 ~500MB
-    'g++-12',                       # G++ 12 ~500MB
-    'llvm-14',                      # LLVM 14 ~700MB
-    'rustc',                        # Rust Compiler ~800MB
-    'golang-go',                    # Go Language ~500MB
-    'nodejs',                       # Node.js ~300MB
-    'npm',                          # NPM ~200MB
-    'python3',                      # Python3 ~100MB
-    'python3-pip',                  # Python pip ~50MB
-    'mono-complete',                # Mono ~600MB
-    'dotnet-sdk-6.0',               # .NET SDK ~500MB
-    'dotnet-sdk-7.0',               # .NET SDK 7 ~500MB
-]
-
-# App size estimates in MB (approximate - for batch planning)
-APP_SIZE_ESTIMATES = {
-    'code': 500,
-    'intellij-idea-community': 800,
-    'pycharm-community': 700,
-    'eclipse': 600,
-    'qtcreator': 500,
-    'android-studio': 2000,
-    'blender': 600,
-    'krita': 500,
-    'gimp': 500,
-    'inkscape': 500,
-    'freecad': 700,
-    'openscad': 500,
-    'kdenlive': 600,
-    'shotcut': 500,
-    'openshot': 600,
-    'olive-editor': 500,
-    'ardour': 600,
-    'lmms': 500,
-    'mixxx': 500,
-    'audacity': 500,
-    'libreoffice': 700,
-    'virtualbox': 200,
-    'virtualbox-ext-pack': 50,
-    'qemu-system': 500,
-    'qemu-kvm': 300,
-    'libvirt-daemon-system': 400,
-    'virt-manager': 300,
-    'docker.io': 300,
-    'docker-compose': 50,
-    'podman': 400,
-    'mysql-server': 500,
-    'postgresql': 600,
-    'mariadb-server': 500,
-    'apache2': 500,
-    'nginx': 400,
-    'tomcat9': 600,
-    'hadoop': 800,
-    'elasticsearch': 600,
-    'steam-installer': 500,
-    'lutris': 300,
-    'wine': 600,
-    'retroarch': 500,
-    'dolphin-emu': 300,
-    'firefox': 400,
-    'google-chrome-stable': 300,
-    'chromium-browser': 400,
-    'discord': 200,
-    'slack': 300,
-    'freecad': 700,
-    'librecad': 500,
-    'octave': 500,
-    'maxima': 400,
-    'geogebra': 500,
-    'vlc': 400,
-    'mpv': 300,
-    'clamav': 300,
-    'wireshark': 400,
-    'nmap': 200,
-    'snapd': 100,
-    'flatpak': 200,
-    'openjdk-17-jdk': 500,
-    'openjdk-21-jdk': 500,
-    'gcc-12': 500,
-    'g++-12': 500,
-    'llvm-14': 700,
-    'rustc': 800,
-    'golang-go': 500,
-    'nodejs': 300,
-    'npm': 200,
-    'python3': 100,
-    'python3-pip': 50,
-    'mono-complete': 600,
-    'dotnet-sdk-6.0': 500,
-    'dotnet-sdk-7.0': 500,
+# Heavy application catalog (categories, weights, known sizes, exclusions) and
+# the memory-mapped index it is compiled into - see load_catalog()
+catalog_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "heavy_2gb_catalog.json")
+catalog_index_file = os.path.join(state_dir, "catalog.idx")
+
+# Runtime configuration - defaults, overridden by keys in config_file
+CONFIG = {
+    # 'transaction' installs a whole batch in one apt run, 'individual' one app at a time
+    'install_mode': 'transaction',
+    # 'apt' uninstalls a batch with apt remove; 'overlay' runs apt in a chroot of
+    # overlay_base (a debootstrap tree, never modified) whose changes land in a throwaway
+    # overlayfs layer under overlay_dir, and uninstalls a batch by discarding the layer
+    'engine': 'apt',
+    'overlay_base': None,
+    'overlay_dir': '/var/tmp/heavy_2gb_installer.overlay',
+    # Size the batch planner aims for (installed MB, shared dependencies counted once)
+    'batch_target_mb': 2000,
+    # Number of recent batches the planner avoids repeating exactly
+    'batch_history': 20,
+    # Download the next batch's archives while the current batch is held
+    'prefetch': True,
+    # Refresh the package lists between batches once they are older than this, or after
+    # a 404 on an archive (apt re-fetches only the lists the mirror changed)
+    'index_ttl_hours': 6,
+    # Parallel keep-alive connections fetching a batch's archives ahead of apt (0 has apt's
+    # own --download-only run fetch them all)
+    'fetch_workers': 4,
+    # Downloaded .debs kept between batches, least recently used evicted first
+    'archive_cache_mb': 4096,
+    # Evict cached archives further while free disk space is below this
+    'archive_cache_min_free_gb': 10,
+    # Resource sampler: seconds between samples and samples kept in its ring buffer
+    'sampler_interval': 5,
+    'sampler_history': 720,
+    # Free space levels the sampler raises events for
+    'disk_critical_gb': 5,
+    'disk_low_gb': 15,
+    # Pressure stall (PSI) thresholds: [avg10, avg60] percent of time some task stalled on
+    # the resource. Above either, installs and removals wait between packages (at most
+    # pressure_max_wait_minutes) and running apt/dpkg drops to idle CPU and I/O priority
+    'pressure_thresholds': {'io': [30, 15], 'memory': [20, 10], 'cpu': [75, 50]},
+    'pressure_check_seconds': 5,
+    'pressure_max_wait_minutes': 30,
+    # Lines of streamed apt/dpkg output kept per stream for error messages
+    'command_output_lines': 200,
+    # cgroup v2 leaf for every apt/dpkg install and removal, below cgroup_root (None runs
+    # them in the daemon's cgroup). Limits use the kernel's formats, None leaves one unset;
+    # io.max applies to the disk holding /
+    'cgroup_root': '/sys/fs/cgroup/heavy_2gb_installer',
+    'cgroup_cpu_max': None,        # e.g. "200000 100000" for two CPUs
+    'cgroup_io_max': None,         # e.g. "wbps=104857600"
+    'cgroup_memory_high': None,    # e.g. "2G"
+    # Prometheus textfile-collector output, in node_exporter's directory (Debian's default
+    # shown; nothing is written while the directory does not exist)
+    'prometheus_textfile': '/var/lib/prometheus/node-exporter/heavy_2gb_installer.prom',
+    # Batch loop timing: [min, max] minutes to hold a batch and to wait between batches;
+    # max_batches None runs until stopped
+    'hold_minutes': [7, 16],
+    'wait_minutes': [3, 7],
+    'max_batches': 50,
+    # Churn target, at most one of the two (None draws hold and wait at random from the
+    # ranges above). The scheduler sizes batches within batch_target_mb_range and sets
+    # hold and wait from measured batch times, jittered by +/- schedule_jitter, and works
+    # off any lead or shortfall over schedule_horizon_minutes
+    'target_gb_per_hour': None,
+    'target_batches_per_hour': None,
+    'batch_target_mb_range': [1000, 3000],
+    'schedule_jitter': 0.2,
+    'schedule_horizon_minutes': 60,
+    # Pauses between individual installs/uninstalls and after a failed batch
+    'install_pause_seconds': 5,
+    'uninstall_pause_seconds': 3,
+    'retry_wait_seconds': 60,
+    # Fleet coordinator ("unix:/path" or "host:port"); None runs uncoordinated
+    'coordinator': None,
+    # Coordinator side: concurrent batch installs and downloads across the fleet,
+    # and the fleet-wide download cap shared equally by the download slots
+    'fleet_batch_slots': 2,
+    'fleet_download_slots': 4,
+    'fleet_bandwidth_mb': 40,
+    # Cleanup runs between batches once free space drops below cleanup_free_gb and
+    # removes batch leftovers (oldest first) until cleanup_target_free_gb is free
+    'cleanup_free_gb': 20,
+    'cleanup_target_free_gb': 30,
+    # Temporary files this daemon left in /tmp and /var/tmp (interrupted atomic writes,
+    # benchmark scratch directories) older than this are removed by cleanup
+    'tmp_max_age_hours': 24,
+    # Download shaping: [[start hour, end hour, MB/s], ...] in local time (a window may
+    # wrap midnight, 0 MB/s holds downloads back), hours outside every window unlimited.
+    # Downloads wait while the token bucket (bandwidth_burst_mb deep, refilled at the
+    # current rate) is in debt or bandwidth_hourly_budget_mb was fetched in the last hour
+    'bandwidth_profile': [],
+    'bandwidth_burst_mb': 256,
+    'bandwidth_hourly_budget_mb': None,
 }
 
+def ensure_state_dir():
+    """Create state_dir readable and writable by its owner only"""
+    try:
+        os.makedirs(state_dir, mode=0o700, exist_ok=True)
+        if os.stat(state_dir).st_uid == os.geteuid():
+            os.chmod(state_dir, 0o700)
+    except OSError:
+        pass
+
+def is_trusted_state_file(path):
+    """Return True if path is a regular file that only we or root could have written"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISREG(st.st_mode) and st.st_uid in (0, os.geteuid())
+            and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+def open_state_file(path, mode='r'):
+    """Open a state file, refusing one another user could have planted or changed"""
+    if os.path.lexists(path) and not is_trusted_state_file(path):
+        raise PermissionError(f"Refusing {path}: not a regular file owned by us or root, or writable by others")
+    return open(path, mode)
+
+def create_state_file(path, mode='w', perms=0o600):
+    """Create or truncate (append to, with mode 'a') a state file, by default readable by its owner only"""
+    if 'a' in mode:
+        if os.path.lexists(path) and not is_trusted_state_file(path):
+            raise PermissionError(f"Refusing {path}: not a regular file owned by us or root, or writable by others")
+        flags = os.O_APPEND
+    else:
+        flags = os.O_TRUNC
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW | flags, perms)
+    os.fchmod(fd, perms)
+    return os.fdopen(fd, mode)
+
+def load_config(logger=None):
+    """Load config_file (JSON) over the CONFIG defaults"""
+    if not os.path.exists(config_file):
+        return CONFIG
+    try:
+        with open(config_file, 'r') as f:
+            overrides = json.load(f)
+        for key, value in overrides.items():
+            if key in CONFIG:
+                CONFIG[key] = value
+            elif logger:
+                logger.warning(f"⚠ Unknown config key ignored: {key}")
+    except Exception as e:
+        if logger:
+            logger.warning(f"⚠ Could not read config file {config_file}: {e}")
+    return CONFIG
+
 def daemonize():
     """Turn the script into a daemon that runs in background"""
     try:
@@ -227,7 +218,7 @@ def daemonize():
     
     os.chdir('/')
     os.setsid()
-    os.umask(0)
+    os.umask(0o022)
     
     try:
         pid = os.fork()
@@ -250,8 +241,14 @@ def daemonize():
 
 def signal_handler(signum, frame):
     """Handle shutdown signals gracefully"""
+    request_shutdown()
+
+def request_shutdown():
+    """Ask the main loop to stop at the next safe point and wake any waits"""
     global shutdown_flag
     shutdown_flag = True
+    if shutdown_event is not None:
+        shutdown_event.set()
 
 def cleanup_pid_file():
     """Remove PID file on exit"""
@@ -287,320 +284,3616 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
+# Resource sampler thread state - samples is a ring buffer of dicts
+_sampler = {
+    'thread': None,
+    'stop': threading.Event(),
+    'lock': threading.Lock(),
+    'samples': deque(maxlen=720),
+    'level': 'ok',        # 'ok', 'low' or 'critical' free disk space
+    'listeners': [],      # callables (level, sample) run on level changes
+}
+
+def read_disk_written_bytes():
+    """Return bytes written to all physical block devices since boot (/proc/diskstats)"""
+    try:
+        devices = {name for name in os.listdir('/sys/block')
+                   if not name.startswith(('loop', 'ram', 'zram', 'dm-', 'md'))}
+        written = 0
+        with open('/proc/diskstats', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 9 and fields[2] in devices:
+                    written += int(fields[9]) * 512  # sectors written
+        return written
+    except (OSError, ValueError):
+        return 0
+
+def read_net_received_bytes():
+    """Return bytes received on all non-loopback interfaces since boot (/proc/net/dev)"""
+    try:
+        received = 0
+        with open('/proc/net/dev', 'r') as f:
+            for line in f.readlines()[2:]:
+                name, _, counters = line.partition(':')
+                if name.strip() != 'lo':
+                    received += int(counters.split()[0])
+        return received
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def read_pressure():
+    """Return {resource: {'avg10', 'avg60', 'avg300'}} from the "some" lines of /proc/pressure"""
+    pressure = {}
+    for resource in ('cpu', 'io', 'memory'):
+        try:
+            with open(f'/proc/pressure/{resource}', 'r') as f:
+                for line in f:
+                    kind, _, fields = line.partition(' ')
+                    if kind == 'some':
+                        values = dict(field.split('=') for field in fields.split())
+                        pressure[resource] = {key: float(values[key]) for key in ('avg10', 'avg60', 'avg300')}
+        except (OSError, ValueError, KeyError):
+            pass
+    return pressure
+
+def get_pressure_excess(pressure=None):
+    """Return a description of every PSI average above its threshold, empty when all are below"""
+    pressure = read_pressure() if pressure is None else pressure
+    excess = []
+    for resource, limits in CONFIG['pressure_thresholds'].items():
+        averages = pressure.get(resource)
+        if not averages:
+            continue
+        for key, limit in zip(('avg10', 'avg60'), limits):
+            if limit is not None and averages[key] > limit:
+                excess.append(f"{resource} {key} {averages[key]:.1f}% > {limit}%")
+    return excess
+
+def take_resource_sample(previous=None):
+    """Sample free disk space, disk write/network receive rates, load average and PSI"""
+    sample = {
+        'time': time.time(),
+        'free_bytes': get_backend().disk_free_bytes(),
+        'written_bytes': read_disk_written_bytes(),
+        'received_bytes': read_net_received_bytes(),
+        'load1': os.getloadavg()[0],
+        'pressure': read_pressure(),
+        'write_rate': 0.0,
+        'receive_rate': 0.0,
+    }
+    if previous:
+        elapsed = sample['time'] - previous['time']
+        if elapsed > 0:
+            sample['write_rate'] = max(0, sample['written_bytes'] - previous['written_bytes']) / elapsed
+            sample['receive_rate'] = max(0, sample['received_bytes'] - previous['received_bytes']) / elapsed
+    return sample
+
+def get_disk_level(free_bytes):
+    """Classify free disk space against the configured thresholds"""
+    if free_bytes < CONFIG['disk_critical_gb'] * 1024 ** 3:
+        return 'critical'
+    if free_bytes < CONFIG['disk_low_gb'] * 1024 ** 3:
+        return 'low'
+    return 'ok'
+
+def record_resource_sample(logger=None):
+    """Take one sample, store it and fire listeners if the disk level changed"""
+    samples = _sampler['samples']
+    sample = take_resource_sample(samples[-1] if samples else None)
+    with _sampler['lock']:
+        samples.append(sample)
+        level = get_disk_level(sample['free_bytes'])
+        changed = level != _sampler['level']
+        _sampler['level'] = level
+        listeners = list(_sampler['listeners'])
+    
+    if changed:
+        if logger:
+            logger.warning(f"⚠ Disk space level {level}: {sample['free_bytes']/1024**3:.1f}GB free")
+        for listener in listeners:
+            try:
+                listener(level, sample)
+            except Exception as e:
+                if logger:
+                    logger.warning(f"⚠ Sampler listener failed: {e}")
+    return sample
+
+def sampler_loop(logger):
+    """Body of the sampler thread"""
+    while not _sampler['stop'].wait(CONFIG['sampler_interval']):
+        try:
+            record_resource_sample(logger)
+        except Exception as e:
+            logger.warning(f"⚠ Resource sampling failed: {e}")
+
+def start_sampler(logger):
+    """Start the background resource sampler thread"""
+    if _sampler['thread'] is not None:
+        return
+    _sampler['samples'] = deque(maxlen=CONFIG['sampler_history'])
+    _sampler['stop'].clear()
+    record_resource_sample(logger)
+    _sampler['thread'] = threading.Thread(target=sampler_loop, args=(logger,), daemon=True)
+    _sampler['thread'].start()
+
+def stop_sampler():
+    """Stop the sampler thread"""
+    thread = _sampler['thread']
+    if thread is not None:
+        _sampler['stop'].set()
+        thread.join(timeout=5)
+        _sampler['thread'] = None
+
+def add_sampler_listener(listener):
+    """Call listener(level, sample) whenever the free disk space level changes"""
+    with _sampler['lock']:
+        _sampler['listeners'].append(listener)
+
+def get_latest_sample():
+    """Return the most recent resource sample, or None"""
+    with _sampler['lock']:
+        return _sampler['samples'][-1] if _sampler['samples'] else None
+
+def get_resource_samples():
+    """Return a copy of the sampler's ring buffer, oldest first"""
+    with _sampler['lock']:
+        return list(_sampler['samples'])
+
+def is_disk_critical():
+    """Check if free disk space is below the critical threshold"""
+    return _sampler['level'] == 'critical'
+
 def check_disk_space():
     """Check available disk space in GB"""
+    sample = get_latest_sample()
+    if sample is not None and time.time() - sample['time'] < 2 * CONFIG['sampler_interval']:
+        return sample['free_bytes'] / (1024 ** 3)
+    return get_backend().disk_free_bytes() / (1024 ** 3)
+
+def format_disk_usage(path='/'):
+    """Return a one-line disk usage summary for path"""
+    st = os.statvfs(path)
+    total = st.f_blocks * st.f_frsize
+    free = st.f_bavail * st.f_frsize
+    used = total - st.f_bfree * st.f_frsize
+    percent = used / (used + free) * 100 if used + free else 0
+    return (f"{path}: {total/1024**3:.1f}GB total, {used/1024**3:.1f}GB used, "
+            f"{free/1024**3:.1f}GB available ({percent:.0f}% used)")
+
+# Histogram bucket bounds (seconds) for phase durations
+METRIC_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 2400, 3600)
+
+# Phase timings and byte counters, exported to metrics_file and the Prometheus textfile
+_metrics = {
+    'lock': threading.Lock(),
+    'batch': 0,           # batch number attached to every phase record
+    'phases': {},         # phase -> {'count', 'sum', 'buckets', 'recent'}
+    'bytes': {},          # kind -> total bytes
+}
+
+def append_metrics_line(record):
+    """Append one JSON record to metrics_file"""
     try:
-        result = subprocess.run(
-            ['df', '/', '--output=avail'],
-            capture_output=True,
-            text=True
-        )
-        lines = result.stdout.strip().split('\n')
-        if len(lines) > 1:
-            available_kb = int(lines[1].strip())
-            available_gb = available_kb / (1024 * 1024)
-            return available_gb
-    except:
+        with create_state_file(metrics_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError:
         pass
-    return 0
-
-def select_batch_2gb():
-    """Select apps for a batch with 2GB total size limit"""
-    selected_apps = []
-    total_size_mb = 0
-    max_size_mb = 2000  # 2GB limit
-    
-    # Shuffle apps to get random selection
-    shuffled_apps = HEAVY_APPS.copy()
-    random.shuffle(shuffled_apps)
-    
-    for app in shuffled_apps:
-        if app in APP_SIZE_ESTIMATES:
-            app_size = APP_SIZE_ESTIMATES[app]
-            
-            # Check if adding this app would exceed 2GB limit
-            if total_size_mb + app_size <= max_size_mb:
-                selected_apps.append(app)
-                total_size_mb += app_size
-                
-                # Stop when we reach close to 2GB
-                if total_size_mb >= 1500:  # At least 1.5GB
-                    break
-            else:
-                # Try to find smaller apps if current one is too big
+
+def count_bytes(kind, amount):
+    """Add amount to the byte counter kind (download, disk_written, ...)"""
+    with _metrics['lock']:
+        _metrics['bytes'][kind] = _metrics['bytes'].get(kind, 0) + amount
+
+def record_phase(phase, seconds, **fields):
+    """Add one phase duration to the histograms and the JSON lines log"""
+    with _metrics['lock']:
+        stats = _metrics['phases'].setdefault(phase, {
+            'count': 0,
+            'sum': 0.0,
+            'buckets': [0] * len(METRIC_BUCKETS),
+            'recent': deque(maxlen=1000),  # for percentiles
+        })
+        stats['count'] += 1
+        stats['sum'] += seconds
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+        stats['recent'].append(seconds)
+        batch = _metrics['batch']
+    
+    record = dict({
+        'type': 'phase',
+        'time': round(time.time(), 3),
+        'batch': batch,
+        'phase': phase,
+        'seconds': round(seconds, 3),
+    }, **fields)
+    append_metrics_line(record)
+    publish_event('phase_done', **{k: v for k, v in record.items() if k not in ('type', 'time')})
+
+@contextmanager
+def time_phase(phase, totals=False, **fields):
+    """Time a block as phase, counting network and disk bytes moved meanwhile
+    
+    Yields a dict that holds 'seconds', 'net_bytes' and 'disk_bytes' once
+    the block has finished. With totals the bytes are also added to the
+    byte counters - only for phases that never overlap each other.
+    """
+    result = {}
+    started = time.monotonic()
+    received = read_net_received_bytes()
+    written = read_disk_written_bytes()
+    try:
+        yield result
+    finally:
+        result['seconds'] = time.monotonic() - started
+        result['net_bytes'] = max(0, read_net_received_bytes() - received)
+        result['disk_bytes'] = max(0, read_disk_written_bytes() - written)
+        if totals:
+            count_bytes('net_received', result['net_bytes'])
+            count_bytes('disk_written', result['disk_bytes'])
+        record_phase(phase, result['seconds'],
+                     net_bytes=result['net_bytes'], disk_bytes=result['disk_bytes'], **fields)
+
+def percentile(values, q):
+    """Return the q-th percentile (0-100) of values by linear interpolation"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def get_metrics_summary():
+    """Return phase histograms/percentiles and byte counters as a dict"""
+    with _metrics['lock']:
+        phases = {}
+        for phase, stats in _metrics['phases'].items():
+            recent = list(stats['recent'])
+            phases[phase] = {
+                'count': stats['count'],
+                'sum': round(stats['sum'], 3),
+                'p50': round(percentile(recent, 50), 3),
+                'p90': round(percentile(recent, 90), 3),
+                'p99': round(percentile(recent, 99), 3),
+                'buckets': dict(zip([str(b) for b in METRIC_BUCKETS], stats['buckets'])),
+            }
+        return {'phases': phases, 'bytes': dict(_metrics['bytes'])}
+
+def write_prometheus_textfile(summary, logger=None):
+    """Write the metrics summary in Prometheus text exposition format"""
+    lines = [
+        '# HELP heavy_installer_phase_seconds Duration of installer phases.',
+        '# TYPE heavy_installer_phase_seconds histogram',
+    ]
+    for phase, stats in sorted(summary['phases'].items()):
+        for bound, count in stats['buckets'].items():
+            lines.append(f'heavy_installer_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+        lines.append(f'heavy_installer_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {stats["count"]}')
+        lines.append(f'heavy_installer_phase_seconds_sum{{phase="{phase}"}} {stats["sum"]}')
+        lines.append(f'heavy_installer_phase_seconds_count{{phase="{phase}"}} {stats["count"]}')
+    lines.append('# HELP heavy_installer_phase_seconds_quantile Recent phase duration percentiles.')
+    lines.append('# TYPE heavy_installer_phase_seconds_quantile gauge')
+    for phase, stats in sorted(summary['phases'].items()):
+        for name, quantile in (('p50', '0.5'), ('p90', '0.9'), ('p99', '0.99')):
+            lines.append(f'heavy_installer_phase_seconds_quantile{{phase="{phase}",quantile="{quantile}"}} {stats[name]}')
+    lines.append('# HELP heavy_installer_bytes_total Bytes moved by the installer.')
+    lines.append('# TYPE heavy_installer_bytes_total counter')
+    for kind, amount in sorted(summary['bytes'].items()):
+        lines.append(f'heavy_installer_bytes_total{{kind="{kind}"}} {amount}')
+    
+    path = CONFIG['prometheus_textfile']
+    if not path or not os.path.isdir(os.path.dirname(path)):
+        return
+    try:
+        # node_exporter runs unprivileged and must be able to read it
+        with create_state_file(path + '.tmp', perms=0o644) as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        if logger:
+            logger.warning(f"⚠ Could not write Prometheus textfile {path}: {e}")
+
+def export_metrics(logger=None):
+    """Write the current metrics summary to metrics_file and the Prometheus textfile"""
+    summary = get_metrics_summary()
+    append_metrics_line(dict({'type': 'summary', 'time': round(time.time(), 3)}, **summary))
+    write_prometheus_textfile(summary, logger)
+    return summary
+
+def log_metrics_summary(logger):
+    """Log where the time went, per phase"""
+    summary = get_metrics_summary()
+    logger.info("Phase timings (count / total / p50 / p90):")
+    for phase, stats in sorted(summary['phases'].items(), key=lambda item: -item[1]['sum']):
+        logger.info(f"  {phase:<20} {stats['count']:>5}  {stats['sum']/60:>8.1f}min  "
+                    f"{stats['p50']:>8.1f}s  {stats['p90']:>8.1f}s")
+    for kind, amount in sorted(summary['bytes'].items()):
+        logger.info(f"  {kind + ' bytes':<20} {amount/1024**3:>8.2f}GB")
+
+# Compiled catalog index layout (little endian):
+#   header, entries, name hash table, categories, category hash table,
+#   category members (entry numbers), string pool
+# Hash tables are open-addressed (crc32, linear probing) with (hash, index + 1) slots.
+CATALOG_MAGIC = b'H2GC'
+CATALOG_VERSION = 1
+CATALOG_HEADER = struct.Struct('<4sHHQQIIIIIIIIII')
+CATALOG_ENTRY = struct.Struct('<IHHIfI')       # name offset, name length, category, size_mb, weight, flags
+CATALOG_CATEGORY = struct.Struct('<IHHII')     # name offset, name length, unused, first member, member count
+CATALOG_SLOT = struct.Struct('<II')            # crc32 of the name, index + 1 (0 = empty)
+CATALOG_EXCLUDED = 1
+CATALOG_SIZE_KNOWN = 2
+
+# Debian package names: lower case letters, digits, + - and . starting alphanumeric
+PACKAGE_NAME_RE = re.compile(r'^[a-z0-9][a-z0-9+.-]+$')
+CATEGORY_NAME_RE = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+
+# The mapped catalog index and lists derived from it on first use
+_catalog = {
+    'path': None,
+    'mmap': None,
+    'header': None,
+    'apps': None,         # names of the entries that are not excluded, in catalog order
+    'weights': None,      # name -> planner weight for those entries
+}
+
+def parse_catalog(path, known_packages=None):
+    """Read and validate a catalog source file, return (entries, categories)
+    
+    entries is a list of dicts in file order and categories maps each
+    category to its entry numbers. Raises ValueError listing every
+    duplicate, malformed or unknown name. With known_packages, names
+    apt does not know are rejected too.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    
+    problems = []
+    entries = []
+    categories = {}
+    seen = {}
+    for category, items in data.get('categories', {}).items():
+        if not CATEGORY_NAME_RE.match(category):
+            problems.append(f"invalid category name {category!r}")
+        members = categories.setdefault(category, [])
+        for item in items:
+            name = item.get('name', '')
+            where = f"{category}/{name or '?'}"
+            if not PACKAGE_NAME_RE.match(name):
+                problems.append(f"{where}: invalid package name")
+                continue
+            if name in seen:
+                problems.append(f"{where}: duplicate of {seen[name]}/{name}")
                 continue
+            if known_packages is not None and name not in known_packages:
+                problems.append(f"{where}: unknown to apt")
+            size_mb = item.get('size_mb')
+            if size_mb is not None and (not isinstance(size_mb, int) or size_mb <= 0):
+                problems.append(f"{where}: size_mb must be a positive integer")
+                size_mb = None
+            weight = item.get('weight', 1.0)
+            if not isinstance(weight, (int, float)) or weight < 0:
+                problems.append(f"{where}: weight must be a non-negative number")
+                weight = 1.0
+            seen[name] = category
+            members.append(len(entries))
+            entries.append({'name': name, 'category': category, 'size_mb': size_mb,
+                            'weight': float(weight), 'excluded': False})
     
-    # If we don't have enough apps, add more smaller ones
-    if total_size_mb < 1000:  # Less than 1GB
-        for app in shuffled_apps:
-            if app not in selected_apps and app in APP_SIZE_ESTIMATES:
-                app_size = APP_SIZE_ESTIMATES[app]
-                if total_size_mb + app_size <= max_size_mb:
-                    selected_apps.append(app)
-                    total_size_mb += app_size
-                    
-                    if total_size_mb >= 1500:
-                        break
+    index = {entry['name']: entry for entry in entries}
+    for name in data.get('exclude', []):
+        if name not in index:
+            problems.append(f"exclude: {name!r} is not in the catalog")
+        else:
+            index[name]['excluded'] = True
+    if problems:
+        raise ValueError(f"{path}: " + '; '.join(problems))
+    return entries, categories
+
+def build_hash_table(names):
+    """Return (slot count, bytes) of an open-addressed table mapping names to their position"""
+    slots = 8
+    while slots < len(names) * 2:
+        slots *= 2
+    table = [(0, 0)] * slots
+    for index, name in enumerate(names):
+        digest = zlib.crc32(name.encode())
+        slot = digest & (slots - 1)
+        while table[slot][1]:
+            slot = (slot + 1) & (slots - 1)
+        table[slot] = (digest, index + 1)
+    return slots, b''.join(CATALOG_SLOT.pack(*entry) for entry in table)
+
+def get_known_packages(logger=None):
+    """Return every package and virtual package name apt knows, or None without apt lists"""
+    index = load_apt_index(logger)
+    return set(index) | set(_apt_index_cache['provides']) if index else None
+
+def compile_catalog(source, target, known_packages=None):
+    """Compile a catalog source file into the binary index at target (atomically)
+    
+    Names are checked against known_packages, by default whatever apt's
+    lists hold, so every compile rejects the same bad edits.
+    """
+    if known_packages is None:
+        known_packages = get_known_packages()
+    entries, categories = parse_catalog(source, known_packages)
+    st = os.stat(source)
+    
+    strings = bytearray()
+    def add_string(text):
+        offset = len(strings)
+        strings.extend(text.encode())
+        return offset, len(strings) - offset
+    
+    category_names = list(categories)
+    category_ids = {name: number for number, name in enumerate(category_names)}
+    entry_data = bytearray()
+    for entry in entries:
+        offset, length = add_string(entry['name'])
+        flags = (CATALOG_EXCLUDED if entry['excluded'] else 0) | (CATALOG_SIZE_KNOWN if entry['size_mb'] else 0)
+        entry_data += CATALOG_ENTRY.pack(offset, length, category_ids[entry['category']],
+                                         entry['size_mb'] or 0, entry['weight'], flags)
+    
+    category_data = bytearray()
+    member_data = bytearray()
+    for name in category_names:
+        offset, length = add_string(name)
+        category_data += CATALOG_CATEGORY.pack(offset, length, 0, len(member_data) // 4, len(categories[name]))
+        member_data += struct.pack(f'<{len(categories[name])}I', *categories[name])
+    
+    name_slots, name_table = build_hash_table([entry['name'] for entry in entries])
+    category_slots, category_table = build_hash_table(category_names)
+    
+    sections = [entry_data, name_table, category_data, category_table, member_data, strings]
+    offsets = []
+    position = CATALOG_HEADER.size
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+    header = CATALOG_HEADER.pack(CATALOG_MAGIC, CATALOG_VERSION, 0, st.st_size, st.st_mtime_ns,
+                                 len(entries), len(category_names), name_slots, category_slots, *offsets)
+    
+    with create_state_file(target + '.tmp', 'wb') as f:
+        f.write(header)
+        for section in sections:
+            f.write(section)
+    os.replace(target + '.tmp', target)
+    return len(entries), len(category_names)
+
+def open_catalog_index(path):
+    """Map a compiled catalog index, return (mmap, header dict) or None if unusable"""
+    try:
+        with open_state_file(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mapped) < CATALOG_HEADER.size:
+        mapped.close()
+        return None
+    fields = CATALOG_HEADER.unpack_from(mapped, 0)
+    if fields[0] != CATALOG_MAGIC or fields[1] != CATALOG_VERSION:
+        mapped.close()
+        return None
+    header = dict(zip(('source_size', 'source_mtime_ns', 'entries', 'categories', 'name_slots',
+                       'category_slots', 'entries_at', 'names_at', 'categories_at',
+                       'category_table_at', 'members_at', 'strings_at'), fields[3:]))
+    return mapped, header
+
+def load_catalog(logger=None):
+    """Map the compiled catalog, recompiling it first if catalog_file changed"""
+    if _catalog['mmap'] is not None and _catalog['path'] == catalog_index_file:
+        return _catalog
+    try:
+        st = os.stat(catalog_file)
+    except OSError as e:
+        raise ValueError(f"Catalog {catalog_file} unavailable: {e}")
+    
+    opened = open_catalog_index(catalog_index_file)
+    if opened and (opened[1]['source_size'], opened[1]['source_mtime_ns']) != (st.st_size, st.st_mtime_ns):
+        opened[0].close()
+        opened = None
+    if opened is None:
+        try:
+            count, categories = compile_catalog(catalog_file, catalog_index_file)
+            opened = open_catalog_index(catalog_index_file)
+        except OSError:
+            # state_dir is root's - other users map a private copy, unlinked once mapped
+            scratch = tempfile.mkdtemp(prefix='heavy_2gb_catalog.')
+            try:
+                count, categories = compile_catalog(catalog_file, os.path.join(scratch, 'catalog.idx'))
+                opened = open_catalog_index(os.path.join(scratch, 'catalog.idx'))
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+        if opened is None:
+            raise ValueError(f"Compiled catalog index {catalog_index_file} could not be mapped")
+        if logger:
+            logger.info(f"✓ Compiled catalog: {count} apps in {categories} categories")
+    
+    if _catalog['mmap'] is not None:
+        _catalog['mmap'].close()
+    _catalog['mmap'], _catalog['header'] = opened
+    _catalog['path'] = catalog_index_file
+    _catalog['apps'] = None
+    _catalog['weights'] = None
+    return _catalog
+
+def catalog_string(offset, length):
+    """Return a string from the catalog's string pool"""
+    start = _catalog['header']['strings_at'] + offset
+    return _catalog['mmap'][start:start + length].decode()
+
+def catalog_find(name, table_at, slots, record, records_at, count):
+    """Probe a catalog hash table for name, return its index or None"""
+    mapped = _catalog['mmap']
+    digest = zlib.crc32(name.encode())
+    slot = digest & (slots - 1)
+    while True:
+        slot_hash, position = CATALOG_SLOT.unpack_from(mapped, table_at + slot * CATALOG_SLOT.size)
+        if not position:
+            return None
+        if slot_hash == digest:
+            offset, length = record.unpack_from(mapped, records_at + (position - 1) * record.size)[:2]
+            if catalog_string(offset, length) == name:
+                return position - 1
+        slot = (slot + 1) & (slots - 1)
+
+def read_catalog_entry(index):
+    """Return the catalog entry at index as a dict"""
+    header = _catalog['header']
+    offset, length, category, size_mb, weight, flags = CATALOG_ENTRY.unpack_from(
+        _catalog['mmap'], header['entries_at'] + index * CATALOG_ENTRY.size
+    )
+    category_offset, category_length = CATALOG_CATEGORY.unpack_from(
+        _catalog['mmap'], header['categories_at'] + category * CATALOG_CATEGORY.size
+    )[:2]
+    return {
+        'name': catalog_string(offset, length),
+        'category': catalog_string(category_offset, category_length),
+        'size_mb': size_mb if flags & CATALOG_SIZE_KNOWN else None,
+        'weight': weight,
+        'excluded': bool(flags & CATALOG_EXCLUDED),
+    }
+
+def close_catalog():
+    """Unmap the catalog index (the next lookup maps it again)"""
+    if _catalog['mmap'] is not None:
+        _catalog['mmap'].close()
+    _catalog.update(path=None, mmap=None, header=None, apps=None, weights=None)
+
+def get_catalog_entry(name):
+    """Return the catalog entry for a package name, or None if it is not in the catalog"""
+    load_catalog()
+    header = _catalog['header']
+    index = catalog_find(name, header['names_at'], header['name_slots'],
+                         CATALOG_ENTRY, header['entries_at'], header['entries'])
+    return None if index is None else read_catalog_entry(index)
+
+def get_category_apps(category):
+    """Return the names in a catalog category (excluded ones included), [] if unknown"""
+    load_catalog()
+    header = _catalog['header']
+    index = catalog_find(category, header['category_table_at'], header['category_slots'],
+                         CATALOG_CATEGORY, header['categories_at'], header['categories'])
+    if index is None:
+        return []
+    first, count = CATALOG_CATEGORY.unpack_from(
+        _catalog['mmap'], header['categories_at'] + index * CATALOG_CATEGORY.size
+    )[3:]
+    members = struct.unpack_from(f'<{count}I', _catalog['mmap'], header['members_at'] + first * 4)
+    return [read_catalog_entry(member)['name'] for member in members]
+
+def get_catalog_apps():
+    """Return the names of every catalog app the planner may pick (exclusions left out)"""
+    load_catalog()
+    if _catalog['apps'] is None:
+        entries = [read_catalog_entry(index) for index in range(_catalog['header']['entries'])]
+        entries = [entry for entry in entries if not entry['excluded']]
+        _catalog['apps'] = [entry['name'] for entry in entries]
+        _catalog['weights'] = {entry['name']: entry['weight'] for entry in entries}
+    return _catalog['apps']
+
+def get_catalog_weights():
+    """Return {app: planner weight} for every app get_catalog_apps() returns"""
+    get_catalog_apps()
+    return _catalog['weights']
+
+def get_app_size_estimate(app):
+    """Return the catalog's size estimate for app in MB (0 if unknown)"""
+    entry = get_catalog_entry(app)
+    return (entry['size_mb'] or 0) if entry else 0
+
+# App sets of the most recent batches, so the planner does not repeat them
+_batch_history = []
+
+def subset_sum(weights, capacity):
+    """Return indices of weights whose sum is the largest possible <= capacity"""
+    # reach[i] is a bitset of all sums reachable with the first i weights
+    mask = (1 << (capacity + 1)) - 1
+    reach = [1]
+    for weight in weights:
+        reach.append((reach[-1] | (reach[-1] << weight)) & mask)
+    
+    total = reach[-1].bit_length() - 1
+    picked = []
+    for i in range(len(weights), 0, -1):
+        if not (reach[i - 1] >> total) & 1:
+            picked.append(i - 1)
+            total -= weights[i - 1]
+    return picked
+
+def plan_batch(items, target_mb, history=(), rng=random, attempts=5, pool_size=256, app_weights=None):
+    """Pick apps whose combined size lands as close to target_mb as possible
+    
+    items maps each app to {package: size_mb} of everything installing it
+    would add, so dependencies shared between apps are only counted once.
+    app_weights (app -> relative weight) makes apps more or less likely to
+    land in the random pool. Returns (apps, total_mb).
+    """
+    package_sizes = {}
+    for packages in items.values():
+        package_sizes.update(packages)
+    
+    apps = list(items)
+    best = ([], 0)
+    for _ in range(attempts):
+        # A random pool keeps batches varied and planning time bounded
+        if app_weights:
+            # Weighted sampling without replacement (larger key wins)
+            keys = {app: rng.random() ** (1.0 / app_weights[app]) if app_weights.get(app) else -1.0
+                    for app in apps}
+            apps.sort(key=keys.get, reverse=True)
+        else:
+            rng.shuffle(apps)
+        pool = apps[:pool_size]
+        chosen = []
+        chosen_packages = set()
+        total_mb = 0
+        
+        # Exact subset-sum on marginal sizes, repeated because shared
+        # dependencies between picked apps leave some room unused
+        for _ in range(3):
+            gap = int(target_mb - total_mb)
+            if gap <= 0:
+                break
+            candidates = []
+            weights = []
+            for app in pool:
+                if app in chosen:
+                    continue
+                marginal = math.ceil(sum(size for package, size in items[app].items()
+                                         if package not in chosen_packages))
+                if 0 < marginal <= gap:
+                    candidates.append(app)
+                    weights.append(marginal)
+            picked = subset_sum(weights, gap)
+            if not picked:
+                break
+            for index in picked:
+                chosen.append(candidates[index])
+                chosen_packages.update(items[candidates[index]])
+            total_mb = sum(package_sizes[package] for package in chosen_packages)
+        
+        if chosen and frozenset(chosen) not in history:
+            return chosen, total_mb
+        if total_mb > best[1]:
+            best = (chosen, total_mb)
+    return best
+
+def get_planner_items(apps, installed=None, logger=None):
+    """Return {app: {package: size_mb}} of what installing each app would add"""
+    closures = get_dependency_closures(apps, logger)
+    if installed is None:
+        installed = load_dpkg_status()
+    items = {}
+    for app in apps:
+        # Never plan apps that are already on the system - the batch
+        # would otherwise purge them afterwards
+        if is_status_installed(installed.get(app)):
+            continue
+        if app in closures:
+            items[app] = {
+                name: _size_cache['sizes'][name][0] / (1024 * 1024)
+                for name in closures[app]
+                if not is_status_installed(installed.get(name))
+            }
+        elif get_app_size_estimate(app) and not _apt_index_cache['packages']:
+            # Estimates only stand in when there is no apt index at all
+            items[app] = {app: get_app_size_estimate(app)}
+    return items
+
+def select_batch_2gb(installed=None, target_mb=None):
+    """Select apps for a batch as close as possible to target_mb (default batch_target_mb)
+    
+    installed is the dpkg state to plan against, by default the current one.
+    """
+    apps = get_catalog_apps()
+    items = get_planner_items(apps, installed)
+    selected_apps, total_size_mb = plan_batch(
+        items, target_mb or CONFIG['batch_target_mb'], history=_batch_history,
+        app_weights=get_catalog_weights()
+    )
     
+    if selected_apps:
+        _batch_history.append(frozenset(selected_apps))
+        del _batch_history[:-CONFIG['batch_history']]
     return selected_apps, total_size_mb
 
+# Fields kept from the apt Packages lists (everything else is skipped while parsing)
+APT_INDEX_FIELDS = (
+    'Package', 'Architecture', 'Version', 'Provides',
+    'Depends', 'Pre-Depends', 'Recommends', 'Installed-Size', 'Size',
+)
+
+# Relations a dependency closure follows - what apt-get install pulls in with its
+# default APT::Install-Recommends, so closure sizes match what apt actually installs
+CLOSURE_FIELDS = ('Pre-Depends', 'Depends', 'Recommends')
+
+# In-memory apt index, rebuilt only when the list files change
+_apt_index_cache = {
+    'signature': None,
+    'packages': {},       # name -> {field: value} parsed from *_Packages
+    'provides': {},       # virtual name -> [real packages providing it]
+    'policy': {},         # name -> bool, from apt-cache policy when lists are compressed
+    'arch': None,
+}
+
+def get_native_arch():
+    """Return dpkg's native architecture (cached after the first call)"""
+    if not _apt_index_cache['arch']:
+        try:
+            result = subprocess.run(
+                ['dpkg', '--print-architecture'],
+                capture_output=True,
+                text=True,
+                timeout=30
+            )
+            _apt_index_cache['arch'] = result.stdout.strip() or 'amd64'
+        except:
+            _apt_index_cache['arch'] = 'amd64'
+    return _apt_index_cache['arch']
+
+def get_apt_lists_signature():
+    """Return a cheap fingerprint (path, size, mtime) of the local apt Packages lists"""
+    signature = []
+    for path in sorted(glob.glob(os.path.join(apt_lists_dir, '*_Packages*'))):
+        try:
+            st = os.stat(path)
+            signature.append((path, st.st_size, st.st_mtime_ns))
+        except OSError:
+            continue
+    return tuple(signature)
+
+def parse_packages_file(path, packages):
+    """Parse one apt Packages list into the packages dict (first stanza per name wins)"""
+    fields = {}
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line == '\n':
+                name = fields.get('Package')
+                if name and name not in packages:
+                    packages[name] = fields
+                fields = {}
+            elif line[0] not in ' \t':
+                key, _, value = line.partition(':')
+                if key in APT_INDEX_FIELDS:
+                    fields[key] = value.strip()
+    name = fields.get('Package')
+    if name and name not in packages:
+        packages[name] = fields
+
+def load_apt_index(logger=None):
+    """Return the apt package index, re-reading the lists only if they changed"""
+    signature = get_apt_lists_signature()
+    if signature == _apt_index_cache['signature']:
+        return _apt_index_cache['packages']
+    
+    packages = {}
+    arch_suffixes = (f"binary-{get_native_arch()}_Packages", "binary-all_Packages")
+    for path, _, _ in signature:
+        if path.endswith(arch_suffixes):
+            try:
+                parse_packages_file(path, packages)
+            except Exception as e:
+                if logger:
+                    logger.warning(f"⚠ Could not parse {path}: {e}")
+    
+    provides = {}
+    for name, fields in packages.items():
+        for alternatives in parse_dependencies(fields.get('Provides', '')):
+            for virtual in alternatives:
+                provides.setdefault(virtual, []).append(name)
+    
+    _apt_index_cache['signature'] = signature
+    _apt_index_cache['packages'] = packages
+    _apt_index_cache['provides'] = provides
+    _apt_index_cache['policy'] = {}
+    if logger:
+        logger.info(f"Package index: {len(packages)} packages from {len(signature)} lists")
+    return packages
+
+def check_packages_available(names, logger=None):
+    """Return {name: available} for a list of packages from the cached index"""
+    packages = load_apt_index(logger)
+    if packages:
+        return {name: name in packages for name in names}
+    
+    # No uncompressed lists to read - fall back to a single apt-cache policy call
+    policy = _apt_index_cache['policy']
+    missing = [name for name in names if name not in policy]
+    if missing:
+        policy.update(get_backend().query_policy(missing))
+    return {name: policy[name] for name in names}
+
 def check_package_exists(package_name):
     """Check if a package exists in the repositories"""
+    return check_packages_available([package_name])[package_name]
+
+# Parsed dpkg status file, reloaded only when dpkg rewrites it
+_dpkg_status_cache = {
+    'stat': None,         # (inode, mtime, size) of dpkg_status_file when parsed
+    'packages': {},       # name -> dpkg Status field, e.g. 'install ok installed'
+}
+
+def load_dpkg_status():
+    """Return {package: status} from dpkg's status file, re-reading it only if it changed"""
     try:
-        result = subprocess.run(
-            ['apt-cache', 'show', package_name],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        return result.returncode == 0
-    except subprocess.TimeoutExpired:
-        return False
-    except:
-        return False
+        st = os.stat(dpkg_status_file)
+    except OSError:
+        return {}
+    stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if stat_key == _dpkg_status_cache['stat']:
+        return _dpkg_status_cache['packages']
+    
+    packages = {}
+    name = status = None
+    with open(dpkg_status_file, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('Package:'):
+                name = line[8:].strip()
+            elif line.startswith('Status:'):
+                status = line[7:].strip()
+            elif line == '\n':
+                # Multi-arch packages have one stanza per architecture,
+                # an installed one wins over a removed one
+                if name and status and not is_status_installed(packages.get(name)):
+                    packages[name] = status
+                name = status = None
+    if name and status and not is_status_installed(packages.get(name)):
+        packages[name] = status
+    
+    _dpkg_status_cache['stat'] = stat_key
+    _dpkg_status_cache['packages'] = packages
+    return packages
+
+def is_status_installed(status):
+    """Check if a dpkg Status field means the package is fully installed"""
+    return bool(status) and status.split()[-1] == 'installed'
+
+def get_package_states(names):
+    """Return {name: dpkg status or None} for several packages in one pass"""
+    packages = load_dpkg_status()
+    return {name: packages.get(name) for name in names}
+
+def is_package_installed(name):
+    """Check if a single package is installed according to dpkg"""
+    return is_status_installed(load_dpkg_status().get(name))
 
 def get_installed_apps_from_batch(apps_list):
     """Get list of apps from batch that are actually installed"""
-    installed_apps = []
-    for app in apps_list:
+    states = get_package_states(apps_list)
+    return [app for app in apps_list if is_status_installed(states[app])]
+
+# Dependency closures and per-package sizes, persisted in size_cache_file
+_size_cache = {
+    'signature': None,    # apt lists fingerprint the checksum below was computed for
+    'checksum': None,     # content checksum of the apt lists the data belongs to
+    'closures': {},       # app -> [packages apt would pull in, including the app]
+    'sizes': {},          # package -> [installed bytes, download bytes]
+}
+
+def get_apt_lists_checksum():
+    """Checksum the apt lists via their Release files, which hash every index"""
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(apt_lists_dir, '*Release'))):
         try:
-            result = subprocess.run(
-                ['dpkg', '-l', app],
-                capture_output=True,
-                text=True
-            )
-            if result.returncode == 0 and 'ii' in result.stdout:
-                installed_apps.append(app)
-        except:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        except OSError:
             continue
-    return installed_apps
+    for path, size, _ in get_apt_lists_signature():
+        digest.update(f"{os.path.basename(path)}:{size}\n".encode())
+    return digest.hexdigest()
 
-def install_app_individually(app, logger):
-    """Install a single app individually"""
+def parse_dependencies(value):
+    """Split a Depends-style field into a list of alternative name lists"""
+    groups = []
+    for group in value.split(','):
+        alternatives = []
+        for alternative in group.split('|'):
+            # Drop version constraints and :any/:native qualifiers
+            name = alternative.split('(')[0].strip().split(':')[0]
+            if name:
+                alternatives.append(name)
+        if alternatives:
+            groups.append(alternatives)
+    return groups
+
+def resolve_dependency(alternatives, packages, provides):
+    """Pick the package apt would most likely use for one dependency group"""
+    for name in alternatives:
+        if name in packages:
+            return name
+    for name in alternatives:
+        if provides.get(name):
+            return provides[name][0]
+    return None
+
+def compute_dependency_closure(app, packages, provides):
+    """Return every package pulled in by installing app on an empty system"""
+    closure = set()
+    pending = [app]
+    while pending:
+        name = pending.pop()
+        if name in closure or name not in packages:
+            continue
+        closure.add(name)
+        fields = packages[name]
+        for field in CLOSURE_FIELDS:
+            for alternatives in parse_dependencies(fields.get(field, '')):
+                dependency = resolve_dependency(alternatives, packages, provides)
+                if dependency and dependency not in closure:
+                    pending.append(dependency)
+    return closure
+
+def load_size_cache(logger=None):
+    """Sync the in-memory size data with the current apt lists, using the disk cache"""
+    signature = get_apt_lists_signature()
+    if signature == _size_cache['signature']:
+        return _size_cache
+    
+    checksum = get_apt_lists_checksum()
+    _size_cache['signature'] = signature
+    if checksum == _size_cache['checksum']:
+        return _size_cache
+    
+    _size_cache['checksum'] = checksum
+    _size_cache['closures'] = {}
+    _size_cache['sizes'] = {}
     try:
-        logger.info(f"  Installing {app}...")
-        result = subprocess.run(
-            ['apt', 'install', '-y', app],
-            timeout=600,  # 10 minutes per app
-            capture_output=True,
-            text=True
-        )
-        
-        if result.returncode == 0:
-            logger.info(f"  ✓ Successfully installed {app}")
-            return True
-        else:
-            error_msg = result.stderr[:200] if result.stderr else "Unknown error"
-            logger.warning(f"  ✗ Failed to install {app}: {error_msg}")
-            return False
-            
+        with open_state_file(size_cache_file) as f:
+            data = json.load(f)
+        if data.get('checksum') == checksum and data.get('fields') == list(CLOSURE_FIELDS):
+            _size_cache['closures'] = data['closures']
+            _size_cache['sizes'] = data['sizes']
+            if logger:
+                logger.info(f"Size cache: {len(data['closures'])} apps loaded from {size_cache_file}")
+    except (OSError, ValueError, KeyError):
+        pass
+    return _size_cache
+
+def save_size_cache(logger=None):
+    """Write the size data to size_cache_file"""
+    try:
+        tmp_file = size_cache_file + '.tmp'
+        with create_state_file(tmp_file) as f:
+            json.dump({
+                'checksum': _size_cache['checksum'],
+                'fields': list(CLOSURE_FIELDS),
+                'closures': _size_cache['closures'],
+                'sizes': _size_cache['sizes'],
+            }, f)
+        os.replace(tmp_file, size_cache_file)
+    except Exception as e:
+        if logger:
+            logger.warning(f"⚠ Could not write size cache: {e}")
+
+def get_dependency_closures(apps, logger=None):
+    """Return {app: closure} for apps known to apt, computing missing ones from the index"""
+    cache = load_size_cache(logger)
+    missing = [app for app in apps if app not in cache['closures']]
+    packages = load_apt_index(logger) if missing else {}
+    missing = [app for app in missing if app in packages]
+    if missing:
+        provides = _apt_index_cache['provides']
+        for app in missing:
+            closure = compute_dependency_closure(app, packages, provides)
+            cache['closures'][app] = sorted(closure)
+            for name in closure:
+                if name not in cache['sizes']:
+                    fields = packages[name]
+                    try:
+                        installed_bytes = int(fields.get('Installed-Size', 0)) * 1024
+                        download_bytes = int(fields.get('Size', 0))
+                    except ValueError:
+                        installed_bytes = download_bytes = 0
+                    cache['sizes'][name] = [installed_bytes, download_bytes]
+        save_size_cache(logger)
+    return {app: cache['closures'][app] for app in apps if app in cache['closures']}
+
+def sum_missing_sizes(names, installed):
+    """Return (installed bytes, download bytes) of the names dpkg does not have yet"""
+    installed_bytes = download_bytes = 0
+    for name in names:
+        if not is_status_installed(installed.get(name)):
+            sizes = _size_cache['sizes'][name]
+            installed_bytes += sizes[0]
+            download_bytes += sizes[1]
+    return installed_bytes, download_bytes
+
+def get_batch_size(apps, logger=None):
+    """Return (installed bytes, download bytes) of installing apps together right now"""
+    closures = get_dependency_closures(apps, logger)
+    needed = set()
+    for closure in closures.values():
+        needed.update(closure)
+    installed_bytes, download_bytes = sum_missing_sizes(needed, load_dpkg_status())
+    
+    # Apps apt knows nothing about keep their hand-made estimate
+    for app in apps:
+        if app not in closures:
+            installed_bytes += get_app_size_estimate(app) * 1024 * 1024
+    return installed_bytes, download_bytes
+
+# Freshness of the apt lists (see index_ttl_hours)
+_index = {
+    'refreshed': None,    # wall time of the last successful apt update by this process
+    'checksum': None,     # get_apt_lists_checksum() after it
+    'not_found': False,   # an archive fetch hit a 404, the lists are out of date
+    'refreshes': 0,
+    'changes': 0,
+}
+
+NOT_FOUND_RE = re.compile(r'\b404\b\s*Not Found|HTTP 404')
+
+def note_not_found(output):
+    """Flag the lists as stale if apt or the fetch stage reported a 404 in output"""
+    if output and NOT_FOUND_RE.search(output):
+        _index['not_found'] = True
+    return _index['not_found']
+
+def get_index_age_hours():
+    """Return the hours since the lists were last refreshed, or None without any lists"""
+    stamps = [os.path.getmtime(path) for path in glob.glob(os.path.join(apt_lists_dir, '*Release'))]
+    if _index['refreshed']:
+        stamps.append(_index['refreshed'])
+    if not stamps:
+        return None
+    return max(0.0, time.time() - max(stamps)) / 3600
+
+def get_index_refresh_reason():
+    """Return why the lists need a refresh now, or None while they are fresh"""
+    if _index['not_found']:
+        return "an archive returned 404"
+    age = get_index_age_hours()
+    if age is None:
+        return "no package lists yet"
+    if age > CONFIG['index_ttl_hours']:
+        return f"lists are {age:.1f}h old"
+    return None
+
+def invalidate_index_caches():
+    """Drop everything derived from the apt lists, so it is rebuilt from the new content"""
+    _apt_index_cache['signature'] = None
+    _apt_index_cache['policy'] = {}
+    _size_cache['signature'] = None
+
+async def run_apt_update(logger, reason):
+    """Run apt update, return (returncode, stdout, stderr) or None if it timed out"""
+    try:
+        with time_phase('apt_update', totals=True, reason=reason):
+            return await get_backend().update()
     except subprocess.TimeoutExpired:
-        logger.warning(f"  ✗ Timeout installing {app}")
+        logger.warning("⚠ apt update timed out, using existing package lists")
+        return None
+
+async def refresh_package_index(logger, reason, window_held=False):
+    """Run apt update and invalidate derived caches if the lists' content changed
+    
+    apt sends conditional requests and keeps every list the mirror did not
+    change, so an unchanged mirror costs only the Release checks. Pass
+    window_held when the caller already holds a fleet download window, which
+    a second fleet_slot('download') would wait on forever. Returns True if
+    the content changed.
+    """
+    logger.info(f"Refreshing package lists ({reason})...")
+    before = await asyncio.to_thread(get_apt_lists_checksum)
+    _index['not_found'] = False
+    if window_held:
+        result = await run_apt_update(logger, reason)
+    else:
+        async with fleet_slot('download', logger), shaped_download(logger):
+            result = await run_apt_update(logger, reason)
+    if result is None:
         return False
-    except Exception as e:
-        logger.warning(f"  ✗ Error installing {app}: {e}")
+    returncode, stdout, stderr = result
+    if returncode != 0:
+        logger.warning(f"⚠ apt update exited with code {returncode}: {stderr[:200]}")
+    
+    hits = sum(1 for line in stdout.splitlines() if line.startswith('Hit:'))
+    fetched = sum(1 for line in stdout.splitlines() if line.startswith('Get:'))
+    after = await asyncio.to_thread(get_apt_lists_checksum)
+    _index['refreshes'] += 1
+    if returncode == 0:
+        _index['refreshed'] = time.time()
+    _index['checksum'] = after
+    if after == before:
+        logger.info(f"✓ Package lists unchanged ({hits} up to date, {fetched} fetched)")
         return False
+    _index['changes'] += 1
+    invalidate_index_caches()
+    await asyncio.to_thread(load_apt_index, logger)
+    logger.info(f"✓ Package lists changed ({hits} up to date, {fetched} fetched), index caches rebuilt")
+    return True
 
-def install_batch_2gb(apps_list, batch_num, total_size_mb, logger):
-    """Install a 2GB batch of heavy apps"""
-    logger.info(f"\n{'='*60}")
-    logger.info(f"INSTALLING BATCH {batch_num}")
-    logger.info(f"Apps: {len(apps_list)}")
-    logger.info(f"Estimated size: {total_size_mb/1024:.1f}GB")
-    logger.info(f"App list: {', '.join(apps_list)}")
-    logger.info('='*60)
-    
-    # Check disk space before installation
-    available_gb = check_disk_space()
-    required_gb = (total_size_mb * 1.5) / 1024  # Need 1.5x for safety
+# Usage of apt's archive cache, persisted in archive_cache_file
+_archive_cache = {
+    'loaded': False,
+    'last_used': {},      # .deb filename -> time it was last needed by a batch
+    'hits': 0,
+    'misses': 0,
+    'bytes_saved': 0,
+}
+
+def load_archive_cache_state():
+    """Load archive cache usage from archive_cache_file (once)"""
+    if _archive_cache['loaded']:
+        return _archive_cache
+    _archive_cache['loaded'] = True
+    try:
+        with open_state_file(archive_cache_file) as f:
+            data = json.load(f)
+        for key in ('last_used', 'hits', 'misses', 'bytes_saved'):
+            _archive_cache[key] = data[key]
+    except (OSError, ValueError, KeyError):
+        pass
+    return _archive_cache
+
+def save_archive_cache_state(logger=None):
+    """Write archive cache usage to archive_cache_file"""
+    try:
+        tmp_file = archive_cache_file + '.tmp'
+        with create_state_file(tmp_file) as f:
+            json.dump({key: _archive_cache[key]
+                       for key in ('last_used', 'hits', 'misses', 'bytes_saved')}, f)
+        os.replace(tmp_file, archive_cache_file)
+    except Exception as e:
+        if logger:
+            logger.warning(f"⚠ Could not write archive cache state: {e}")
+
+def list_cached_archives():
+    """Return {filename: (size, mtime)} of the .debs in apt's archive cache"""
+    archives = {}
+    try:
+        with os.scandir(apt_archives_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.deb') and entry.is_file():
+                    st = entry.stat()
+                    archives[entry.name] = (st.st_size, st.st_mtime)
+    except OSError:
+        pass
+    return archives
+
+def get_archive_filename(name, packages):
+    """Return the filename apt stores a package's archive under, or None"""
+    fields = packages.get(name)
+    if not fields or 'Version' not in fields:
+        return None
+    version = fields['Version'].replace(':', '%3a')
+    return f"{name}_{version}_{fields.get('Architecture', get_native_arch())}.deb"
+
+def record_archive_usage(apps, logger, cached=None):
+    """Count archive cache hits for a batch and mark its archives as recently used
     
-    logger.info(f"Disk space check: {available_gb:.1f}GB available, {required_gb:.1f}GB required")
+    cached is the set of archive filenames present before the batch's
+    download started, by default the cache contents right now.
+    """
+    state = load_archive_cache_state()
+    packages = load_apt_index(logger)
+    installed = load_dpkg_status()
+    if cached is None:
+        cached = set(list_cached_archives())
     
-    if available_gb < required_gb:
-        logger.error(f"✗ Insufficient disk space. Need {required_gb:.1f}GB, have {available_gb:.1f}GB")
-        return False, []
+    needed = set()
+    for closure in get_dependency_closures(apps, logger).values():
+        needed.update(closure)
     
-    # Validate packages exist
-    valid_apps = []
-    for app in apps_list:
-        if check_package_exists(app):
-            valid_apps.append(app)
+    now = time.time()
+    hits = misses = saved = 0
+    for name in needed:
+        filename = get_archive_filename(name, packages)
+        if filename is None or is_status_installed(installed.get(name)):
+            continue
+        if filename in cached:
+            hits += 1
+            saved += _size_cache['sizes'][name][1]
         else:
-            logger.warning(f"✗ Package not available: {app}")
+            misses += 1
+        state['last_used'][filename] = now
     
-    if not valid_apps:
-        logger.error("✗ No valid packages to install")
-        return False, []
+    state['hits'] += hits
+    state['misses'] += misses
+    state['bytes_saved'] += saved
+    save_archive_cache_state(logger)
     
-    logger.info(f"Valid packages: {len(valid_apps)}/{len(apps_list)}")
+    total = state['hits'] + state['misses']
+    ratio = state['hits'] / total * 100 if total else 0
+    logger.info(f"Archive cache: {hits}/{hits + misses} archives cached, {saved/1024**2:.0f}MB download saved "
+                f"(overall {ratio:.0f}% hit ratio, {state['bytes_saved']/1024**3:.2f}GB saved)")
+    return hits, misses, saved
+
+def enforce_archive_budget(logger):
+    """Evict least recently used archives over budget or while disk space is low"""
+    state = load_archive_cache_state()
+    archives = list_cached_archives()
+    budget = CONFIG['archive_cache_mb'] * 1024 * 1024
+    min_free = CONFIG['archive_cache_min_free_gb'] * 1024 ** 3
     
-    # Install apps individually for better tracking
-    installed_apps = []
-    success_count = 0
+    total = sum(size for size, _ in archives.values())
+    free = check_disk_space() * 1024 ** 3
+    freed = evicted = 0
     
-    for app in valid_apps:
-        if install_app_individually(app, logger):
-            success_count += 1
-            installed_apps.append(app)
-        
-        # Small delay between individual installs
-        time.sleep(5)
+    # Archives never used by a batch count as used when they were downloaded
+    for filename in sorted(archives, key=lambda name: state['last_used'].get(name, archives[name][1])):
+        if total <= budget and free + freed >= min_free:
+            break
+        try:
+            os.remove(os.path.join(apt_archives_dir, filename))
+        except OSError:
+            continue
+        size = archives[filename][0]
+        total -= size
+        freed += size
+        evicted += 1
     
-    logger.info(f"\nInstallation summary for batch {batch_num}:")
-    logger.info(f"Successfully installed: {success_count}/{len(valid_apps)} apps")
+    # Forget archives that are gone (evicted here or removed by apt)
+    present = set(list_cached_archives())
+    state['last_used'] = {name: used for name, used in state['last_used'].items() if name in present}
+    save_archive_cache_state(logger)
     
-    if success_count > 0:
-        logger.info(f"✓ Batch {batch_num} installation completed")
-        return True, installed_apps
+    logger.info(f"Archive cache: {total/1024**2:.0f}MB of {budget/1024**2:.0f}MB budget, "
+                f"evicted {evicted} archives ({freed/1024**2:.0f}MB)")
+    return freed
+
+# Write-ahead batch journal (SQLite in WAL mode) so a killed daemon can resume its batch
+_journal = {'conn': None, 'path': None}
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    batch INTEGER PRIMARY KEY,
+    apps TEXT NOT NULL,            -- JSON list, the plan as installed
+    size_mb REAL NOT NULL,
+    state TEXT NOT NULL,           -- installing, held, uninstalling, done, failed
+    hold_until REAL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS packages (
+    batch INTEGER NOT NULL,
+    package TEXT NOT NULL,
+    action TEXT NOT NULL,          -- install or uninstall
+    ok INTEGER NOT NULL,
+    time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS introduced (
+    package TEXT PRIMARY KEY,      -- dependency a batch added (dpkg diff), not the apps
+    batch INTEGER NOT NULL,        -- last batch that installed or needed it
+    bytes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+def get_journal():
+    """Return the journal connection, opening (and creating) journal_file on first use"""
+    if _journal['conn'] is None or _journal['path'] != journal_file:
+        # A planted journal could name any installed package for resume to purge
+        if os.path.lexists(journal_file) and not is_trusted_state_file(journal_file):
+            raise sqlite3.DatabaseError(f"Refusing untrusted journal {journal_file}")
+        conn = sqlite3.connect(journal_file, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        conn.executescript(JOURNAL_SCHEMA)
+        _journal['conn'] = conn
+        _journal['path'] = journal_file
+    return _journal['conn']
+
+def close_journal():
+    """Close the journal connection, checkpointing the WAL"""
+    if _journal['conn'] is not None:
+        _journal['conn'].close()
+        _journal['conn'] = None
+
+def journal_write(sql, params=()):
+    """Run one journal statement, logging instead of failing the batch loop"""
+    try:
+        get_journal().execute(sql, params)
+    except sqlite3.Error as e:
+        logging.getLogger(__name__).warning(f"⚠ Batch journal write failed: {e}")
+
+def journal_begin_batch(batch_number, apps, size_mb):
+    """Record a batch plan before anything is installed"""
+    journal_write(
+        'INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?, NULL, ?)',
+        (batch_number, json.dumps(apps), size_mb, 'installing', time.time())
+    )
+
+def journal_set_state(batch_number, state, hold_until=None):
+    """Move a journalled batch to state"""
+    journal_write(
+        'UPDATE batches SET state = ?, hold_until = COALESCE(?, hold_until), updated = ? WHERE batch = ?',
+        (state, hold_until, time.time(), batch_number)
+    )
+
+def journal_record_package(batch_number, package, action, ok):
+    """Record the outcome of installing or uninstalling one package"""
+    journal_write(
+        'INSERT INTO packages VALUES (?, ?, ?, ?, ?)',
+        (batch_number, package, action, int(bool(ok)), time.time())
+    )
+
+def journal_save_counters(**counters):
+    """Persist the batch loop counters"""
+    for name, value in counters.items():
+        journal_write('INSERT OR REPLACE INTO counters VALUES (?, ?)', (name, int(value)))
+
+def journal_load_counters():
+    """Return the counters of an unfinished run, or {} if the last run ended normally"""
+    try:
+        counters = dict(get_journal().execute('SELECT name, value FROM counters'))
+    except sqlite3.Error:
+        return {}
+    if counters.get('run_finished', 1):
+        return {}
+    return counters
+
+def journal_add_introduced(batch_number, packages):
+    """Record {package: installed bytes} a batch introduced, or touch ones it reused"""
+    for package, size in packages.items():
+        journal_write('INSERT OR REPLACE INTO introduced VALUES (?, ?, ?)', (package, batch_number, int(size)))
+
+def journal_get_introduced():
+    """Return [(package, batch, bytes)] of recorded batch dependencies, oldest batch first"""
+    try:
+        return list(get_journal().execute('SELECT package, batch, bytes FROM introduced ORDER BY batch, package'))
+    except sqlite3.Error:
+        return []
+
+def journal_drop_introduced(packages):
+    """Forget recorded batch dependencies (removed, or now needed by something else)"""
+    for package in packages:
+        journal_write('DELETE FROM introduced WHERE package = ?', (package,))
+
+def journal_reset():
+    """Forget the previous run - it finished normally or left nothing behind
+    
+    Dependencies batches introduced are kept - they are still on disk
+    until a cleanup removes them.
+    """
+    journal_write('DELETE FROM batches')
+    journal_write('DELETE FROM packages')
+    journal_write('DELETE FROM counters')
+
+def journal_get_open_batch():
+    """Return the last batch that was neither finished nor failed, or None"""
+    try:
+        row = get_journal().execute(
+            "SELECT batch, apps, size_mb, state, hold_until FROM batches "
+            "WHERE state NOT IN ('done', 'failed') ORDER BY batch DESC LIMIT 1"
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+    if not row:
+        return None
+    return {
+        'batch': row[0],
+        'apps': json.loads(row[1]),
+        'size_mb': row[2],
+        'state': row[3],
+        'hold_until': row[4],
+    }
+
+async def read_lines(stream, handle_line):
+    """Feed every line of a subprocess stream to handle_line, splitting overlong lines"""
+    pending = b''
+    while True:
+        chunk = await stream.read(64 * 1024)
+        if not chunk:
+            break
+        *lines, pending = (pending + chunk).split(b'\n')
+        if len(pending) > 64 * 1024:
+            lines.append(pending)
+            pending = b''
+        for line in lines:
+            handle_line(line.decode('utf-8', errors='replace'))
+    if pending:
+        handle_line(pending.decode('utf-8', errors='replace'))
+
+def signal_command(process, signum, session):
+    """Send signum to a child, to its whole process group if it leads its own session"""
+    try:
+        if session:
+            os.killpg(process.pid, signum)
+        else:
+            process.send_signal(signum)
+    except ProcessLookupError:
+        pass
+
+async def run_command(args, timeout=None, throttle=False, on_line=None):
+    """Run a command as an asyncio subprocess, return (returncode, stdout, stderr)
+    
+    The child is killed on timeout (raising subprocess.TimeoutExpired) and
+    terminated when the calling task is cancelled. With throttle it runs
+    in its own process group - signalled as a whole, so apt's dpkg children
+    never outlive it holding the lock - deprioritised while pressure is high, and
+    inside the cgroup leaf of the enclosing apt_cgroup() block, if any.
+    With on_line, stdout lines are handed to it as they arrive and only
+    the last command_output_lines of each stream (plus every pmerror
+    line) are returned instead of the whole output.
+    """
+    if throttle and _cgroups['current']:
+        # The shell joins the leaf before exec, so every byte and CPU second is charged to it
+        args = ['sh', '-c', 'echo $$ > "$0/cgroup.procs" 2>/dev/null; exec "$@"', _cgroups['current']] + list(args)
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=throttle
+    )
+    watcher = asyncio.create_task(deprioritize_on_pressure(process.pid)) if throttle else None
+    try:
+        if on_line:
+            stdout, stderr = await asyncio.wait_for(stream_output(process, on_line), timeout)
+        else:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        signal_command(process, signal.SIGKILL, throttle)
+        await process.wait()
+        raise subprocess.TimeoutExpired(args, timeout)
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            signal_command(process, signal.SIGTERM, throttle)
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                signal_command(process, signal.SIGKILL, throttle)
+        elif throttle:
+            signal_command(process, signal.SIGKILL, throttle)
+        raise
+    finally:
+        if watcher:
+            watcher.cancel()
+    return (
+        process.returncode,
+        stdout.decode('utf-8', errors='replace'),
+        stderr.decode('utf-8', errors='replace'),
+    )
+
+async def stream_output(process, on_line):
+    """Stream a child's output to on_line, return the bounded (stdout, stderr) it keeps"""
+    kept = {'stdout': deque(maxlen=CONFIG['command_output_lines']),
+            'stderr': deque(maxlen=CONFIG['command_output_lines'])}
+    errors = []
+    def handle_stdout(line):
+        if line.startswith('pmerror:'):
+            errors.append(line)
+        else:
+            kept['stdout'].append(line)
+        try:
+            on_line(line)
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"⚠ Output handler failed: {e}")
+    await asyncio.gather(read_lines(process.stdout, handle_stdout),
+                         read_lines(process.stderr, kept['stderr'].append))
+    await process.wait()
+    return ('\n'.join(errors + list(kept['stdout'])).encode(), '\n'.join(kept['stderr']).encode())
+
+async def wait_for_shutdown(seconds, *events):
+    """Sleep for seconds, returning early as soon as shutdown is requested or any event is set"""
+    waiters = [asyncio.ensure_future(event.wait()) for event in (shutdown_event,) + events]
+    try:
+        await asyncio.wait(waiters, timeout=seconds, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+    return shutdown_flag
+
+# Time spent holding back for pressure (see pressure_thresholds)
+_throttle = {
+    'waited_seconds': 0.0,        # between packages, waiting for pressure to drop
+    'deprioritized_seconds': 0.0, # apt/dpkg running at idle priority
+    'since': None,                # wall time the current throttling started
+    'reasons': [],
+}
+
+def note_throttled(kind, seconds, reasons):
+    """Account seconds of throttling of kind 'waited' or 'deprioritized'"""
+    _throttle[f'{kind}_seconds'] += seconds
+    _throttle['since'] = None
+    record_phase(f'pressure_{kind}', seconds, reasons=reasons)
+
+async def wait_for_low_pressure(logger):
+    """Wait between packages until PSI is back below the thresholds, return the seconds waited"""
+    excess = get_pressure_excess()
+    if not excess:
+        return 0.0
+    logger.info(f"  ⚠ Pressure high ({', '.join(excess)}), waiting before the next package")
+    started = time.monotonic()
+    deadline = started + CONFIG['pressure_max_wait_minutes'] * 60
+    _throttle['since'] = time.time()
+    _throttle['reasons'] = excess
+    publish_event('throttled', reasons=excess)
+    while excess and not shutdown_flag and time.monotonic() < deadline:
+        await wait_for_shutdown(CONFIG['pressure_check_seconds'])
+        excess = get_pressure_excess()
+    seconds = time.monotonic() - started
+    note_throttled('waited', seconds, _throttle['reasons'])
+    if excess and not shutdown_flag:
+        logger.warning(f"  ⚠ Pressure still high after {seconds/60:.0f} minutes, continuing at idle priority")
+    else:
+        logger.info(f"  ✓ Pressure back below thresholds after {seconds:.0f}s")
+    publish_event('unthrottled', seconds=round(seconds, 1))
+    return seconds
+
+async def set_group_priority(pgid, idle):
+    """Move a process group to idle CPU and I/O priority, or back to the defaults"""
+    try:
+        os.setpriority(os.PRIO_PGRP, pgid, 19 if idle else 0)
+    except OSError:
+        pass
+    ioprio = ['-c', '3'] if idle else ['-c', '2', '-n', '4']
+    try:
+        await run_command(['ionice'] + ioprio + ['-P', str(pgid)], timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+
+async def deprioritize_on_pressure(pgid):
+    """Keep a running apt/dpkg process group at idle priority whenever pressure is high"""
+    logger = logging.getLogger(__name__)
+    lowered = None
+    try:
+        while True:
+            await asyncio.sleep(CONFIG['pressure_check_seconds'])
+            excess = get_pressure_excess()
+            if excess and lowered is None:
+                logger.info(f"  ⚠ Pressure high ({', '.join(excess)}), running dpkg at idle priority")
+                await set_group_priority(pgid, True)
+                lowered = time.monotonic()
+                _throttle['since'] = time.time()
+                _throttle['reasons'] = excess
+            elif not excess and lowered is not None:
+                await set_group_priority(pgid, False)
+                note_throttled('deprioritized', time.monotonic() - lowered, _throttle['reasons'])
+                lowered = None
+    finally:
+        # The group is gone or going - nothing left to restore
+        if lowered is not None:
+            note_throttled('deprioritized', time.monotonic() - lowered, _throttle['reasons'])
+
+def get_throttle_status():
+    """Return the throttled time so far and the current throttling reasons as a dict"""
+    return {
+        'waited_seconds': round(_throttle['waited_seconds']),
+        'deprioritized_seconds': round(_throttle['deprioritized_seconds']),
+        'since': _throttle['since'],
+        'reasons': _throttle['reasons'] if _throttle['since'] else [],
+    }
+
+# cgroup v2 leaves apt/dpkg children run in (see cgroup_root)
+_cgroups = {
+    'available': None,    # checked on first use
+    'controllers': set(), # of cpu, io and memory, the ones leaves get
+    'current': None,      # leaf of the running apt_cgroup() block
+    'sequence': itertools.count(1),
+    'batch': {},          # usage summed over the current batch
+}
+
+def write_cgroup_file(path, value):
+    """Write one value to a cgroup interface file"""
+    with open(path, 'w') as f:
+        f.write(value)
+
+def get_root_disk_device():
+    """Return "major:minor" of the whole disk holding /, as io.max wants it"""
+    dev = os.stat('/').st_dev
+    device = f"{os.major(dev)}:{os.minor(dev)}"
+    sys_path = f"/sys/dev/block/{device}"
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        with open(os.path.join(sys_path, '..', 'dev'), 'r') as f:
+            device = f.read().strip()
+    return device
+
+def cgroups_available(logger):
+    """Create cgroup_root with the cpu, io and memory controllers for its leaves, once"""
+    if _cgroups['available'] is not None:
+        return _cgroups['available']
+    _cgroups['available'] = False
+    root = CONFIG['cgroup_root']
+    if not root:
+        return False
+    parent = os.path.dirname(root.rstrip('/'))
+    try:
+        with open(os.path.join(parent, 'cgroup.controllers'), 'r') as f:
+            controllers = set(f.read().split()) & {'cpu', 'io', 'memory'}
+        if controllers:
+            write_cgroup_file(os.path.join(parent, 'cgroup.subtree_control'),
+                              ' '.join(f'+{name}' for name in sorted(controllers)))
+        os.makedirs(root, exist_ok=True)
+        if controllers:
+            write_cgroup_file(os.path.join(root, 'cgroup.subtree_control'),
+                              ' '.join(f'+{name}' for name in sorted(controllers)))
+    except OSError as e:
+        logger.warning(f"⚠ cgroup v2 not usable at {root} ({e}), apt/dpkg run unconfined")
+        return False
+    missing = {'cpu', 'io', 'memory'} - controllers
+    if missing:
+        logger.warning(f"⚠ cgroup controllers {', '.join(sorted(missing))} unavailable, "
+                       f"their limits and figures are skipped")
+    _cgroups['controllers'] = controllers
+    _cgroups['available'] = True
+    return True
+
+def apply_cgroup_limits(leaf, logger):
+    """Write the configured cpu.max, io.max and memory.high into a leaf"""
+    limits = {
+        'cpu.max': CONFIG['cgroup_cpu_max'],
+        'io.max': CONFIG['cgroup_io_max'] and f"{get_root_disk_device()} {CONFIG['cgroup_io_max']}",
+        'memory.high': CONFIG['cgroup_memory_high'],
+    }
+    for name, value in limits.items():
+        if value and name.split('.')[0] in _cgroups['controllers']:
+            try:
+                write_cgroup_file(os.path.join(leaf, name), str(value))
+            except OSError as e:
+                logger.warning(f"⚠ Could not set {name}={value}: {e}")
+
+def read_cgroup_usage(leaf):
+    """Return CPU seconds, bytes read/written and peak memory charged to a leaf"""
+    usage = {'cpu_seconds': 0.0, 'read_bytes': 0, 'written_bytes': 0, 'memory_peak': None}
+    try:
+        with open(os.path.join(leaf, 'cpu.stat'), 'r') as f:
+            for line in f:
+                key, _, value = line.partition(' ')
+                if key == 'usage_usec':
+                    usage['cpu_seconds'] = int(value) / 1e6
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(leaf, 'io.stat'), 'r') as f:
+            for line in f:
+                fields = dict(field.split('=') for field in line.split()[1:])
+                usage['read_bytes'] += int(fields.get('rbytes', 0))
+                usage['written_bytes'] += int(fields.get('wbytes', 0))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(leaf, 'memory.peak'), 'r') as f:
+            usage['memory_peak'] = int(f.read())
+    except (OSError, ValueError):
+        pass
+    return usage
+
+def format_cgroup_usage(usage):
+    """Format a usage dict as e.g. CPU 12.3s, read 10MB, written 800MB, peak 300MB"""
+    text = (f"CPU {usage['cpu_seconds']:.1f}s, read {usage['read_bytes']/1024**2:.0f}MB, "
+            f"written {usage['written_bytes']/1024**2:.0f}MB")
+    if usage['memory_peak'] is not None:
+        text += f", peak {usage['memory_peak']/1024**2:.0f}MB"
+    return text
+
+@contextmanager
+def apt_cgroup(label, logger):
+    """Run the apt/dpkg commands of the block in a fresh cgroup leaf and account what they used
+    
+    Yields the usage dict, filled in once the block has finished. Only
+    one block is open at a time - the batch loop runs dpkg sequentially.
+    """
+    usage = {}
+    if not cgroups_available(logger):
+        yield usage
+        return
+    leaf = os.path.join(CONFIG['cgroup_root'], f"{re.sub(r'[^A-Za-z0-9.+-]', '_', label)}-{next(_cgroups['sequence'])}")
+    try:
+        os.mkdir(leaf)
+    except OSError as e:
+        logger.warning(f"⚠ Could not create cgroup {leaf}: {e}")
+        yield usage
+        return
+    apply_cgroup_limits(leaf, logger)
+    _cgroups['current'] = leaf
+    try:
+        yield usage
+    finally:
+        _cgroups['current'] = None
+        usage.update(read_cgroup_usage(leaf))
+        try:
+            os.rmdir(leaf)
+        except OSError:
+            pass  # a straggler still inside - the kernel frees it once it exits
+        
+        batch = _cgroups['batch']
+        for key in ('cpu_seconds', 'read_bytes', 'written_bytes'):
+            batch[key] = batch.get(key, 0) + usage[key]
+        if usage['memory_peak'] is not None:
+            batch['memory_peak'] = max(batch.get('memory_peak', 0), usage['memory_peak'])
+        count_bytes('dpkg_read', usage['read_bytes'])
+        count_bytes('dpkg_written', usage['written_bytes'])
+        append_metrics_line(dict({'type': 'cgroup', 'time': round(time.time(), 3),
+                                  'batch': _metrics['batch'], 'label': label}, **usage))
+        logger.info(f"  {label}: {format_cgroup_usage(usage)}")
+
+def log_batch_cgroup_usage(batch_number, logger):
+    """Log and record the apt/dpkg usage summed over a batch, then start a new sum"""
+    usage = _cgroups['batch']
+    _cgroups['batch'] = {}
+    if not usage:
+        return
+    usage.setdefault('memory_peak', None)
+    logger.info(f"Batch {batch_number} apt/dpkg usage: {format_cgroup_usage(usage)}")
+    append_metrics_line(dict({'type': 'cgroup_batch', 'time': round(time.time(), 3), 'batch': batch_number}, **usage))
+
+# dpkg step named by the start of a pmstatus message
+APT_STAGES = (
+    ('Preparing to unpack', 'unpack'), ('Unpacking', 'unpack'),
+    ('Preparing to configure', 'setup'), ('Configuring', 'setup'), ('Setting up', 'setup'),
+    ('Installed', 'setup'), ('Processing triggers', 'triggers'),
+    ('Preparing for removal', 'remove'), ('Removing', 'remove'), ('Removed', 'remove'),
+    ('Completely removing', 'remove'), ('Completely removed', 'remove'),
+)
+
+def parse_apt_status(line):
+    """Parse one APT::Status-Fd line into {'stage', 'package', 'percent', 'message'}, or None"""
+    kind, _, rest = line.partition(':')
+    if kind not in ('dlstatus', 'pmstatus', 'pmerror'):
+        return None
+    # <kind>:<id or package>[:<arch>]:<percent>:<message> - the message may hold colons
+    match = re.match(r'^(.*?):(\d+(?:\.\d+)?):(.*)$', rest)
+    if not match:
+        return None
+    package, percent, message = match.group(1).split(':')[0], float(match.group(2)), match.group(3).strip()
+    if kind == 'dlstatus':
+        return {'stage': 'download', 'package': None, 'percent': percent, 'message': message}
+    if kind == 'pmerror':
+        return {'stage': 'error', 'package': package, 'percent': percent, 'message': message}
+    stage = next((name for prefix, name in APT_STAGES if message.startswith(prefix)), 'dpkg')
+    return {'stage': stage, 'package': package, 'percent': percent, 'message': message}
+
+@contextmanager
+def apt_progress(logger, action):
+    """Yield an on_line handler turning Status-Fd lines into log lines, events and status
+    
+    On exit the time spent in each stage (download, unpack, setup,
+    triggers, remove) is recorded as an apt_<stage> phase, so one apt run
+    is split into the steps it went through.
+    """
+    last = {'stage': None, 'package': None, 'logged': -100.0, 'published': -100.0}
+    timed = {'stage': None, 'since': None}
+    stages = {}     # stage -> seconds spent in it during this run
+    def note_stage_time():
+        if timed['stage'] is not None:
+            stages[timed['stage']] = stages.get(timed['stage'], 0.0) + time.monotonic() - timed['since']
+    def on_line(line):
+        progress = parse_apt_status(line)
+        if progress is None:
+            return
+        _control['state']['apt'] = dict(progress, action=action)
+        changed = (progress['stage'], progress['package']) != (last['stage'], last['package'])
+        if progress['stage'] == 'error':
+            logger.warning(f"  ✗ dpkg error in {progress['package']}: {progress['message'][:200]}")
+        elif (changed and progress['stage'] != 'download') or progress['percent'] - last['logged'] >= 25:
+            logger.info(f"  [{progress['stage']}] {progress['percent']:.0f}% {progress['message']}")
+            last['logged'] = progress['percent']
+        if changed or progress['percent'] - last['published'] >= 1:
+            publish_event('apt_progress', action=action, **progress)
+            last['published'] = progress['percent']
+        if progress['stage'] not in ('error', timed['stage']):
+            note_stage_time()
+            timed['stage'], timed['since'] = progress['stage'], time.monotonic()
+        last['stage'], last['package'] = progress['stage'], progress['package']
+    try:
+        yield on_line
+    finally:
+        note_stage_time()
+        for stage, seconds in stages.items():
+            record_phase(f'apt_{stage}', seconds, action=action)
+
+def parse_simulated_removals(output):
+    """Return the package names of the Remv/Purg lines of an apt-get -s run"""
+    return {line.split()[1] for line in output.splitlines()
+            if line.startswith(('Remv ', 'Purg ')) and len(line.split()) > 1}
+
+# Hash names of apt's --print-uris output -> hashlib names
+URI_HASHES = {'SHA512': 'sha512', 'SHA256': 'sha256', 'SHA1': 'sha1', 'MD5Sum': 'md5'}
+
+def parse_print_uris(output):
+    """Return [{'uri', 'filename', 'size', 'hash'}] from apt-get --print-uris output"""
+    archives = []
+    for line in output.splitlines():
+        match = re.match(r"^'([^']+)' (\S+) (\d+)(?: (\w+):([0-9a-fA-F]+))?$", line.strip())
+        if match and match.group(2).endswith('.deb'):
+            algorithm = URI_HASHES.get(match.group(4) or '')
+            archives.append({
+                'uri': match.group(1),
+                'filename': match.group(2),
+                'size': int(match.group(3)),
+                'hash': (algorithm, match.group(5).lower()) if algorithm else None,
+            })
+    return archives
+
+def verify_archive(path, archive):
+    """Check a downloaded file against the size and hash apt expects"""
+    if os.path.getsize(path) != archive['size']:
+        return False
+    if not archive['hash']:
+        return True
+    algorithm, expected = archive['hash']
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest() == expected
+
+def fetch_archive(archive, connections, rate=None, cancelled=None):
+    """Download one archive into apt's cache, resuming a partial file; return the bytes transferred
+    
+    connections holds the calling worker's keep-alive connection per host.
+    The partial file has its own name so apt's own downloads never share it.
+    Raises OSError once three attempts failed.
+    """
+    target = os.path.join(apt_archives_dir, archive['filename'])
+    partial = os.path.join(apt_archives_dir, 'partial', archive['filename'] + '.heavy')
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+    url = urlsplit(archive['uri'])
+    path = url.path + (f'?{url.query}' if url.query else '')
+    transferred = 0
+    error = None
+    for _ in range(3):
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if offset >= archive['size']:
+            os.remove(partial)
+            offset = 0
+        connection = connections.get(url.netloc)
+        if connection is None:
+            factory = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+            connection = connections[url.netloc] = factory(url.netloc, timeout=60)
+        try:
+            connection.request('GET', path, headers={'Range': f'bytes={offset}-'} if offset else {})
+            response = connection.getresponse()
+            if response.status == 200:
+                offset = 0
+            elif response.status != 206:
+                response.read()
+                if response.status == 416 and os.path.exists(partial):
+                    os.remove(partial)
+                raise OSError(f"HTTP {response.status} for {archive['uri']}")
+            started = time.monotonic()
+            received = 0
+            with open(partial, 'ab' if offset else 'wb') as f:
+                while True:
+                    if cancelled and cancelled.is_set():
+                        raise OSError("fetch cancelled")
+                    chunk = response.read(64 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+                    if rate:
+                        ahead = received / rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            transferred += received
+        except (OSError, http.client.HTTPException) as e:
+            connections.pop(url.netloc).close()
+            error = e
+            if cancelled and cancelled.is_set():
+                break
+            continue
+        if verify_archive(partial, archive):
+            os.replace(partial, target)
+            return transferred
+        os.remove(partial)
+        error = f"checksum mismatch for {archive['filename']}"
+    raise OSError(str(error))
+
+async def fetch_archives(archives, rate=None, logger=None):
+    """Fetch archives apt has not cached with fetch_workers parallel workers
+    
+    Largest archives go first; rate (bytes/s) is split between the
+    workers. Returns (bytes transferred, filenames that failed) - those
+    are left for apt to fetch itself.
+    """
+    logger = logger or logging.getLogger(__name__)
+    cached = list_cached_archives()
+    pending = [archive for archive in archives
+               if urlsplit(archive['uri']).scheme in ('http', 'https')
+               and cached.get(archive['filename'], (None,))[0] != archive['size']]
+    if not pending or not CONFIG['fetch_workers']:
+        return 0, []
+    queue = deque(sorted(pending, key=lambda archive: -archive['size']))
+    workers = min(CONFIG['fetch_workers'], len(pending))
+    cancelled = threading.Event()
+    totals = {'bytes': 0, 'failed': []}
+    
+    async def worker():
+        connections = {}
+        try:
+            while queue:
+                archive = queue.popleft()
+                try:
+                    fetched = await asyncio.to_thread(
+                        fetch_archive, archive, connections, rate and rate / workers, cancelled)
+                    totals['bytes'] += fetched
+                except OSError as e:
+                    logger.warning(f"  ⚠ Parallel fetch of {archive['filename']} failed: {e}")
+                    note_not_found(str(e))
+                    totals['failed'].append(archive['filename'])
+        finally:
+            for connection in connections.values():
+                connection.close()
+    
+    try:
+        await asyncio.gather(*(worker() for _ in range(workers)))
+    except asyncio.CancelledError:
+        cancelled.set()
+        raise
+    return totals['bytes'], totals['failed']
+
+class AptBackend:
+    """Package manager backend running the real apt, dpkg and statvfs calls"""
+    
+    name = 'apt'
+    download_limit = None    # bytes/s cap for apt downloads, e.g. a fleet download window
+    supports_rollback = False  # True for backends whose rollback(logger) undoes a whole batch at once
+    
+    def command(self, args):
+        """Return the argv that runs an apt/dpkg command against the managed system"""
+        return list(args)
+    
+    async def prepare(self, logger):
+        """Set up whatever the backend needs before the first batch"""
+    
+    async def begin_batch(self, logger):
+        """Mark the start of a batch's installs"""
+    
+    async def close(self, logger):
+        """Release what prepare set up"""
+    
+    def acquire_options(self):
+        """Return apt -o options enforcing download_limit"""
+        if not self.download_limit:
+            return []
+        kbps = max(1, int(self.download_limit / 1024))
+        return ['-o', f'Acquire::http::Dl-Limit={kbps}', '-o', f'Acquire::https::Dl-Limit={kbps}']
+    
+    async def update(self):
+        """Refresh the package lists"""
+        return await run_command(['apt', 'update'] + self.acquire_options(), timeout=300)
+    
+    async def install(self, packages, timeout, on_line=None):
+        """Install packages in one apt run, streaming Status-Fd progress lines to on_line"""
+        return await run_command(
+            self.command(['apt-get', 'install', '-y', '-o', 'APT::Status-Fd=1'] + self.acquire_options() + list(packages)),
+            timeout=timeout, throttle=True, on_line=on_line
+        )
+    
+    async def download(self, packages):
+        """Download the archives packages need without installing them
+        
+        With fetch_workers the URIs apt resolves are fetched in parallel
+        first, so apt's own run only picks up what that stage missed.
+        """
+        if CONFIG['fetch_workers']:
+            returncode, stdout, _ = await run_command(
+                self.command(['apt-get', 'install', '--print-uris', '-qq', '-y'] + list(packages)), timeout=300
+            )
+            if returncode == 0:
+                await fetch_archives(parse_print_uris(stdout), self.download_limit)
+        return await run_command(
+            self.command(['apt-get', 'install', '--download-only', '-y', '-q'] + self.acquire_options() + list(packages))
+        )
+    
+    async def remove(self, package, timeout, on_line=None):
+        """Remove and purge one package, streaming Status-Fd progress lines to on_line"""
+        return await run_command(self.command(['apt', 'remove', '-y', '--purge', '-o', 'APT::Status-Fd=1', package]),
+                                 timeout=timeout, throttle=True, on_line=on_line)
+    
+    async def repair(self):
+        """Finish configuring half-installed packages"""
+        return await run_command(self.command(['dpkg', '--configure', '-a']), timeout=600)
+    
+    async def list_autoremovable(self):
+        """Return the packages apt autoremove would remove right now"""
+        _, stdout, _ = await run_command(self.command(['apt-get', '-s', 'autoremove']), timeout=120)
+        return parse_simulated_removals(stdout)
+    
+    async def simulate_remove(self, packages):
+        """Return every package removing packages would take with it"""
+        _, stdout, _ = await run_command(self.command(['apt-get', '-s', 'remove', '--purge'] + list(packages)), timeout=120)
+        return parse_simulated_removals(stdout)
+    
+    async def remove_packages(self, packages, timeout, on_line=None):
+        """Remove and purge several packages in one run, streaming Status-Fd progress lines to on_line"""
+        return await run_command(self.command(['apt-get', 'remove', '-y', '--purge', '-o', 'APT::Status-Fd=1'] + list(packages)),
+                                 timeout=timeout, throttle=True, on_line=on_line)
+    
+    async def autoclean(self):
+        """Drop cached archives that can no longer be downloaded"""
+        return await run_command(['apt', 'autoclean'], timeout=180)
+    
+    def query_policy(self, names):
+        """Ask apt-cache policy about several packages at once, return {name: has_candidate}"""
+        found = {name: False for name in names}
+        try:
+            result = subprocess.run(
+                ['apt-cache', 'policy'] + list(names),
+                capture_output=True,
+                text=True,
+                timeout=60
+            )
+            current = None
+            for line in result.stdout.splitlines():
+                if line and not line[0].isspace() and line.endswith(':'):
+                    current = line[:-1]
+                elif current in found and line.strip().startswith('Candidate:'):
+                    found[current] = line.split(':', 1)[1].strip() != '(none)'
+        except Exception:
+            pass
+        return found
+    
+    def disk_free_bytes(self):
+        """Return bytes available to unprivileged users on /"""
+        st = os.statvfs('/')
+        return st.f_bavail * st.f_frsize
+
+class FakeBackend(AptBackend):
+    """Simulated package manager for benchmarks - no root, no network
+    
+    Installs and removals update a private dpkg status file (point
+    dpkg_status_file at status_file) and a simulated disk. Operations
+    sleep for their simulated duration times time_scale; 0 runs as fast
+    as possible while still accounting the simulated seconds. With a
+    mirror_url (see run_mirror) downloads really fetch time_scale times
+    their bytes from it, throttled like apt's Dl-Limit. With snapshots
+    it models the overlay engine: begin_batch snapshots the system and
+    rollback restores it at discard_rate instead of removing packages.
+    """
+    
+    name = 'fake'
+    
+    def __init__(self, root, disk_bytes=50 * 1024 ** 3, download_rate=20 * 1024 ** 2,
+                 unpack_rate=60 * 1024 ** 2, remove_rate=200 * 1024 ** 2, command_overhead=2.0,
+                 failure_rate=0.0, time_scale=0.0, seed=None, mirror_url=None,
+                 snapshots=False, discard_rate=2 * 1024 ** 3):
+        self.root = root
+        self.mirror_url = mirror_url
+        self.status_file = os.path.join(root, 'status')
+        self.disk_bytes = disk_bytes
+        self.used_bytes = 0
+        self.download_rate = download_rate
+        self.unpack_rate = unpack_rate
+        self.remove_rate = remove_rate
+        self.command_overhead = command_overhead
+        self.failure_rate = failure_rate
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.installed = {}          # package -> installed bytes
+        self.manual = set()          # explicitly installed packages
+        self.simulated = {}          # operation -> simulated seconds
+        self.supports_rollback = snapshots
+        self.discard_rate = discard_rate
+        self.snapshot = None         # (installed, manual, used_bytes) at begin_batch
+        self.write_status()
+    
+    def write_status(self):
+        """Write the installed packages as a dpkg status file"""
+        with open(self.status_file + '.tmp', 'w') as f:
+            for name in sorted(self.installed):
+                f.write(f"Package: {name}\nStatus: install ok installed\n\n")
+        os.replace(self.status_file + '.tmp', self.status_file)
+    
+    async def simulate(self, operation, seconds):
+        """Account (and optionally sleep for) a simulated operation"""
+        seconds += self.command_overhead
+        self.simulated[operation] = self.simulated.get(operation, 0.0) + seconds
+        await asyncio.sleep(seconds * self.time_scale)
+    
+    def fetch_from_mirror(self, nbytes, rate):
+        """Download nbytes from the stand-in mirror at no more than rate bytes/s"""
+        started = time.monotonic()
+        received = 0
+        with urlopen(f"{self.mirror_url.rstrip('/')}/{nbytes}", timeout=60) as response:
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                received += len(chunk)
+                ahead = received / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+    
+    async def transfer(self, nbytes):
+        """Simulate downloading nbytes, honouring download_limit"""
+        rate = min(self.download_rate, self.download_limit or self.download_rate)
+        if self.mirror_url and self.time_scale and nbytes:
+            self.simulated['download'] = self.simulated.get('download', 0.0) + nbytes / rate
+            await asyncio.to_thread(self.fetch_from_mirror, int(nbytes * self.time_scale), rate)
+        else:
+            await self.simulate('download', nbytes / rate)
+    
+    def missing_packages(self, packages):
+        """Return {package: [installed bytes, download bytes]} apt would have to add"""
+        needed = {}
+        for closure in get_dependency_closures(packages).values():
+            for name in closure:
+                if name not in self.installed:
+                    needed[name] = _size_cache['sizes'][name]
+        return needed
+    
+    def uncached_download_bytes(self, needed):
+        """Return the download bytes of needed packages not in apt_archives_dir"""
+        cached = set(list_cached_archives())
+        index = load_apt_index()
+        return sum(sizes[1] for name, sizes in needed.items()
+                   if get_archive_filename(name, index) not in cached)
+    
+    def cache_archives(self, needed):
+        """Create sparse stand-ins for the archives in apt_archives_dir"""
+        index = load_apt_index()
+        for name, (_, download_bytes) in needed.items():
+            filename = get_archive_filename(name, index)
+            path = os.path.join(apt_archives_dir, filename) if filename else None
+            if path and not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.truncate(download_bytes)
+    
+    async def update(self):
+        await self.simulate('update', 0)
+        return 0, '', ''
+    
+    async def install(self, packages, timeout, on_line=None):
+        needed = self.missing_packages(packages)
+        on_line = on_line or (lambda line: None)
+        on_line("dlstatus:1:0:Retrieving file 1")
+        await self.transfer(self.uncached_download_bytes(needed))
+        self.cache_archives(needed)
+        on_line("dlstatus:1:100:Download complete")
+        for done, name in enumerate(sorted(needed), 1):
+            on_line(f"pmstatus:{name}:{done * 50 / len(needed):.1f}:Unpacking {name} (1.0)")
+        await self.simulate('unpack', sum(sizes[0] for sizes in needed.values()) / self.unpack_rate)
+        for done, name in enumerate(sorted(needed), 1):
+            on_line(f"pmstatus:{name}:{50 + done * 50 / len(needed):.1f}:Setting up {name} (1.0)")
+        
+        # A failing package stops dpkg, like a broken maintainer script
+        failed = None
+        for package in packages:
+            if self.failure_rate and self.rng.random() < self.failure_rate:
+                failed = package
+                break
+            for name in get_dependency_closures([package]).get(package, []):
+                if name in needed and name not in self.installed:
+                    self.installed[name] = needed[name][0]
+                    self.used_bytes += needed[name][0]
+            self.manual.add(package)
+        self.write_status()
+        
+        if failed:
+            return (100, f"pmerror:{failed}:50:installed post-installation script returned error exit status 1\n",
+                    "E: Sub-process /usr/bin/dpkg returned an error code (1)")
+        return 0, '', ''
+    
+    async def download(self, packages):
+        needed = self.missing_packages(packages)
+        await self.transfer(self.uncached_download_bytes(needed))
+        self.cache_archives(needed)
+        return 0, '', ''
+    
+    async def remove(self, package, timeout, on_line=None):
+        freed = self.installed.pop(package, 0)
+        self.manual.discard(package)
+        self.used_bytes -= freed
+        await self.simulate('remove', freed / self.remove_rate)
+        self.write_status()
+        return 0, '', ''
+    
+    async def repair(self):
+        await self.simulate('repair', 0)
+        return 0, '', ''
+    
+    def required_packages(self):
+        """Return the installed packages some manually installed package needs"""
+        required = set(self.manual)
+        for closure in get_dependency_closures(sorted(self.manual)).values():
+            required.update(closure)
+        return required
+    
+    async def list_autoremovable(self):
+        await self.simulate('autoremove', 0)
+        required = self.required_packages()
+        return {name for name in self.installed if name not in required}
+    
+    async def simulate_remove(self, packages):
+        removing = set(packages) & set(self.installed)
+        dependents = {app for app in self.manual
+                      if removing & set(get_dependency_closures([app]).get(app, []))}
+        return removing | dependents
+    
+    async def remove_packages(self, packages, timeout, on_line=None):
+        freed = 0
+        for name in packages:
+            freed += self.installed.pop(name, 0)
+            self.manual.discard(name)
+        self.used_bytes -= freed
+        await self.simulate('remove', freed / self.remove_rate)
+        self.write_status()
+        return 0, '', ''
+    
+    async def autoclean(self):
+        await self.simulate('autoclean', 0)
+        return 0, '', ''
+    
+    async def begin_batch(self, logger):
+        if not self.supports_rollback:
+            return
+        if self.snapshot:
+            await self.rollback(logger)
+        self.snapshot = (dict(self.installed), set(self.manual), self.used_bytes)
+    
+    async def rollback(self, logger):
+        if not self.snapshot:
+            return 0
+        installed, manual, used_bytes = self.snapshot
+        freed = self.used_bytes - used_bytes
+        self.installed, self.manual, self.used_bytes = dict(installed), set(manual), used_bytes
+        self.snapshot = None
+        await self.simulate('rollback', freed / self.discard_rate)
+        self.write_status()
+        return freed
+    
+    def query_policy(self, names):
+        packages = load_apt_index()
+        return {name: name in packages for name in names}
+    
+    def disk_free_bytes(self):
+        cached = sum(size for size, _ in list_cached_archives().values())
+        return self.disk_bytes - self.used_bytes - cached
+
+class OverlayBackend(AptBackend):
+    """apt in a chroot whose changes land in a throwaway overlayfs layer
+    
+    base is a Debian root (e.g. made by debootstrap) used read-only as the
+    lower layer; each batch writes to a fresh upper layer mounted at
+    <root>/merged. The host's apt lists and archive cache are bound in, so
+    planning, prefetch and the fetch stage work unchanged. Rolling a batch
+    back unmounts and deletes its layer instead of running dpkg.
+    """
+    
+    name = 'overlay'
+    supports_rollback = True
+    
+    def __init__(self, base, root):
+        self.base = os.path.abspath(base) if base else None
+        self.root = root
+        self.merged = os.path.join(root, 'merged')
+        self.current = os.path.join(root, 'current')   # symlink to the mounted layer
+        self.layer = None
+        self.dirty = False       # the mounted layer may hold a batch's changes
+    
+    def command(self, args):
+        return ['chroot', self.merged] + list(args)
+    
+    def point_dpkg_status(self, root):
+        """Read installed packages from the dpkg status file under root"""
+        global dpkg_status_file
+        dpkg_status_file = os.path.join(root, 'var/lib/dpkg/status')
+    
+    async def run_mount(self, args):
+        """Run a mount command, raising RuntimeError if it fails"""
+        returncode, _, stderr = await run_command(args, timeout=120)
+        if returncode != 0:
+            raise RuntimeError(f"{' '.join(args)} failed: {stderr.strip()[:200]}")
+    
+    async def mount_layer(self):
+        """Mount a fresh, empty layer over base at merged"""
+        layer = os.path.join(self.root, f"layer-{time.time_ns()}")
+        os.makedirs(os.path.join(layer, 'upper'))
+        os.makedirs(os.path.join(layer, 'work'))
+        os.makedirs(self.merged, exist_ok=True)
+        await self.run_mount(['mount', '-t', 'overlay', 'overlay', '-o',
+                              f"lowerdir={self.base},upperdir={layer}/upper,workdir={layer}/work", self.merged])
+        # Mount propagation is shared on systemd hosts: keep the chroot's mounts from
+        # reaching the host, and keep unmounting them from unmounting the host's submounts
+        await self.run_mount(['mount', '--make-private', self.merged])
+        for fstype, target in [('proc', 'proc'), ('sysfs', 'sys')]:
+            path = os.path.join(self.merged, target)
+            os.makedirs(path, exist_ok=True)
+            await self.run_mount(['mount', '-t', fstype, fstype, path])
+        for source, target in [('/dev', 'dev'),
+                               (apt_lists_dir, 'var/lib/apt/lists'),
+                               (apt_archives_dir, 'var/cache/apt/archives'),
+                               ('/etc/resolv.conf', 'etc/resolv.conf')]:
+            path = os.path.join(self.merged, target)
+            if os.path.isdir(source):
+                os.makedirs(path, exist_ok=True)
+            elif not os.path.exists(path):
+                open(path, 'a').close()
+            await self.run_mount(['mount', '--rbind', source, path])
+            await self.run_mount(['mount', '--make-rslave', path])
+        if os.path.lexists(self.current):
+            os.unlink(self.current)
+        os.symlink(layer, self.current)
+        self.layer = layer
+        self.point_dpkg_status(self.merged)
+    
+    async def unmount_layer(self):
+        """Unmount merged and everything mounted below it, raising RuntimeError if busy"""
+        if os.path.ismount(self.merged):
+            await self.run_mount(['umount', '-R', self.merged])
+    
+    def layer_bytes(self, layer):
+        """Return the disk space the files in a layer's upper directory take"""
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.join(layer, 'upper')):
+            for name in dirnames + filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+    
+    async def prepare(self, logger):
+        if not self.base or not os.path.exists(os.path.join(self.base, 'var/lib/dpkg/status')):
+            raise RuntimeError(f"overlay_base {self.base} is not a Debian root (no var/lib/dpkg/status)")
+        os.makedirs(self.root, exist_ok=True)
+        if os.path.ismount(self.merged) and os.path.islink(self.current):
+            # An interrupted run's layer still holds its open batch; resume rolls it back
+            self.layer = os.readlink(self.current)
+            self.dirty = True
+            self.point_dpkg_status(self.merged)
+            logger.info(f"Overlay layer {self.layer} still mounted, keeping it for the interrupted batch")
+            return
+        await self.unmount_layer()
+        for entry in os.listdir(self.root):
+            if entry.startswith('layer-'):
+                await asyncio.to_thread(shutil.rmtree, os.path.join(self.root, entry), True)
+        await self.mount_layer()
+        logger.info(f"✓ Overlay engine: {self.base} with batch layers under {self.root}")
+    
+    async def begin_batch(self, logger):
+        if self.dirty:
+            logger.info("Discarding the previous batch's overlay layer")
+            await self.rollback(logger)
+        self.dirty = True
+    
+    async def rollback(self, logger):
+        """Discard the batch's layer and mount a fresh one, return the bytes freed"""
+        layer = self.layer
+        freed = await asyncio.to_thread(self.layer_bytes, layer)
+        await self.unmount_layer()
+        await asyncio.to_thread(shutil.rmtree, layer, True)
+        await self.mount_layer()
+        self.dirty = False
+        return freed
+    
+    async def close(self, logger):
+        """Discard the mounted layer and leave nothing mounted"""
+        await self.unmount_layer()
+        if self.layer:
+            await asyncio.to_thread(shutil.rmtree, self.layer, True)
+        if os.path.lexists(self.current):
+            os.unlink(self.current)
+        self.layer = None
+        self.dirty = False
+        self.point_dpkg_status(self.base)
+    
+    def disk_free_bytes(self):
+        """Return bytes available on the filesystem holding the layers"""
+        st = os.statvfs(self.root)
+        return st.f_bavail * st.f_frsize
+
+# Package manager backend used by every apt/dpkg/disk operation
+_backend ={'active': AptBackend()}
+
+def get_backend():
+    """Return the active package manager backend"""
+    return _backend['active']
+
+def set_backend(backend):
+    """Route package manager operations through backend (e.g. a FakeBackend)"""
+    _backend['active'] = backend
+
+# Connection to the fleet coordinator (worker side)
+_fleet = {
+    'reader': None,
+    'writer': None,
+    'pending': {},        # request id -> future waiting for the coordinator's reply
+    'ids': itertools.count(1),
+    'task': None,         # reads replies and resolves pending futures
+}
+
+def parse_address(address):
+    """Split a coordinator address into ('unix', path) or ('tcp', host, port)"""
+    if address.startswith('unix:'):
+        return ('unix', address[5:])
+    host, _, port = address.rpartition(':')
+    return ('tcp', host or '127.0.0.1', int(port))
+
+async def fleet_connect(logger):
+    """Connect to CONFIG['coordinator'] if one is configured"""
+    if not CONFIG['coordinator'] or _fleet['writer']:
+        return
+    address = parse_address(CONFIG['coordinator'])
+    try:
+        if address[0] == 'unix':
+            reader, writer = await asyncio.open_unix_connection(address[1])
+        else:
+            reader, writer = await asyncio.open_connection(address[1], address[2])
+    except OSError as e:
+        logger.warning(f"⚠ Fleet coordinator {CONFIG['coordinator']} unreachable ({e}), running uncoordinated")
+        return
+    _fleet['reader'], _fleet['writer'] = reader, writer
+    _fleet['task'] = asyncio.create_task(fleet_read_replies(logger))
+    logger.info(f"✓ Connected to fleet coordinator {CONFIG['coordinator']}")
+
+async def fleet_read_replies(logger):
+    """Resolve pending requests with the coordinator's replies until it goes away"""
+    try:
+        while True:
+            line = await _fleet['reader'].readline()
+            if not line:
+                break
+            reply = json.loads(line)
+            future = _fleet['pending'].pop(reply.get('id'), None)
+            if future and not future.done():
+                future.set_result(reply)
+            elif 'grant' in reply:
+                # Granted after the request was given up on
+                await fleet_send({'op': 'release', 'grant': reply['grant']})
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠ Fleet coordinator connection failed: {e}")
+    finally:
+        # Anyone still waiting for a slot carries on uncoordinated
+        if _fleet['writer'] is not None:
+            logger.warning("⚠ Lost fleet coordinator, running uncoordinated")
+        _fleet['writer'] = None
+        for future in _fleet['pending'].values():
+            if not future.done():
+                future.set_result(None)
+        _fleet['pending'].clear()
+
+async def fleet_send(message):
+    """Send one request to the coordinator without waiting for a reply"""
+    writer = _fleet['writer']
+    if writer is None:
+        return
+    try:
+        writer.write((json.dumps(message) + '\n').encode())
+        await writer.drain()
+    except OSError:
+        _fleet['writer'] = None
+
+async def fleet_call(message):
+    """Send a request and return the coordinator's reply (None when uncoordinated)"""
+    if _fleet['writer'] is None:
+        return None
+    request_id = next(_fleet['ids'])
+    future = asyncio.get_running_loop().create_future()
+    _fleet['pending'][request_id] = future
+    await fleet_send(dict(message, id=request_id))
+    try:
+        return await future
+    except asyncio.CancelledError:
+        _fleet['pending'].pop(request_id, None)
+        await fleet_send({'op': 'cancel', 'id': request_id})
+        raise
+
+@asynccontextmanager
+async def fleet_slot(kind, logger):
+    """Hold a fleet-wide 'batch' slot or 'download' window for the block
+    
+    Download windows come with the bandwidth share apt is limited to
+    meanwhile. Without a coordinator this does nothing.
+    """
+    if _fleet['writer'] is None:
+        yield None
+        return
+    started = time.monotonic()
+    grant = await fleet_call({'op': 'acquire', 'kind': kind, 'host': f"{socket.gethostname()}:{os.getpid()}"})
+    if grant is None:
+        yield None
+        return
+    waited = time.monotonic() - started
+    if waited >= 1:
+        logger.info(f"Waited {waited:.0f}s for a fleet {kind} slot")
+    backend = get_backend()
+    if grant.get('rate'):
+        backend.download_limit = grant['rate']
+    try:
+        yield grant
+    finally:
+        backend.download_limit = None
+        await fleet_send({'op': 'release', 'grant': grant['grant']})
+
+async def fleet_close():
+    """Disconnect from the coordinator"""
+    writer = _fleet['writer']
+    _fleet['writer'] = None
+    if writer is not None:
+        writer.close()
+    if _fleet['task']:
+        _fleet['task'].cancel()
+        _fleet['task'] = None
+
+# Token bucket shaping package downloads (see bandwidth_profile)
+_shaper = {
+    'tokens': None,       # bytes that may be fetched before waiting, negative while in debt
+    'refilled': 0.0,      # monotonic time of the last refill
+    'window': deque(),    # (time, bytes) fetched within the last hour
+    'bytes': 0,           # bytes fetched by shaped downloads
+    'seconds': 0.0,       # time those downloads took
+    'target': None,       # rate limit of the current or last download, bytes/s
+}
+
+def get_profile_rate(now=None):
+    """Return the bandwidth_profile rate in bytes/s at local time now, None if unlimited"""
+    now = now or datetime.now()
+    hour = now.hour + now.minute / 60
+    for start, end, mb_per_s in CONFIG['bandwidth_profile']:
+        inside = start <= hour < end if start <= end else (hour >= start or hour < end)
+        if inside:
+            return mb_per_s * 1024 * 1024
+    return None
+
+def refill_tokens(rate):
+    """Top the token bucket up for the time since the last refill at rate bytes/s"""
+    now = time.monotonic()
+    burst = CONFIG['bandwidth_burst_mb'] * 1024 * 1024
+    if _shaper['tokens'] is None or rate is None:
+        _shaper['tokens'] = burst
+    else:
+        _shaper['tokens'] = min(burst, _shaper['tokens'] + (now - _shaper['refilled']) * rate)
+    _shaper['refilled'] = now
+
+def get_hour_bytes():
+    """Return the bytes shaped downloads fetched within the last hour"""
+    cutoff = time.time() - 3600
+    window = _shaper['window']
+    while window and window[0][0] < cutoff:
+        window.popleft()
+    return sum(nbytes for _, nbytes in window)
+
+async def wait_for_bandwidth(logger):
+    """Wait until the profile, token bucket and hourly budget allow a download, return its rate"""
+    announced = False
+    while True:
+        rate = get_profile_rate()
+        refill_tokens(rate)
+        reasons = {}
+        if rate == 0:
+            reasons['profile holds downloads back'] = 60
+        elif rate and _shaper['tokens'] < 0:
+            reasons[f"{-_shaper['tokens']/1024**2:.0f}MB over the token bucket"] = -_shaper['tokens'] / rate
+        budget = CONFIG['bandwidth_hourly_budget_mb']
+        if budget and get_hour_bytes() >= budget * 1024 * 1024:
+            reasons[f"hourly budget of {budget}MB used"] = _shaper['window'][0][0] + 3600 - time.time()
+        if not reasons or shutdown_flag:
+            return rate
+        
+        # Re-check at least every minute, the profile may have moved on
+        wait = min(max(reasons.values()), 60)
+        if not announced:
+            logger.info(f"Waiting for download bandwidth: {', '.join(reasons)}")
+            announced = True
+        await wait_for_shutdown(max(1, wait))
+
+@asynccontextmanager
+async def shaped_download(logger):
+    """Run a package download under the bandwidth profile, charging what it fetched
+    
+    Nested inside a fleet download window apt gets the lower of the two
+    limits. The charge is the larger of the archive cache growth and the
+    bytes received on the network meanwhile.
+    """
+    rate = await wait_for_bandwidth(logger)
+    backend = get_backend()
+    previous = backend.download_limit
+    if rate:
+        backend.download_limit = min(previous or rate, rate)
+    _shaper['target'] = backend.download_limit
+    cached = list_cached_archives()
+    received = read_net_received_bytes()
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        backend.download_limit = previous
+        grown = sum(info[0] for name, info in list_cached_archives().items() if cached.get(name) != info)
+        fetched = max(grown, read_net_received_bytes() - received)
+        if fetched > 0:
+            refill_tokens(get_profile_rate())
+            _shaper['tokens'] -= fetched
+            _shaper['window'].append((time.time(), fetched))
+            _shaper['bytes'] += fetched
+            _shaper['seconds'] += time.monotonic() - started
+            count_bytes('shaped_download', fetched)
+
+def get_bandwidth_status():
+    """Return the download target, achieved rate and hourly budget use as a dict"""
+    profile = get_profile_rate()
+    target = _shaper['target']
+    return {
+        'profile_mb_s': None if profile is None else round(profile / 1024 ** 2, 2),
+        'target_mb_s': None if target is None else round(target / 1024 ** 2, 2),
+        'achieved_mb_s': round(_shaper['bytes'] / _shaper['seconds'] / 1024 ** 2, 2) if _shaper['seconds'] else None,
+        'hour_mb': round(get_hour_bytes() / 1024 ** 2),
+        'budget_mb': CONFIG['bandwidth_hourly_budget_mb'],
+    }
+
+async def install_app_individually(app, logger):
+    """Install a single app individually"""
+    await wait_for_low_pressure(logger)
+    with time_phase('install_app', package=app), apt_cgroup(f'install-{app}', logger), \
+            apt_progress(logger, 'install') as on_line:
+        try:
+            logger.info(f"  Installing {app}...")
+            returncode, _, stderr = await get_backend().install(
+                [app],
+                timeout=600,  # 10 minutes per app
+                on_line=on_line
+            )
+            
+            if returncode == 0:
+                logger.info(f"  ✓ Successfully installed {app}")
+                return True
+            else:
+                note_not_found(stderr)
+                error_msg = stderr[:200] if stderr else "Unknown error"
+                logger.warning(f"  ✗ Failed to install {app}: {error_msg}")
+                return False
+                
+        except subprocess.TimeoutExpired:
+            logger.warning(f"  ✗ Timeout installing {app}")
+            return False
+        except Exception as e:
+            logger.warning(f"  ✗ Error installing {app}: {e}")
+            return False
+
+async def repair_dpkg_state(logger):
+    """Finish configuring packages left half-installed by a failed apt run"""
+    try:
+        await get_backend().repair()
+    except Exception as e:
+        logger.warning(f"  ⚠ dpkg --configure -a had issues: {e}")
+
+async def install_apps_transaction(apps, logger):
+    """Install several apps in a single apt/dpkg run, return (ok, {app: installed})"""
+    await wait_for_low_pressure(logger)
+    with time_phase('install_transaction', packages=len(apps)), apt_cgroup(f'install-{len(apps)}-apps', logger), \
+            apt_progress(logger, 'install') as on_line:
+        logger.info(f"  Installing {len(apps)} apps in one transaction: {', '.join(apps)}")
+        error_msg = None
+        returncode = None
+        try:
+            returncode, _, stderr = await get_backend().install(
+                apps,
+                timeout=600 * len(apps),  # 10 minutes per app, as in individual mode
+                on_line=on_line
+            )
+            if returncode != 0:
+                note_not_found(stderr)
+                error_msg = stderr[:200] if stderr else "Unknown error"
+        except subprocess.TimeoutExpired:
+            error_msg = "Timeout"
+        except Exception as e:
+            error_msg = str(e)
+        
+        # apt's own report can be partial, dpkg state is authoritative
+        installed = set(get_installed_apps_from_batch(apps))
+        results = {app: app in installed for app in apps}
+        
+        ok = returncode == 0 and all(results.values())
+        if not ok:
+            logger.warning(f"  ✗ Transaction failed: {error_msg or 'packages missing after install'}")
+        return ok, results
+
+async def install_apps_bisect(apps, logger):
+    """Install apps in one transaction, bisecting the remainder if it fails"""
+    ok, results = await install_apps_transaction(apps, logger)
+    if ok:
+        for app in apps:
+            logger.info(f"  ✓ Successfully installed {app}")
+        return results
+    
+    await repair_dpkg_state(logger)
+    remaining = [app for app in apps if not results[app]]
+    for app in apps:
+        if results[app]:
+            logger.info(f"  ✓ Successfully installed {app}")
+    
+    if len(apps) == 1 or shutdown_flag or is_disk_critical():
+        for app in remaining:
+            logger.warning(f"  ✗ Failed to install {app}")
+        return results
+    
+    # Retry the still-missing apps in two halves so one bad package
+    # only costs log2(n) extra runs instead of n
+    if len(remaining) == len(apps):
+        middle = len(remaining) // 2
+        halves = [remaining[:middle], remaining[middle:]]
+    else:
+        halves = [remaining]
+    
+    for half in halves:
+        if half:
+            results.update(await install_apps_bisect(half, logger))
+    return results
+
+async def install_batch_2gb(apps_list, batch_num, total_size_mb, logger, cached_archives=None):
+    """Install a 2GB batch of heavy apps
+    
+    cached_archives is the archive cache contents from before a prefetch
+    of this batch, so prefetched downloads are not counted as cache hits.
+    """
+    logger.info(f"\n{'='*60}")
+    logger.info(f"INSTALLING BATCH {batch_num}")
+    logger.info(f"Apps: {len(apps_list)}")
+    logger.info(f"Estimated size: {total_size_mb/1024:.1f}GB")
+    logger.info(f"App list: {', '.join(apps_list)}")
+    logger.info('='*60)
+    
+    # Validate packages exist
+    valid_apps = []
+    availability = await asyncio.to_thread(check_packages_available, apps_list, logger)
+    for app in apps_list:
+        if availability[app]:
+            valid_apps.append(app)
+        else:
+            logger.warning(f"✗ Package not available: {app}")
+    
+    if not valid_apps:
+        logger.error("✗ No valid packages to install")
+        return False, []
+    
+    logger.info(f"Valid packages: {len(valid_apps)}/{len(apps_list)}")
+    
+    # Check disk space before installation - unpacked size plus the
+    # downloaded archives of everything apt will pull in
+    installed_bytes, download_bytes = await asyncio.to_thread(get_batch_size, valid_apps, logger)
+    available_gb = check_disk_space()
+    required_gb = (installed_bytes + download_bytes) * 1.5 / (1024 ** 3)  # Need 1.5x for safety
+    
+    logger.info(f"Batch size with dependencies: {installed_bytes/1024**3:.2f}GB installed, "
+                f"{download_bytes/1024**3:.2f}GB download")
+    logger.info(f"Disk space check: {available_gb:.1f}GB available, {required_gb:.1f}GB required")
+    
+    if available_gb < required_gb:
+        logger.error(f"✗ Insufficient disk space. Need {required_gb:.1f}GB, have {available_gb:.1f}GB")
+        return False, []
+    
+    await asyncio.to_thread(record_archive_usage, valid_apps, logger, cached_archives)
+    
+    # Fetch stage - whatever the prefetch did not get, so dpkg never waits on the network.
+    # Only this stage holds the download window and is shaped; dpkg runs outside it.
+    # A 404 means the lists went stale under us: refresh them and fetch again
+    async with fleet_slot('download', logger), shaped_download(logger):
+        for attempt in range(2):
+            with time_phase('fetch', apps=len(valid_apps)):
+                try:
+                    _, _, stderr = await get_backend().download(valid_apps)
+                    note_not_found(stderr)
+                except Exception as e:
+                    logger.warning(f"⚠ Fetch stage had issues, apt downloads the rest: {e}")
+            if attempt or not _index['not_found']:
+                break
+            await refresh_package_index(logger, "an archive returned 404", window_held=True)
+    
+    installed_apps = []
+    success_count = 0
+    
+    if CONFIG['install_mode'] == 'transaction':
+        # One apt/dpkg run for the whole batch, bisecting on failure
+        results = await install_apps_bisect(valid_apps, logger)
+        installed_apps = [app for app in valid_apps if results.get(app)]
+        success_count = len(installed_apps)
+    else:
+        # Install apps individually for better tracking
+        for app in valid_apps:
+            if is_disk_critical():
+                logger.error("✗ Disk space critical, not installing the rest of the batch")
+                break
+            if await install_app_individually(app, logger):
+                success_count += 1
+                installed_apps.append(app)
+            
+            # Small delay between individual installs
+            await asyncio.sleep(CONFIG['install_pause_seconds'])
+    
+    logger.info(f"\nInstallation summary for batch {batch_num}:")
+    logger.info(f"Successfully installed: {success_count}/{len(valid_apps)} apps")
+    
+    if success_count > 0:
+        logger.info(f"✓ Batch {batch_num} installation completed")
+        return True, installed_apps
+    else:
+        logger.error(f"✗ Batch {batch_num} installation failed")
+        return False, []
+
+async def uninstall_app_individually(app, logger):
+    """Uninstall a single app individually"""
+    await wait_for_low_pressure(logger)
+    with time_phase('uninstall_app', package=app), apt_cgroup(f'remove-{app}', logger), \
+            apt_progress(logger, 'remove') as on_line:
+        try:
+            logger.info(f"  Uninstalling {app}...")
+            
+            # First check if app is installed
+            if not is_package_installed(app):
+                logger.info(f"  ⚠ {app} is not installed")
+                return True
+            
+            # Remove with purge to clean everything
+            returncode, _, _ = await get_backend().remove(app, timeout=300, on_line=on_line)
+            
+            if returncode == 0:
+                logger.info(f"  ✓ Successfully uninstalled {app}")
+                return True
+            else:
+                logger.warning(f"  ✗ Failed to uninstall {app}")
+                return False
+                
+        except subprocess.TimeoutExpired:
+            logger.warning(f"  ✗ Timeout uninstalling {app}")
+            return False
+        except Exception as e:
+            logger.warning(f"  ✗ Error uninstalling {app}: {e}")
+            return False
+
+async def uninstall_batch_completely(apps_list, batch_num, logger):
+    """Completely uninstall all apps from batch"""
+    logger.info(f"\n{'='*60}")
+    logger.info(f"UNINSTALLING BATCH {batch_num}")
+    logger.info(f"Apps to uninstall: {len(apps_list)}")
+    logger.info(f"App list: {', '.join(apps_list)}")
+    logger.info('='*60)
+
+    backend = get_backend()
+    if backend.supports_rollback:
+        # Discarding the batch's snapshot takes its apps and every dependency with it
+        try:
+            freed = await backend.rollback(logger)
+        except Exception as e:
+            logger.error(f"✗ Rolling back batch {batch_num} failed: {e}")
+            return False
+        count_bytes('rolled_back', freed)
+        journal_drop_introduced([package for package, _, _ in journal_get_introduced()])
+        for done, app in enumerate(apps_list, 1):
+            journal_record_package(batch_num, app, 'uninstall', True)
+            set_loop_progress(done, len(apps_list), package=app, ok=True)
+        logger.info(f"✓ Batch {batch_num} rolled back ({freed/1024**2:.0f}MB discarded)")
+        return True
+
+    success_count = 0
+
+    for done, app in enumerate(apps_list, 1):
+        removed = await uninstall_app_individually(app, logger)
+        journal_record_package(batch_num, app, 'uninstall', removed)
+        set_loop_progress(done, len(apps_list), package=app, ok=removed)
+        if removed:
+            success_count += 1
+        
+        # Small delay between uninstalls
+        await asyncio.sleep(CONFIG['uninstall_pause_seconds'])
+    
+    logger.info(f"\nUninstallation summary for batch {batch_num}:")
+    logger.info(f"Successfully uninstalled: {success_count}/{len(apps_list)} apps")
+    
+    if success_count > 0:
+        logger.info(f"✓ Batch {batch_num} uninstallation completed")
+        return True
+    else:
+        logger.warning(f"⚠ Batch {batch_num} uninstallation had issues")
+        return False
+
+def record_batch_dependencies(batch_number, baseline_status, apps, logger):
+    """Journal the dependencies a batch introduced (its dpkg diff) and touch reused ones"""
+    status = load_dpkg_status()
+    added = [name for name, state in status.items()
+             if is_status_installed(state) and not is_status_installed(baseline_status.get(name))
+             and name not in apps]
+    recorded = {package: size for package, _, size in journal_get_introduced()}
+    needed = set()
+    for closure in get_dependency_closures(apps, logger).values():
+        needed.update(closure)
+    
+    packages = {name: _size_cache['sizes'].get(name, [0, 0])[0] for name in added}
+    packages.update({name: recorded[name] for name in needed if name in recorded})
+    journal_add_introduced(batch_number, packages)
+    if added:
+        logger.info(f"Batch {batch_number} introduced {len(added)} dependencies "
+                    f"({sum(packages[name] for name in added)/1024**2:.0f}MB), kept until disk pressure")
+
+def cleanup_needed():
+    """Check if free space is below the cleanup threshold"""
+    return check_disk_space() < CONFIG['cleanup_free_gb']
+
+def is_own_temp_file(name):
+    """Return True for temporary files this daemon creates (never other programs' files)"""
+    return name.startswith('heavy_2gb_') and (name.endswith('.tmp') or name.startswith('heavy_2gb_bench.'))
+
+def clean_temp_files(logger):
+    """Remove our own temporary files and directories older than tmp_max_age_hours"""
+    cutoff = time.time() - CONFIG['tmp_max_age_hours'] * 3600
+    freed = removed = 0
+    for directory in temp_directories:
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if not is_own_temp_file(entry.name):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+                if st.st_mtime > cutoff or st.st_uid != os.getuid() or stat.S_ISSOCK(st.st_mode):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    size = sum(os.path.getsize(os.path.join(root, name))
+                               for root, _, names in os.walk(entry.path) for name in names
+                               if not os.path.islink(os.path.join(root, name)))
+                    shutil.rmtree(entry.path)
+                else:
+                    size = st.st_size
+                    os.remove(entry.path)
+                freed += size
+                removed += 1
+            except OSError:
+                continue
+    if removed:
+        logger.info(f"Removed {removed} stale temporary entries ({freed/1024**2:.0f}MB)")
+    return freed
+
+async def remove_batch_dependencies(packages, logger):
+    """Remove recorded batch dependencies that nothing needs, return the ones removed
+    
+    Only packages apt itself would autoremove are taken, and only if a
+    simulated removal touches nothing else.
+    """
+    backend = get_backend()
+    states = get_package_states(packages)
+    gone = [name for name in packages if not is_status_installed(states.get(name))]
+    autoremovable = await backend.list_autoremovable()
+    # Something installed since needs these - they are no longer ours to remove
+    needed = [name for name in packages if name not in gone and name not in autoremovable]
+    journal_drop_introduced(gone + needed)
+    
+    candidates = [name for name in packages if name in autoremovable]
+    if not candidates:
+        return []
+    extra = await backend.simulate_remove(candidates) - set(candidates)
+    if extra:
+        logger.warning(f"⚠ Removing batch dependencies would also remove {', '.join(sorted(extra))}, skipped")
+        return []
+    with apt_cgroup(f'remove-{len(candidates)}-dependencies', logger), apt_progress(logger, 'remove') as on_line:
+        returncode, _, stderr = await backend.remove_packages(candidates, timeout=600, on_line=on_line)
+    if returncode != 0:
+        logger.warning(f"⚠ Removing batch dependencies failed: {stderr[:200]}")
+    states = get_package_states(candidates)
+    removed = [name for name in candidates if not is_status_installed(states.get(name))]
+    journal_drop_introduced(removed)
+    return removed
+
+async def cleanup_system(logger, force=False):
+    """Reclaim disk space: batch dependencies (oldest batches first), stale archives and temp files
+    
+    Without force, dependencies are only removed until cleanup_target_free_gb
+    is free again - the rest stay installed for later batches to reuse.
+    Returns the bytes reclaimed.
+    """
+    with time_phase('cleanup', totals=True):
+        logger.info("\nPerforming system cleanup...")
+        reclaimed = 0
+        
+        try:
+            free_before = get_backend().disk_free_bytes()
+            target = CONFIG['cleanup_target_free_gb'] * 1024 ** 3
+            
+            # Oldest batches first, just enough to get back to the target
+            chosen = []
+            expected = free_before
+            for package, _, size in journal_get_introduced():
+                if not force and expected >= target:
+                    break
+                chosen.append(package)
+                expected += size
+            removed = await remove_batch_dependencies(chosen, logger) if chosen else []
+            
+            # Clean package cache
+            await get_backend().autoclean()
+            
+            # Keep downloaded package files for later batches, within budget
+            enforce_archive_budget(logger)
+            
+            # Clean temporary files
+            clean_temp_files(logger)
+            
+            reclaimed = max(0, get_backend().disk_free_bytes() - free_before)
+            count_bytes('reclaimed', reclaimed)
+            logger.info(f"✓ System cleanup reclaimed {reclaimed/1024**2:.0f}MB "
+                        f"({len(removed)} batch dependencies removed)")
+            
+            # Show disk space after cleanup
+            available_gb = check_disk_space()
+            logger.info(f"Available disk space: {available_gb:.1f}GB")
+            
+        except Exception as e:
+            logger.warning(f"⚠ Cleanup had issues: {e}")
+    return reclaimed
+
+class BatchScheduler:
+    """Paces the batch loop towards target_gb_per_hour or target_batches_per_hour
+    
+    Without a target, hold and wait are drawn from hold_minutes and
+    wait_minutes. With one, the busy time (install, uninstall, cleanup)
+    of recent batches is fitted against their size, and the next batch
+    size, hold and wait are chosen so a cycle lasts as long as the target
+    rate allows. Times are passed in, so the simulator can drive it on
+    its virtual clock.
+    """
+    
+    def __init__(self, now, rng=random):
+        self.started = now
+        self.rng = rng
+        self.installed_mb = 0.0
+        self.batches = 0
+        self.samples = deque(maxlen=10)   # (installed MB, busy seconds) of recent batches
+        self.cycle_started = None
+    
+    def target(self):
+        """Return ('gb', MB/s) or ('batches', batches/s) for the configured target, or None"""
+        if CONFIG['target_gb_per_hour']:
+            return 'gb', CONFIG['target_gb_per_hour'] * 1024 / 3600
+        if CONFIG['target_batches_per_hour']:
+            return 'batches', CONFIG['target_batches_per_hour'] / 3600
+        return None
+    
+    def required_rate(self, now):
+        """Return the rate needed to be back on target within schedule_horizon_minutes"""
+        kind, rate = self.target()
+        done = self.installed_mb if kind == 'gb' else self.batches
+        # Finished cycles only - the current one is credited when it ends
+        elapsed = (self.cycle_started if self.cycle_started is not None else now) - self.started
+        behind = rate * elapsed - done
+        rate += behind / (CONFIG['schedule_horizon_minutes'] * 60)
+        return min(max(rate, self.target()[1] / 2), self.target()[1] * 2)
+    
+    def busy_seconds(self, size_mb):
+        """Estimate the busy seconds of a size_mb batch from recent batches, None before the first"""
+        if not self.samples:
+            return None
+        mean_mb = sum(mb for mb, _ in self.samples) / len(self.samples)
+        mean_busy = sum(busy for _, busy in self.samples) / len(self.samples)
+        spread = sum((mb - mean_mb) ** 2 for mb, _ in self.samples)
+        if len(self.samples) >= 3 and spread > 0:
+            slope = sum((mb - mean_mb) * (busy - mean_busy) for mb, busy in self.samples) / spread
+            if slope > 0:
+                return max(0.0, mean_busy + slope * (size_mb - mean_mb))
+        return mean_busy * size_mb / mean_mb
+    
+    def cycle_seconds(self, size_mb, now):
+        """Return how long a cycle of a size_mb batch may take at the required rate"""
+        kind, _ = self.target()
+        rate = self.required_rate(now)
+        return size_mb / rate if kind == 'gb' else 1 / rate
+    
+    def jitter(self, seconds, bounds):
+        """Jitter seconds by +/- schedule_jitter, kept within bounds (minutes)"""
+        spread = CONFIG['schedule_jitter']
+        seconds *= self.rng.uniform(1 - spread, 1 + spread)
+        return min(max(seconds, bounds[0] * 60), bounds[1] * 60)
+    
+    def next_batch_mb(self, now):
+        """Return the size to plan the next batch at"""
+        default = CONFIG['batch_target_mb']
+        target = self.target()
+        if not target or target[0] != 'gb' or not self.samples:
+            return default
+        
+        # Prefer the configured size, as long as the idle time it leaves fits the ranges
+        idle_min = (CONFIG['hold_minutes'][0] + CONFIG['wait_minutes'][0]) * 60
+        idle_max = (CONFIG['hold_minutes'][1] + CONFIG['wait_minutes'][1]) * 60
+        def misfit(size_mb):
+            idle = self.cycle_seconds(size_mb, now) - self.busy_seconds(size_mb)
+            return max(idle_min - idle, idle - idle_max, 0)
+        low, high = CONFIG['batch_target_mb_range']
+        return min(range(low, high + 1, 50), key=lambda size_mb: (misfit(size_mb), abs(size_mb - default)))
+    
+    def begin_batch(self, now):
+        """Start timing a batch cycle"""
+        self.cycle_started = now
+    
+    def hold_seconds(self, size_mb, now):
+        """Return how long to hold a batch of size_mb"""
+        busy = self.busy_seconds(size_mb)
+        if not self.target() or busy is None:
+            return self.rng.randint(*CONFIG['hold_minutes']) * 60
+        
+        # Split the idle time of the cycle like the middles of the two ranges
+        hold = sum(CONFIG['hold_minutes'])
+        share = hold / (hold + sum(CONFIG['wait_minutes'])) if hold else 0.0
+        idle = self.cycle_seconds(size_mb, now) - busy
+        return self.jitter(idle * share, CONFIG['hold_minutes'])
+    
+    def wait_seconds(self, size_mb, now):
+        """Return how long to wait before the next batch, closing the cycle on target"""
+        if not self.target() or self.cycle_started is None:
+            return self.rng.randint(*CONFIG['wait_minutes']) * 60
+        remaining = self.cycle_started + self.cycle_seconds(size_mb, now) - now
+        return self.jitter(remaining, (CONFIG['wait_minutes'][0], math.inf))
+    
+    def finish_batch(self, installed_mb, idle_seconds, now):
+        """Account a finished cycle; idle_seconds is the hold and wait it spent"""
+        if installed_mb <= 0:
+            return
+        self.installed_mb += installed_mb
+        self.batches += 1
+        if self.cycle_started is not None:
+            self.samples.append((installed_mb, max(0.0, now - self.cycle_started - idle_seconds)))
+    
+    def status(self, now):
+        """Return the target and the rates achieved so far as a dict"""
+        hours = max(now - self.started, 1) / 3600
+        return {
+            'target_gb_per_hour': CONFIG['target_gb_per_hour'],
+            'target_batches_per_hour': CONFIG['target_batches_per_hour'],
+            'achieved_gb_per_hour': round(self.installed_mb / 1024 / hours, 2),
+            'achieved_batches_per_hour': round(self.batches / hours, 2),
+            'next_batch_mb': self.next_batch_mb(now),
+        }
+
+# Batch scheduler of the running loop, for status requests
+_scheduler = {'active': None}
+
+# Next batch planned (and downloaded) while the current one is held
+_prefetch = {
+    'apps': [],
+    'size_mb': 0,
+    'cached': None,       # archive cache contents before the download started
+}
+
+async def prefetch_next_batch(baseline_status, logger, target_mb=None):
+    """Plan the next batch and download its archives while the current one is held
+    
+    baseline_status is the dpkg state from before the current batch was
+    installed, so the plan does not count on dependencies that are about
+    to be uninstalled. Cancelling the task stops the download and keeps
+    whatever apt already fetched.
+    """
+    apps, size_mb = await asyncio.to_thread(select_batch_2gb, baseline_status, target_mb)
+    _prefetch['apps'] = apps
+    _prefetch['size_mb'] = size_mb
+    _prefetch['cached'] = None
+    if not apps or not CONFIG['prefetch']:
+        return
+    
+    availability = await asyncio.to_thread(check_packages_available, apps, logger)
+    valid_apps = [app for app in apps if availability[app]]
+    if not valid_apps:
+        return
+    
+    # The archives land next to the installed batch - keep the critical floor
+    _, download_bytes = await asyncio.to_thread(get_batch_size, valid_apps, logger)
+    available_gb = check_disk_space()
+    required_gb = download_bytes * 1.5 / (1024 ** 3)
+    if available_gb - required_gb < CONFIG['disk_critical_gb']:
+        logger.info(f"Prefetch skipped: {required_gb:.1f}GB of archives would leave "
+                    f"{available_gb - required_gb:.1f}GB free")
+        return
+    
+    logger.info(f"Prefetching next batch ({download_bytes/1024**3:.2f}GB): {', '.join(valid_apps)}")
+    _prefetch['cached'] = set(list_cached_archives())
+    started = time.time()
+    try:
+        async with fleet_slot('download', logger), shaped_download(logger):
+            with time_phase('prefetch', apps=len(valid_apps)):
+                returncode, _, stderr = await get_backend().download(valid_apps)
+                note_not_found(stderr)
+    except asyncio.CancelledError:
+        logger.info(f"Prefetch cancelled after {time.time() - started:.0f}s")
+        raise
+    
+    elapsed = time.time() - started
+    if returncode == 0:
+        logger.info(f"✓ Prefetch completed in {elapsed:.0f}s")
     else:
-        logger.error(f"✗ Batch {batch_num} installation failed")
-        return False, []
+        logger.warning(f"⚠ Prefetch exited with code {returncode} after {elapsed:.0f}s")
 
-def uninstall_app_individually(app, logger):
-    """Uninstall a single app individually"""
+async def finish_task(task, logger, timeout):
+    """Wait up to timeout seconds for a background task, cancelling it on timeout or shutdown"""
+    if task is None:
+        return
+    waiter = asyncio.ensure_future(shutdown_event.wait())
     try:
-        logger.info(f"  Uninstalling {app}...")
-        
-        # First check if app is installed
-        check_result = subprocess.run(
-            ['dpkg', '-l', app],
-            capture_output=True,
-            text=True
-        )
-        
-        if check_result.returncode != 0 or 'ii' not in check_result.stdout:
-            logger.info(f"  ⚠ {app} is not installed")
-            return True
-        
-        # Remove with purge to clean everything
-        result = subprocess.run(
-            ['apt', 'remove', '-y', '--purge', app],
-            timeout=300,
-            capture_output=True,
-            text=True
-        )
-        
-        if result.returncode == 0:
-            logger.info(f"  ✓ Successfully uninstalled {app}")
-            return True
-        else:
-            logger.warning(f"  ✗ Failed to uninstall {app}")
-            return False
-            
-    except subprocess.TimeoutExpired:
-        logger.warning(f"  ✗ Timeout uninstalling {app}")
-        return False
+        await asyncio.wait({task, waiter}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+    if not task.done():
+        task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
     except Exception as e:
-        logger.warning(f"  ✗ Error uninstalling {app}: {e}")
+        logger.warning(f"⚠ Background task failed: {e}")
+
+def take_prefetched_batch():
+    """Return (apps, size_mb, cached archives) planned by the last prefetch, or None"""
+    if not _prefetch['apps']:
+        return None
+    batch = (_prefetch['apps'], _prefetch['size_mb'], _prefetch['cached'])
+    _prefetch['apps'] = []
+    _prefetch['size_mb'] = 0
+    _prefetch['cached'] = None
+    return batch
+
+# Live daemon state served on control_socket, with pause/resume and an event stream
+_control = {
+    'loop': None,
+    'server': None,
+    'subscribers': set(),  # asyncio.Queue per event stream client
+    'clients': set(),      # connection handler tasks
+    'paused': False,
+    'resume_event': None,  # asyncio.Event set while not paused
+    'started': time.time(),
+    'state': {
+        'phase': 'starting',
+        'phase_started': time.time(),
+        'phase_until': None,
+        'batch': 0,
+        'apps': [],
+        'installed': [],
+        'progress': None,
+        'apt': None,          # latest Status-Fd progress of the running apt/dpkg
+        'counters': {},
+    },
+}
+
+def publish_event(event, **fields):
+    """Send an event to every stream client (safe to call from any thread)"""
+    loop = _control['loop']
+    if loop is None or not _control['subscribers']:
+        return
+    record = dict({'event': event, 'time': round(time.time(), 3)}, **fields)
+    def deliver():
+        for queue in list(_control['subscribers']):
+            if not queue.full():
+                queue.put_nowait(record)
+    try:
+        loop.call_soon_threadsafe(deliver)
+    except RuntimeError:
+        pass   # loop already closed
+
+def set_loop_phase(phase, until=None, **fields):
+    """Record which step of the batch loop is running, e.g. 'holding' until a time"""
+    now = time.time()
+    _control['state'].update(fields, phase=phase, phase_started=now, phase_until=until, progress=None, apt=None)
+    publish_event('phase', phase=phase, until=until, **fields)
+
+def set_loop_progress(done, total, **fields):
+    """Record progress (done of total) within the current loop phase"""
+    _control['state']['progress'] = dict({'done': done, 'total': total}, **fields)
+    publish_event('progress', phase=_control['state']['phase'], done=done, total=total, **fields)
+
+def get_control_status():
+    """Return the live daemon state as a JSON-serialisable dict"""
+    state = dict(_control['state'])
+    sample = get_latest_sample()
+    free_bytes = sample['free_bytes'] if sample else get_backend().disk_free_bytes()
+    return dict(state, **{
+        'pid': os.getpid(),
+        'uptime': round(time.time() - _control['started']),
+        'paused': _control['paused'],
+        'stop_requested': shutdown_flag,
+        'disk_free_gb': round(free_bytes / 1024 ** 3, 2),
+        'disk_level': _sampler['level'],
+        'bytes': get_metrics_summary()['bytes'],
+        'bandwidth': get_bandwidth_status(),
+        'schedule': _scheduler['active'].status(time.monotonic()) if _scheduler['active'] else None,
+        'pressure': sample['pressure'] if sample else read_pressure(),
+        'throttle': get_throttle_status(),
+        'index': {'age_hours': get_index_age_hours(), 'refreshes': _index['refreshes'], 'changes': _index['changes']},
+    })
+
+def peer_may_control(writer):
+    """Allow control commands from root and the daemon's own user only"""
+    sock = writer.get_extra_info('socket')
+    try:
+        _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    except (OSError, AttributeError):
         return False
+    return uid in (0, os.getuid())
 
-def uninstall_batch_completely(apps_list, batch_num, logger):
-    """Completely uninstall all apps from batch"""
-    logger.info(f"\n{'='*60}")
-    logger.info(f"UNINSTALLING BATCH {batch_num}")
-    logger.info(f"Apps to uninstall: {len(apps_list)}")
-    logger.info(f"App list: {', '.join(apps_list)}")
-    logger.info('='*60)
+async def handle_control_client(reader, writer, logger):
+    """Serve status, stop, pause, resume and events requests from one client"""
+    _control['clients'].add(asyncio.current_task())
     
-    success_count = 0
+    async def reply(message):
+        writer.write((json.dumps(message) + '\n').encode())
+        await writer.drain()
     
-    for app in apps_list:
-        if uninstall_app_individually(app, logger):
-            success_count += 1
-        
-        # Small delay between uninstalls
-        time.sleep(3)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                op = json.loads(line).get('op')
+            except (ValueError, AttributeError):
+                await reply({'ok': False, 'error': 'invalid request'})
+                continue
+            
+            if op == 'status':
+                await reply(dict(get_control_status(), ok=True))
+            elif op in ('stop', 'pause', 'resume') and not peer_may_control(writer):
+                await reply({'ok': False, 'error': 'permission denied'})
+            elif op == 'stop':
+                logger.info("Stop requested over the control socket")
+                request_shutdown()
+                publish_event('stop_requested')
+                await reply({'ok': True, 'phase': _control['state']['phase']})
+            elif op == 'pause':
+                logger.info("Pause requested over the control socket")
+                _control['paused'] = True
+                _control['resume_event'].clear()
+                publish_event('paused')
+                await reply({'ok': True, 'phase': _control['state']['phase']})
+            elif op == 'resume':
+                logger.info("Resume requested over the control socket")
+                _control['paused'] = False
+                _control['resume_event'].set()
+                publish_event('resumed')
+                await reply({'ok': True, 'phase': _control['state']['phase']})
+            elif op == 'events':
+                queue = asyncio.Queue(maxsize=1000)
+                _control['subscribers'].add(queue)
+                try:
+                    await reply({'ok': True, 'event': 'status', 'status': get_control_status()})
+                    while True:
+                        event = await queue.get()
+                        if event is None:   # daemon exiting
+                            break
+                        await reply(event)
+                    break
+                finally:
+                    _control['subscribers'].discard(queue)
+            else:
+                await reply({'ok': False, 'error': f"unknown op {op!r}"})
+    except (OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+        pass
+    finally:
+        _control['clients'].discard(asyncio.current_task())
+        writer.close()
+
+async def start_control_server(logger):
+    """Serve the control API on control_socket"""
+    _control['loop'] = asyncio.get_running_loop()
+    _control['resume_event'] = asyncio.Event()
+    _control['resume_event'].set()
+    try:
+        if os.path.exists(control_socket):
+            os.remove(control_socket)
+        _control['server'] = await asyncio.start_unix_server(
+            lambda reader, writer: handle_control_client(reader, writer, logger), control_socket
+        )
+        # Anyone may read the status; control commands check the peer's uid
+        os.chmod(control_socket, 0o666)
+    except OSError as e:
+        logger.warning(f"⚠ Control socket unavailable: {e}")
+
+async def stop_control_server():
+    """Close the control socket and end event streams"""
+    server = _control['server']
+    _control['server'] = None
+    if server is not None:
+        server.close()
+        if os.path.exists(control_socket):
+            os.remove(control_socket)
+    for queue in _control['subscribers']:
+        queue.put_nowait(None)
+    clients = set(_control['clients'])
+    if clients:
+        _, pending = await asyncio.wait(clients, timeout=2)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    _control['loop'] = None
+
+async def wait_while_paused(logger):
+    """Block between batches while paused, until resumed or stopped"""
+    if not _control['paused'] or _control['resume_event'] is None:
+        return
+    logger.info("Paused - waiting for resume")
+    set_loop_phase('paused')
+    await wait_for_shutdown(None, _control['resume_event'])
+    if not shutdown_flag:
+        logger.info("Resumed")
+
+def control_request(message, timeout=5):
+    """Send one request to the daemon's control socket, return the reply or None if unreachable"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(control_socket)
+            sock.sendall((json.dumps(message) + '\n').encode())
+            with sock.makefile('r') as f:
+                line = f.readline()
+        return json.loads(line) if line else None
+    except (OSError, ValueError):
+        return None
+
+def stream_control_events():
+    """Print the daemon's event stream until it exits or Ctrl-C"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(control_socket)
+            sock.sendall(b'{"op": "events"}\n')
+            with sock.makefile('r') as f:
+                for line in f:
+                    print(line.strip(), flush=True)
+    except OSError as e:
+        print(f"✗ Daemon control socket unavailable: {e}")
+    except KeyboardInterrupt:
+        pass
+
+async def resume_interrupted_batch(batch, logger):
+    """Finish a batch a killed daemon left behind, reconciled against dpkg state
     
-    logger.info(f"\nUninstallation summary for batch {batch_num}:")
-    logger.info(f"Successfully uninstalled: {success_count}/{len(apps_list)} apps")
+    The remaining hold is waited out (a fresh one if the install itself
+    was interrupted), then whatever dpkg still has from the plan is
+    uninstalled. Returns the apps that were found installed.
+    """
+    logger.info(f"Resuming interrupted batch {batch['batch']} ({batch['state']}): {', '.join(batch['apps'])}")
+    if batch['state'] == 'installing':
+        # dpkg may have been killed half way through a package; if the repair fails
+        # too, the uninstall below still removes whatever dpkg reports installed
+        await repair_dpkg_state(logger)
     
-    if success_count > 0:
-        logger.info(f"✓ Batch {batch_num} uninstallation completed")
-        return True
-    else:
-        logger.warning(f"⚠ Batch {batch_num} uninstallation had issues")
-        return False
+    # The planner never picks installed apps, so any app of the plan dpkg has now came from this batch
+    states = get_package_states(batch['apps'])
+    installed_apps = [app for app in batch['apps'] if is_status_installed(states.get(app))]
+    if batch['state'] == 'installing':
+        for app in batch['apps']:
+            journal_record_package(batch['batch'], app, 'install', app in installed_apps)
+    logger.info(f"Found {len(installed_apps)}/{len(batch['apps'])} apps of batch {batch['batch']} installed")
+    
+    if installed_apps and batch['state'] in ('installing', 'held'):
+        if batch['state'] == 'held' and batch['hold_until']:
+            remaining = batch['hold_until'] - time.time()
+        else:
+            remaining = random.randint(*CONFIG['hold_minutes']) * 60
+            journal_set_state(batch['batch'], 'held', hold_until=time.time() + remaining)
+        set_loop_phase('holding', until=time.time() + max(remaining, 0), batch=batch['batch'],
+                       apps=batch['apps'], installed=installed_apps)
+        if remaining > 0:
+            logger.info(f"Holding resumed batch for another {remaining/60:.1f} minutes...")
+            with time_phase('hold'):
+                await wait_for_shutdown(remaining, disk_critical_event)
+    
+    if installed_apps:
+        journal_set_state(batch['batch'], 'uninstalling')
+        set_loop_phase('uninstalling', batch=batch['batch'], apps=batch['apps'], installed=installed_apps)
+        with time_phase('batch_uninstall', totals=True, apps=len(installed_apps)):
+            await uninstall_batch_completely(installed_apps, batch['batch'], logger)
+    journal_set_state(batch['batch'], 'done')
+    return installed_apps
 
-def cleanup_system(logger):
-    """Clean up system after operations"""
-    logger.info("\nPerforming system cleanup...")
+async def orchestrate(logger):
+    """Run the batch loop - planning and downloads overlap holds, waits end on SIGTERM"""
+    global shutdown_event, disk_critical_event
+    shutdown_event = asyncio.Event()
+    if shutdown_flag:
+        shutdown_event.set()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, request_shutdown)
     
+    # The overlay engine needs its chroot mounted before anything reads dpkg's status
     try:
-        # Remove unnecessary packages
-        subprocess.run(
-            ['apt', 'autoremove', '-y'],
-            timeout=300,
-            capture_output=True
-        )
-        
-        # Clean package cache
-        subprocess.run(
-            ['apt', 'autoclean'],
-            timeout=180,
-            capture_output=True
-        )
-        
-        # Clean downloaded package files
-        subprocess.run(
-            ['apt', 'clean'],
-            timeout=180,
-            capture_output=True
-        )
-        
-        # Clean temporary files
-        subprocess.run(
-            ['rm', '-rf', '/tmp/*', '/var/tmp/*'],
-            capture_output=True
-        )
-        
-        logger.info("✓ System cleanup completed")
-        
-        # Show disk space after cleanup
-        available_gb = check_disk_space()
-        logger.info(f"Available disk space: {available_gb:.1f}GB")
-        
+        await get_backend().prepare(logger)
     except Exception as e:
-        logger.warning(f"⚠ Cleanup had issues: {e}")
-
-def main_installation():
-    """Main installation process - runs in background"""
-    global shutdown_flag
+        logger.error(f"✗ Could not set up the {get_backend().name} engine: {e}")
+        return
     
-    # Setup logging
-    logger = setup_logging()
+    # Sampler thread reports disk levels, mirrored into an event for the loop
+    disk_critical_event = asyncio.Event()
+    def on_disk_level(level, sample):
+        update = disk_critical_event.set if level == 'critical' else disk_critical_event.clear
+        loop.call_soon_threadsafe(update)
+        publish_event('disk_level', level=level, free_gb=round(sample['free_bytes'] / 1024 ** 3, 2))
+    add_sampler_listener(on_disk_level)
+    start_sampler(logger)
+    await start_control_server(logger)
+    await fleet_connect(logger)
     
     logger.info("="*70)
     logger.info("HEAVY APP 2GB BATCH INSTALLER STARTED")
     logger.info(f"Start time: {datetime.now()}")
+    logger.info(f"Install mode: {CONFIG['install_mode']}, engine: {get_backend().name}")
     logger.info("="*70)
     
     # Check initial disk space
     initial_disk = check_disk_space()
     logger.info(f"Initial disk space: {initial_disk:.1f}GB")
     
-    if initial_disk < 15:
+    if initial_disk < CONFIG['disk_low_gb']:
         logger.warning(f"⚠ Low disk space warning: {initial_disk:.1f}GB available")
         logger.warning("Recommended: At least 20GB free space")
     
-    # Update system first
-    logger.info("Updating package lists...")
-    subprocess.run(['apt', 'update'], capture_output=True, timeout=300)
+    # Refresh the package lists only if they are stale
+    reason = get_index_refresh_reason()
+    if reason:
+        await refresh_package_index(logger, reason)
+    else:
+        logger.info(f"Package lists are {get_index_age_hours():.1f}h old, no refresh needed")
+    await asyncio.to_thread(load_apt_index, logger)
+    
+    # Pick up where a killed daemon stopped, or start a fresh journal
+    counters = journal_load_counters()
+    open_batch = journal_get_open_batch()
+    if not counters and not open_batch:
+        journal_reset()
     
     # Process apps in 2GB batches
-    batch_number = 0
-    total_batches_processed = 0
-    total_apps_installed = 0
+    batch_number = counters.get('batch_number', 0)
+    total_batches_processed = counters.get('total_batches_processed', 0)
+    total_apps_installed = counters.get('total_apps_installed', 0)
+    journal_save_counters(run_finished=0)
+    if batch_number:
+        logger.info(f"Resuming interrupted run after batch {batch_number}")
+    
+    if open_batch:
+        batch_number = max(batch_number, open_batch['batch'])
+        resumed_apps = await resume_interrupted_batch(open_batch, logger)
+        if resumed_apps:
+            total_batches_processed += 1
+            total_apps_installed += len(resumed_apps)
+        journal_save_counters(batch_number=batch_number, total_batches_processed=total_batches_processed,
+                              total_apps_installed=total_apps_installed)
+    _control['state']['counters'] = {'batches': total_batches_processed, 'apps': total_apps_installed}
+    scheduler = _scheduler['active'] = BatchScheduler(time.monotonic())
     
     while not shutdown_flag:
-        batch_number += 1
+        # Stop after certain number of batches
+        if CONFIG['max_batches'] and batch_number >= CONFIG['max_batches']:
+            logger.info(f"Reached maximum batch limit ({CONFIG['max_batches']})")
+            break
         
-        # Check for shutdown
+        # Between batches is the safe point to pause at
+        await wait_while_paused(logger)
         if shutdown_flag:
-            logger.info("Shutdown requested, stopping...")
             break
         
-        # Select batch with 2GB limit
-        batch_apps, batch_size_mb = select_batch_2gb()
+        # Between batches is also when stale lists get refreshed
+        reason = get_index_refresh_reason()
+        if reason:
+            await refresh_package_index(logger, reason)
+        
+        batch_number += 1
+        _metrics['batch'] = batch_number
+        batch_started = time.monotonic()
+        scheduler.begin_batch(batch_started)
+        set_loop_phase('planning', batch=batch_number, apps=[], installed=[])
+        
+        # Select batch with 2GB limit - already planned (and downloaded) if prefetched
+        prefetched = take_prefetched_batch()
+        if prefetched:
+            batch_apps, batch_size_mb, cached_archives = prefetched
+        else:
+            with time_phase('plan'):
+                batch_apps, batch_size_mb = await asyncio.to_thread(
+                    select_batch_2gb, None, scheduler.next_batch_mb(batch_started))
+            cached_archives = None
         
         if not batch_apps:
             logger.warning("No apps available for batch selection")
@@ -617,27 +3910,52 @@ def main_installation():
         current_disk = check_disk_space()
         logger.info(f"Current disk space: {current_disk:.1f}GB")
         
-        if current_disk < 5:
-            logger.error("✗ Critical: Less than 5GB disk space available")
+        if current_disk < CONFIG['disk_critical_gb']:
+            logger.error(f"✗ Critical: Less than {CONFIG['disk_critical_gb']}GB disk space available")
             logger.info("Performing emergency cleanup...")
-            cleanup_system(logger)
+            await cleanup_system(logger, force=True)
             current_disk = check_disk_space()
             
-            if current_disk < 5:
+            if current_disk < CONFIG['disk_critical_gb']:
                 logger.error("✗ Insufficient disk space even after cleanup. Stopping.")
                 break
         
-        # Install the batch
-        install_success, installed_apps = install_batch_2gb(
-            batch_apps, batch_number, batch_size_mb, logger
-        )
+        # A snapshot engine starts each batch from a clean layer
+        try:
+            await get_backend().begin_batch(logger)
+        except Exception as e:
+            logger.error(f"✗ Could not start batch {batch_number} on a clean layer: {e}. Stopping.")
+            break
+        
+        # Install the batch - the plan is journalled first so a crash can be resumed
+        journal_begin_batch(batch_number, batch_apps, batch_size_mb)
+        set_loop_phase('installing', apps=batch_apps, size_mb=round(batch_size_mb))
+        baseline_status = load_dpkg_status()
+        async with fleet_slot('batch', logger):
+            with time_phase('batch_install', totals=True, apps=len(batch_apps)) as install_timing:
+                install_success, installed_apps = await install_batch_2gb(
+                    batch_apps, batch_number, batch_size_mb, logger, cached_archives
+                )
+        seconds = max(install_timing['seconds'], 0.001)
+        logger.info(f"Install phase took {seconds/60:.1f} minutes: "
+                    f"{install_timing['net_bytes']/seconds/1024**2:.2f}MB/s downloaded, "
+                    f"{install_timing['disk_bytes']/seconds/1024**2:.2f}MB/s written")
+        
+        for app in batch_apps:
+            journal_record_package(batch_number, app, 'install', app in installed_apps)
+        record_batch_dependencies(batch_number, baseline_status, batch_apps, logger)
         
         if not install_success:
             logger.warning(f"⚠ Batch {batch_number} installation failed, skipping to next batch")
-            time.sleep(60)
+            journal_set_state(batch_number, 'failed')
+            journal_save_counters(batch_number=batch_number)
+            await wait_for_shutdown(CONFIG['retry_wait_seconds'])
+            scheduler.finish_batch(0, CONFIG['retry_wait_seconds'], time.monotonic())
+            log_batch_cgroup_usage(batch_number, logger)
             continue
         
         total_apps_installed += len(installed_apps)
+        installed_mb = batch_size_mb * len(installed_apps) / len(batch_apps)
         
         # Check for shutdown before delay
         if shutdown_flag:
@@ -645,60 +3963,91 @@ def main_installation():
             # Uninstall what we just installed before exiting
             if installed_apps:
                 logger.info("Uninstalling current batch before exit...")
-                uninstall_batch_completely(installed_apps, batch_number, logger)
+                journal_set_state(batch_number, 'uninstalling')
+                set_loop_phase('uninstalling')
+                await uninstall_batch_completely(installed_apps, batch_number, logger)
+            journal_set_state(batch_number, 'done')
             break
         
-        # Random delay between 7-16 minutes before uninstall
-        delay_minutes = random.randint(7, 16)
-        delay_seconds = delay_minutes * 60
-        logger.info(f"\nWaiting {delay_minutes} minutes before uninstalling...")
+        # Plan and fetch the next batch while this one sits installed
+        prefetch_task = asyncio.create_task(prefetch_next_batch(
+            baseline_status, logger, scheduler.next_batch_mb(time.monotonic())))
         
-        # Break delay into smaller chunks to check shutdown flag
-        chunk_size = 30
-        for i in range(0, delay_seconds, chunk_size):
-            if shutdown_flag:
-                break
-            time.sleep(min(chunk_size, delay_seconds - i))
+        # Hold before uninstall - random within hold_minutes, or paced to the churn target
+        hold_seconds = scheduler.hold_seconds(batch_size_mb, time.monotonic())
+        journal_set_state(batch_number, 'held', hold_until=time.time() + hold_seconds)
+        set_loop_phase('holding', until=time.time() + hold_seconds, installed=installed_apps)
+        logger.info(f"\nWaiting {hold_seconds/60:.1f} minutes before uninstalling...")
+        with time_phase('hold') as hold_timing:
+            await wait_for_shutdown(hold_seconds, disk_critical_event)
+        
+        if is_disk_critical() and not shutdown_flag:
+            logger.error("✗ Disk space critical during hold, uninstalling batch early")
+            await finish_task(prefetch_task, logger, timeout=0)
         
         if shutdown_flag:
             logger.info("Shutdown requested, stopping...")
+            await finish_task(prefetch_task, logger, timeout=0)
             if installed_apps:
                 logger.info("Uninstalling current batch before exit...")
-                uninstall_batch_completely(installed_apps, batch_number, logger)
+                journal_set_state(batch_number, 'uninstalling')
+                set_loop_phase('uninstalling')
+                await uninstall_batch_completely(installed_apps, batch_number, logger)
+            journal_set_state(batch_number, 'done')
             break
         
+        # dpkg is needed for the uninstall - give the download a little longer
+        await finish_task(prefetch_task, logger, timeout=300)
+        
         # UNINSTALL THE BATCH
+        journal_set_state(batch_number, 'uninstalling')
+        set_loop_phase('uninstalling')
         if installed_apps:
-            uninstall_success = uninstall_batch_completely(
-                installed_apps, batch_number, logger
-            )
+            with time_phase('batch_uninstall', totals=True, apps=len(installed_apps)):
+                uninstall_success = await uninstall_batch_completely(
+                    installed_apps, batch_number, logger
+                )
             
             if not uninstall_success:
                 logger.warning(f"⚠ Batch {batch_number} uninstallation had issues")
         
         total_batches_processed += 1
+        journal_set_state(batch_number, 'done')
+        journal_save_counters(batch_number=batch_number, total_batches_processed=total_batches_processed,
+                              total_apps_installed=total_apps_installed)
+        _control['state']['counters'] = {'batches': total_batches_processed, 'apps': total_apps_installed}
+        
+        # Clean up under disk pressure only, overlapping the wait below; the archive
+        # cache is held to its budget after every batch either way
+        cleanup_task = None
+        if cleanup_needed() and not shutdown_flag:
+            logger.info(f"Free space below {CONFIG['cleanup_free_gb']}GB, cleaning up")
+            cleanup_task = asyncio.create_task(cleanup_system(logger))
+        else:
+            enforce_archive_budget(logger)
         
-        # Random delay before next batch (3-7 minutes)
+        # Delay before next batch - random within wait_minutes, or what closes the cycle on target
+        wait_seconds = 0.0
         if not shutdown_flag:
-            next_delay_minutes = random.randint(3, 7)
-            next_delay_seconds = next_delay_minutes * 60
-            logger.info(f"\nWaiting {next_delay_minutes} minutes before next batch...")
-            
-            for i in range(0, next_delay_seconds, chunk_size):
-                if shutdown_flag:
-                    break
-                time.sleep(min(chunk_size, next_delay_seconds - i))
+            wait_seconds = scheduler.wait_seconds(batch_size_mb, time.monotonic())
+            logger.info(f"\nWaiting {wait_seconds/60:.1f} minutes before next batch...")
+            set_loop_phase('waiting', until=time.time() + wait_seconds)
+            with time_phase('wait') as wait_timing:
+                await wait_for_shutdown(wait_seconds)
+            wait_seconds = wait_timing['seconds']
         
-        # Perform cleanup every 2 batches
-        if batch_number % 2 == 0 and not shutdown_flag:
-            cleanup_system(logger)
+        # Never leave dpkg work behind - cleanup finishes even on shutdown
+        if cleanup_task:
+            await cleanup_task
         
-        # Optional: Stop after certain number of batches
-        if batch_number >= 50:  # Process up to 50 batches
-            logger.info("Reached maximum batch limit (50)")
-            break
+        scheduler.finish_batch(installed_mb, hold_timing['seconds'] + wait_seconds, time.monotonic())
+        log_batch_cgroup_usage(batch_number, logger)
+        record_phase('batch', time.monotonic() - batch_started, apps=len(installed_apps))
+        export_metrics(logger)
     
     # Final cleanup and summary
+    log_batch_cgroup_usage(batch_number, logger)
+    set_loop_phase('stopping')
     logger.info("\n" + "="*70)
     if shutdown_flag:
         logger.info("PROCESS STOPPED BY USER")
@@ -709,8 +4058,20 @@ def main_installation():
     logger.info(f"Total apps installed/uninstalled: {total_apps_installed}")
     logger.info(f"Total batch cycles: {batch_number}")
     
-    # Final cleanup
-    cleanup_system(logger)
+    # Final cleanup - nothing a batch introduced stays behind
+    await cleanup_system(logger, force=True)
+    try:
+        await get_backend().close(logger)
+    except Exception as e:
+        logger.error(f"✗ Could not release the {get_backend().name} engine: {e}")
+    stop_sampler()
+    journal_save_counters(run_finished=1)
+    close_journal()
+    await fleet_close()
+    await stop_control_server()
+    
+    log_metrics_summary(logger)
+    export_metrics(logger)
     
     # Final disk space report
     final_disk = check_disk_space()
@@ -725,8 +4086,790 @@ def main_installation():
     else:
         logger.info("Heavy app 2GB batch process completed successfully!")
 
+# Fleet coordinator state (leader side)
+_coordinator = {
+    'pools': {},          # slot kind -> asyncio.Semaphore
+    'grants': itertools.count(1),
+    'active': {},         # grant id -> (kind, host, granted at)
+}
+
+def get_fleet_share():
+    """Return the download rate (bytes/s) each fleet download window may use"""
+    return CONFIG['fleet_bandwidth_mb'] * 1024 * 1024 / CONFIG['fleet_download_slots']
+
+async def handle_fleet_client(reader, writer, logger):
+    """Serve one worker connection; its grants are released when it disconnects"""
+    pools = _coordinator['pools']
+    waiting = {}          # request id -> task waiting for a slot
+    grants = {}           # grant id -> kind
+    lock = asyncio.Lock()
+    
+    async def reply(message):
+        async with lock:
+            writer.write((json.dumps(message) + '\n').encode())
+            await writer.drain()
+    
+    async def acquire(request):
+        kind = request.get('kind')
+        if kind not in pools:
+            await reply({'id': request.get('id'), 'error': f"unknown slot kind {kind!r}"})
+            return
+        await pools[kind].acquire()
+        grant_id = next(_coordinator['grants'])
+        grants[grant_id] = kind
+        _coordinator['active'][grant_id] = (kind, request.get('host'), time.time())
+        waiting.pop(request.get('id'), None)
+        rate = get_fleet_share() if kind == 'download' else None
+        logger.info(f"Granted {kind} slot #{grant_id} to {request.get('host')} "
+                    f"({sum(1 for g in _coordinator['active'].values() if g[0] == kind)} in use)")
+        await reply({'id': request.get('id'), 'grant': grant_id, 'rate': rate})
+    
+    def release(grant_id):
+        kind = grants.pop(grant_id, None)
+        if kind:
+            _coordinator['active'].pop(grant_id, None)
+            pools[kind].release()
+    
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+            except ValueError:
+                continue
+            op = request.get('op')
+            if op == 'acquire':
+                waiting[request.get('id')] = asyncio.create_task(acquire(request))
+            elif op == 'release':
+                release(request.get('grant'))
+            elif op == 'cancel':
+                task = waiting.pop(request.get('id'), None)
+                if task:
+                    task.cancel()
+            elif op == 'stats':
+                await reply({'id': request.get('id'), 'active': [
+                    {'grant': grant_id, 'kind': kind, 'host': host, 'seconds': round(time.time() - since)}
+                    for grant_id, (kind, host, since) in sorted(_coordinator['active'].items())
+                ]})
+    except OSError:
+        pass
+    finally:
+        for task in waiting.values():
+            task.cancel()
+        for grant_id in list(grants):
+            release(grant_id)
+        writer.close()
+
+async def run_coordinator(address, logger):
+    """Hand out batch slots and download windows to workers until SIGTERM/SIGINT"""
+    global shutdown_event
+    shutdown_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, request_shutdown)
+    
+    _coordinator['pools'] = {
+        'batch': asyncio.Semaphore(CONFIG['fleet_batch_slots']),
+        'download': asyncio.Semaphore(CONFIG['fleet_download_slots']),
+    }
+    handler = lambda reader, writer: handle_fleet_client(reader, writer, logger)
+    kind = parse_address(address)
+    if kind[0] == 'unix':
+        if os.path.exists(kind[1]):
+            os.remove(kind[1])
+        server = await asyncio.start_unix_server(handler, kind[1])
+    else:
+        server = await asyncio.start_server(handler, kind[1], kind[2])
+    
+    logger.info(f"Fleet coordinator listening on {address}: {CONFIG['fleet_batch_slots']} batch slots, "
+                f"{CONFIG['fleet_download_slots']} download windows of "
+                f"{get_fleet_share()/1024**2:.1f}MB/s ({CONFIG['fleet_bandwidth_mb']}MB/s fleet-wide)")
+    async with server:
+        await shutdown_event.wait()
+    if kind[0] == 'unix' and os.path.exists(kind[1]):
+        os.remove(kind[1])
+    logger.info("Fleet coordinator stopped")
+
+# Stand-in mirror counters, for testing a fleet on one machine
+_mirror = {
+    'lock': threading.Lock(),
+    'active': 0,
+    'peak_active': 0,
+    'bytes': 0,
+    'peak_rate': 0.0,
+}
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """Answer GET /<n> with n zero bytes, counting concurrent downloads"""
+    
+    def do_GET(self):
+        try:
+            remaining = int(self.path.strip('/'))
+        except ValueError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(remaining))
+        self.end_headers()
+        with _mirror['lock']:
+            _mirror['active'] += 1
+            _mirror['peak_active'] = max(_mirror['peak_active'], _mirror['active'])
+        chunk = bytes(64 * 1024)
+        try:
+            while remaining > 0:
+                size = min(remaining, len(chunk))
+                self.wfile.write(chunk[:size])
+                remaining -= size
+                with _mirror['lock']:
+                    _mirror['bytes'] += size
+        except OSError:
+            pass
+        finally:
+            with _mirror['lock']:
+                _mirror['active'] -= 1
+    
+    def log_message(self, format, *args):
+        pass
+
+def run_mirror(address, logger):
+    """Serve the stand-in mirror on host:port, logging concurrency and throughput every second"""
+    _, host, port = parse_address(address)
+    server = ThreadingHTTPServer((host, port), MirrorHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    signal.signal(signal.SIGTERM, signal_handler)
+    logger.info(f"Stand-in mirror serving on http://{host}:{port}/<bytes>")
+    
+    last_bytes = 0
+    try:
+        while not shutdown_flag:
+            time.sleep(1)
+            with _mirror['lock']:
+                rate = _mirror['bytes'] - last_bytes
+                last_bytes = _mirror['bytes']
+                _mirror['peak_rate'] = max(_mirror['peak_rate'], rate)
+                active = _mirror['active']
+            if rate or active:
+                logger.info(f"{active} downloads, {rate/1024**2:.1f}MB/s")
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    logger.info(f"Mirror served {_mirror['bytes']/1024**2:.0f}MB, peak {_mirror['peak_active']} "
+                f"concurrent downloads, peak {_mirror['peak_rate']/1024**2:.1f}MB/s")
+
+def setup_console_logging(name):
+    """Return a logger printing to stdout, for the foreground subcommands"""
+    logger = logging.getLogger(name)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+def write_benchmark_catalog(lists_dir, apps, rng, shared_libs=40):
+    """Write a synthetic Packages list covering apps, with shared library dependencies"""
+    libs = [f"libbench{i}" for i in range(shared_libs)]
+    path = os.path.join(lists_dir, f"bench_dists_main_binary-{get_native_arch()}_Packages")
+    with open(path, 'w') as f:
+        for lib in libs:
+            installed_kb = rng.randint(20, 200) * 1024
+            f.write(f"Package: {lib}\nVersion: 1.0\nArchitecture: {get_native_arch()}\n"
+                    f"Installed-Size: {installed_kb}\nSize: {installed_kb * 400}\n\n")
+        for app in apps:
+            installed_kb = rng.randint(300, 2500) * 1024
+            depends = ', '.join(rng.sample(libs, rng.randint(1, 4)))
+            f.write(f"Package: {app}\nVersion: 1.0\nArchitecture: {get_native_arch()}\n"
+                    f"Depends: {depends}\nInstalled-Size: {installed_kb}\nSize: {installed_kb * 400}\n\n")
+
+def run_benchmark(batches=10, catalog_size=None, seed=0, time_scale=0.0, coordinator=None, mirror_url=None,
+                  engine='apt'):
+    """Run the batch loop against a FakeBackend in a scratch directory and report throughput
+    
+    Paths, delays and the backend are redirected for the run only; nothing
+    outside the scratch directory is touched and no root is needed.
+    """
+    global apt_lists_dir, dpkg_status_file, size_cache_file, apt_archives_dir
+    global archive_cache_file, metrics_file, journal_file, control_socket
+    global catalog_file, catalog_index_file, temp_directories
+    saved_paths = (apt_lists_dir, dpkg_status_file, size_cache_file, apt_archives_dir,
+                   archive_cache_file, metrics_file, journal_file, control_socket,
+                   catalog_file, catalog_index_file, temp_directories)
+    saved_config = dict(CONFIG)
+    apps = list(get_catalog_apps())
+    saved_backend = get_backend()
+    root = tempfile.mkdtemp(prefix='heavy_2gb_bench.')
+    rng = random.Random(seed)
+    random.seed(seed)
+    
+    try:
+        apt_lists_dir = os.path.join(root, 'lists')
+        apt_archives_dir = os.path.join(root, 'archives')
+        os.makedirs(apt_lists_dir)
+        os.makedirs(apt_archives_dir)
+        size_cache_file = os.path.join(root, 'sizes.json')
+        archive_cache_file = os.path.join(root, 'archives.json')
+        metrics_file = os.path.join(root, 'metrics.jsonl')
+        journal_file = os.path.join(root, 'journal.db')
+        control_socket = os.path.join(root, 'control.sock')
+        temp_directories = [os.path.join(root, 'tmp')]
+        
+        # The real catalog, padded with synthetic apps up to catalog_size
+        if catalog_size and catalog_size > len(apps):
+            apps.extend(f"bench-app-{i}" for i in range(catalog_size - len(apps)))
+        write_benchmark_catalog(apt_lists_dir, apps, rng)
+        catalog_file = os.path.join(root, 'catalog.json')
+        catalog_index_file = os.path.join(root, 'catalog.idx')
+        with open(catalog_file, 'w') as f:
+            json.dump({'categories': {'benchmark': [{'name': app} for app in apps]}}, f)
+        close_catalog()
+        
+        backend = FakeBackend(root, seed=seed, time_scale=time_scale, mirror_url=mirror_url,
+                              snapshots=engine == 'overlay')
+        set_backend(backend)
+        dpkg_status_file = backend.status_file
+        
+        CONFIG.update({
+            'hold_minutes': [0, 0],
+            'wait_minutes': [0, 0],
+            'max_batches': batches,
+            'install_pause_seconds': 0,
+            'uninstall_pause_seconds': 0,
+            'retry_wait_seconds': 0,
+            'prometheus_textfile': os.path.join(root, 'metrics.prom'),
+            'coordinator': coordinator,
+            'cgroup_root': None,
+            'pressure_thresholds': {},
+        })
+        
+        logger = logging.getLogger('heavy_2gb_benchmark')
+        logger.handlers = [logging.FileHandler(os.path.join(root, 'benchmark.log'))]
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        
+        # Planner microbenchmark on the synthetic catalog
+        get_dependency_closures(apps, logger)
+        rounds = 50
+        started = time.perf_counter()
+        for _ in range(rounds):
+            select_batch_2gb(installed={})
+        planner_ms = (time.perf_counter() - started) / rounds * 1000
+        del _batch_history[:]
+        
+        started = time.monotonic()
+        asyncio.run(orchestrate(logger))
+        elapsed = time.monotonic() - started
+        
+        summary = get_metrics_summary()
+        simulated = sum(backend.simulated.values())
+        completed = summary['phases'].get('batch', {}).get('count', 0)
+        return {
+            'batches': completed,
+            'engine': engine,
+            'catalog_size': len(apps),
+            'elapsed_seconds': round(elapsed, 3),
+            'batches_per_hour': round(completed / elapsed * 3600, 1) if elapsed else 0.0,
+            'simulated_seconds': round(simulated, 1),
+            'simulated_batches_per_hour': round(completed / simulated * 3600, 1) if simulated else 0.0,
+            'planner_ms': round(planner_ms, 3),
+            'phases': {phase: {'count': stats['count'], 'sum': stats['sum'], 'p50': stats['p50']}
+                       for phase, stats in summary['phases'].items()},
+            'simulated': {op: round(seconds, 1) for op, seconds in backend.simulated.items()},
+        }
+    finally:
+        close_journal()
+        close_catalog()
+        (apt_lists_dir, dpkg_status_file, size_cache_file, apt_archives_dir,
+         archive_cache_file, metrics_file, journal_file, control_socket,
+         catalog_file, catalog_index_file, temp_directories) = saved_paths
+        CONFIG.clear()
+        CONFIG.update(saved_config)
+        set_backend(saved_backend)
+        shutil.rmtree(root, ignore_errors=True)
+
+def show_benchmark(result):
+    """Print a benchmark result"""
+    print(f"Batches completed:   {result['batches']} (catalog of {result['catalog_size']} apps, "
+          f"{result['engine']} engine)")
+    print(f"Wall time:           {result['elapsed_seconds']:.2f}s "
+          f"({result['batches_per_hour']:.0f} batches/hour of orchestration overhead)")
+    print(f"Simulated apt time:  {result['simulated_seconds']:.0f}s "
+          f"({result['simulated_batches_per_hour']:.1f} batches/hour on the modelled machine)")
+    print(f"Planner:             {result['planner_ms']:.2f}ms per batch selection")
+    print("\nPhase timings (measured):")
+    for phase, stats in sorted(result['phases'].items()):
+        print(f"  {phase:<20} n={stats['count']:<4} total={stats['sum']:.3f}s p50={stats['p50']:.3f}s")
+    print("\nSimulated backend time:")
+    for op, seconds in sorted(result['simulated'].items()):
+        print(f"  {op:<20} {seconds:.1f}s")
+
+# Rates the simulator assumes when the metrics log has too little history
+SIMULATION_DEFAULTS = {
+    'download_rate': 20 * 1024 ** 2,   # bytes/s
+    'unpack_rate': 60 * 1024 ** 2,     # bytes/s written by dpkg
+    'remove_rate': 200 * 1024 ** 2,    # bytes/s freed by dpkg
+    'command_overhead': 2.0,           # seconds per apt/dpkg run
+    'min_history_bytes': 100 * 1024 ** 2,
+}
+
+def load_phase_history(path=None):
+    """Summarise past runs from the metrics JSON lines log for the simulator"""
+    history = {'install_app': {}, 'uninstall_app': {}, 'phases': {}}
+    downloaded = [0, 0.0]
+    written = [0, 0.0]
+    try:
+        with open_state_file(path or metrics_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type') != 'phase':
+                    continue
+                phase, seconds = record['phase'], record['seconds']
+                history['phases'].setdefault(phase, []).append(seconds)
+                if phase in ('install_app', 'uninstall_app') and 'package' in record:
+                    history[phase].setdefault(record['package'], []).append(seconds)
+                if phase == 'prefetch' and record.get('net_bytes'):
+                    downloaded[0] += record['net_bytes']
+                    downloaded[1] += seconds
+                if phase == 'install_transaction' and record.get('disk_bytes'):
+                    written[0] += record['disk_bytes']
+                    written[1] += seconds
+    except OSError:
+        pass
+    
+    rates = dict(SIMULATION_DEFAULTS)
+    if downloaded[0] >= rates['min_history_bytes'] and downloaded[1] > 0:
+        rates['download_rate'] = downloaded[0] / downloaded[1]
+    if written[0] >= rates['min_history_bytes'] and written[1] > 0:
+        rates['unpack_rate'] = written[0] / written[1]
+    history['rates'] = rates
+    return history
+
+def run_virtual_time(main):
+    """Run generator processes in virtual time, return the clock once main has finished
+    
+    A process yields ('now',) for the virtual clock, ('sleep', seconds),
+    ('spawn', generator) - which sends back a handle - or ('join', handle,
+    timeout), which sends back whether the handle finished within timeout
+    (None waits forever). Nothing really sleeps; events are taken from a
+    heap in time order.
+    """
+    queue = []      # (time, seq, process, value to send, waiter)
+    sequence = itertools.count()
+    handles = {main: {'done': False, 'waiters': []}}
+    clock = 0.0
+    
+    def schedule(at, process, value=None, waiter=None):
+        heapq.heappush(queue, (at, next(sequence), process, value, waiter))
+    
+    schedule(0.0, main)
+    while queue:
+        clock, _, process, value, waiter = heapq.heappop(queue)
+        if waiter:
+            # A join wakes once - by the joined process or its timeout
+            if waiter['woken']:
+                continue
+            waiter['woken'] = True
+        try:
+            request = process.send(value)
+        except StopIteration:
+            handles[process]['done'] = True
+            for waiter in handles[process]['waiters']:
+                schedule(clock, waiter['process'], True, waiter)
+            continue
+        
+        if request[0] == 'now':
+            schedule(clock, process, clock)
+        elif request[0] == 'sleep':
+            schedule(clock + request[1], process)
+        elif request[0] == 'spawn':
+            child = request[1]
+            handles[child] = {'done': False, 'waiters': []}
+            schedule(clock, child)
+            schedule(clock, process, child)
+        elif request[0] == 'join':
+            handle = handles[request[1]]
+            if handle['done']:
+                schedule(clock, process, True)
+            else:
+                waiter = {'process': process, 'woken': False}
+                handle['waiters'].append(waiter)
+                if request[2] is not None:
+                    schedule(clock + request[2], process, False, waiter)
+    return clock
+
+def simulate_run(batches=None, seed=0, history=None, logger=None):
+    """Forecast a full run with a seeded discrete-event simulation of the batch loop
+    
+    Uses the real planner, dependency closures and size data, the batch
+    scheduler on the virtual clock and per-package timings from past runs. Models the
+    prefetch overlapping the hold, cleanup overlapping the wait, the
+    archive cache budget and leftover dependencies until autoremove.
+    """
+    batches = batches or CONFIG['max_batches'] or 50
+    history = history or load_phase_history()
+    rates = history['rates']
+    rng = random.Random(seed)
+    
+    load_apt_index(logger)
+    catalog_apps = get_catalog_apps()
+    app_weights = get_catalog_weights()
+    closures = get_dependency_closures(catalog_apps, logger)
+    baseline = dict(load_dpkg_status())
+    status = dict(baseline)
+    
+    def package_sizes(app):
+        """Return {package: (installed bytes, download bytes)} of everything app pulls in"""
+        if app in closures:
+            return {name: tuple(_size_cache['sizes'][name]) for name in closures[app]}
+        # Hand-made estimates have no download size - debs compress about 3:1
+        estimate = get_app_size_estimate(app) * 1024 * 1024
+        return {app: (estimate, estimate // 3)}
+    
+    def median(values):
+        return percentile(values, 50) if values else None
+    
+    state = {
+        'archives': {},           # package -> download bytes, least recently used first
+        'extra_bytes': {},        # package -> installed bytes on top of the baseline
+        'downloaded': 0,
+        'peak_bytes': 0,
+        'prefetch': None,
+        'plan_history': [],
+    }
+    schedule = []
+    budget = CONFIG['archive_cache_mb'] * 1024 * 1024
+    free_at_start = get_backend().disk_free_bytes()
+    
+    def used_bytes():
+        return sum(state['extra_bytes'].values()) + sum(state['archives'].values())
+    
+    def note_disk():
+        state['peak_bytes'] = max(state['peak_bytes'], used_bytes())
+    
+    def plan(installed, target_mb):
+        items = get_planner_items(catalog_apps, installed, logger)
+        apps, size_mb = plan_batch(items, target_mb, state['plan_history'], rng,
+                                   app_weights=app_weights)
+        if apps:
+            state['plan_history'].append(frozenset(apps))
+            del state['plan_history'][:-CONFIG['batch_history']]
+        return apps, size_mb
+    
+    def fetch(packages):
+        """Return the download seconds for packages, caching their archives"""
+        missing = {name: sizes[1] for name, sizes in packages.items() if name not in state['archives']}
+        for name in packages:
+            if name in state['archives']:
+                state['archives'][name] = state['archives'].pop(name)
+        state['archives'].update(missing)
+        state['downloaded'] += sum(missing.values())
+        note_disk()
+        return sum(missing.values()) / rates['download_rate']
+    
+    def needed_packages(apps, installed):
+        needed = {}
+        for app in apps:
+            needed.update({name: sizes for name, sizes in package_sizes(app).items()
+                           if not is_status_installed(installed.get(name))})
+        return needed
+    
+    def prefetch(baseline_status, target_mb):
+        apps, size_mb = plan(baseline_status, target_mb)
+        state['prefetch'] = {'apps': apps, 'size_mb': size_mb, 'cancelled': False}
+        if not apps or not CONFIG['prefetch']:
+            return
+        packages = needed_packages(apps, baseline_status)
+        uncached = sum(sizes[1] for name, sizes in packages.items() if name not in state['archives'])
+        yield ('sleep', rates['command_overhead'] + uncached / rates['download_rate'])
+        if not state['prefetch']['cancelled']:
+            fetch(packages)
+    
+    def cleanup():
+        freed = sum(state['extra_bytes'].values())
+        seconds = median(history['phases'].get('cleanup', []))
+        if seconds is None:
+            seconds = 3 * rates['command_overhead'] + freed / rates['remove_rate']
+        yield ('sleep', seconds)
+        for name in state['extra_bytes']:
+            status.pop(name, None)
+        state['extra_bytes'] = {}
+        evict_archives()
+    
+    def evict_archives():
+        """Drop least recently used archives over the cache budget"""
+        while state['archives'] and sum(state['archives'].values()) > budget:
+            state['archives'].pop(next(iter(state['archives'])))
+    
+    def batch_loop():
+        scheduler = BatchScheduler((yield ('now',)), rng)
+        for batch_number in range(1, batches + 1):
+            started = yield ('now',)
+            scheduler.begin_batch(started)
+            # A cancelled prefetch still leaves its plan behind
+            prefetched = state['prefetch']
+            state['prefetch'] = None
+            if prefetched and prefetched['apps']:
+                apps, size_mb = prefetched['apps'], prefetched['size_mb']
+            else:
+                apps, size_mb = plan(status, scheduler.next_batch_mb(started))
+            if not apps:
+                break
+            
+            # Install - archives prefetched earlier only cost unpack time
+            baseline_status = dict(status)
+            packages = needed_packages(apps, status)
+            install_bytes = sum(sizes[0] for sizes in packages.values())
+            seconds = fetch(packages) + install_bytes / rates['unpack_rate']
+            if CONFIG['install_mode'] == 'individual':
+                known = [median(history['install_app'][app]) for app in apps if app in history['install_app']]
+                if len(known) == len(apps):
+                    seconds = sum(known)
+                else:
+                    seconds += rates['command_overhead'] * len(apps)
+                seconds += CONFIG['install_pause_seconds'] * len(apps)
+            else:
+                seconds += rates['command_overhead']
+            yield ('sleep', seconds)
+            install_seconds = seconds
+            for name, sizes in packages.items():
+                status[name] = 'install ok installed'
+                state['extra_bytes'][name] = sizes[0]
+            note_disk()
+            
+            # Hold, with the next batch planned and downloaded meanwhile
+            now = yield ('now',)
+            task = yield ('spawn', prefetch(baseline_status, scheduler.next_batch_mb(now)))
+            hold = scheduler.hold_seconds(size_mb, now)
+            yield ('sleep', hold)
+            if not (yield ('join', task, 300)):
+                state['prefetch']['cancelled'] = True
+            
+            # Uninstall the apps; their dependencies stay until autoremove
+            seconds = 0.0
+            for app in apps:
+                known = median(history['uninstall_app'].get(app, []))
+                freed = state['extra_bytes'].pop(app, 0)
+                status.pop(app, None)
+                if known is None:
+                    known = rates['command_overhead'] + freed / rates['remove_rate']
+                seconds += known + CONFIG['uninstall_pause_seconds']
+            yield ('sleep', seconds)
+            uninstall_seconds = seconds
+            
+            cleanup_task = None
+            if free_at_start - used_bytes() < CONFIG['cleanup_free_gb'] * 1024**3:
+                cleanup_task = yield ('spawn', cleanup())
+            else:
+                evict_archives()
+            wait = scheduler.wait_seconds(size_mb, (yield ('now',)))
+            yield ('sleep', wait)
+            if cleanup_task:
+                yield ('join', cleanup_task, None)
+            scheduler.finish_batch(size_mb, hold + wait, (yield ('now',)))
+            
+            schedule.append({
+                'batch': batch_number,
+                'start': started,
+                'apps': apps,
+                'size_mb': round(size_mb),
+                'install_seconds': round(install_seconds),
+                'hold_seconds': round(hold),
+                'uninstall_seconds': round(uninstall_seconds),
+                'wait_seconds': round(wait),
+            })
+    
+    total_seconds = run_virtual_time(batch_loop())
+    return {
+        'seed': seed,
+        'batches': len(schedule),
+        'total_seconds': total_seconds,
+        'peak_disk_bytes': state['peak_bytes'],
+        'downloaded_bytes': state['downloaded'],
+        'rates': rates,
+        'schedule': schedule,
+    }
+
+def format_duration(seconds):
+    """Format seconds as e.g. 13h05m"""
+    minutes = int(round(seconds / 60))
+    return f"{minutes // 60}h{minutes % 60:02d}m"
+
+def show_simulation(results):
+    """Print the schedule of the first simulated run and the spread over all runs"""
+    first = results[0]
+    rates = first['rates']
+    print(f"Model: download {rates['download_rate']/1024**2:.1f}MB/s, "
+          f"unpack {rates['unpack_rate']/1024**2:.1f}MB/s, "
+          f"hold {CONFIG['hold_minutes'][0]}-{CONFIG['hold_minutes'][1]}min, "
+          f"wait {CONFIG['wait_minutes'][0]}-{CONFIG['wait_minutes'][1]}min", end='')
+    if CONFIG['target_gb_per_hour']:
+        print(f", target {CONFIG['target_gb_per_hour']}GB/h")
+    elif CONFIG['target_batches_per_hour']:
+        print(f", target {CONFIG['target_batches_per_hour']} batches/h")
+    else:
+        print()
+    print(f"\nBatch schedule (seed {first['seed']}):")
+    for entry in first['schedule']:
+        print(f"  #{entry['batch']:<3} +{format_duration(entry['start'])}  "
+              f"{entry['size_mb']/1024:.1f}GB  install {entry['install_seconds']/60:.1f}m  "
+              f"hold {entry['hold_seconds']/60:.0f}m  uninstall {entry['uninstall_seconds']/60:.1f}m  "
+              f"wait {entry['wait_seconds']/60:.0f}m  {', '.join(entry['apps'])}")
+    
+    totals = sorted(result['total_seconds'] for result in results)
+    print(f"\nProjected wall-clock time: {format_duration(percentile(totals, 50))}", end='')
+    if len(results) > 1:
+        print(f" (min {format_duration(totals[0])}, max {format_duration(totals[-1])} over {len(results)} runs)")
+    else:
+        print()
+    print(f"Batches:                   {first['batches']}")
+    print(f"Peak extra disk use:       {max(r['peak_disk_bytes'] for r in results)/1024**3:.1f}GB "
+          f"(free now: {check_disk_space():.1f}GB)")
+    print(f"Total downloaded:          {percentile([r['downloaded_bytes'] for r in results], 50)/1024**3:.1f}GB")
+
+def run_catalog_command(logger):
+    """Compile the catalog (checking names against apt) or look entries up"""
+    action = sys.argv[2] if len(sys.argv) > 2 else 'compile'
+    if action == 'compile':
+        ensure_state_dir()
+        known = get_known_packages(logger)
+        started = time.perf_counter()
+        try:
+            count, categories = compile_catalog(catalog_file, catalog_index_file, known)
+        except (OSError, ValueError) as e:
+            print(f"✗ {e}")
+            sys.exit(1)
+        print(f"✓ Compiled {count} apps in {categories} categories into {catalog_index_file} "
+              f"in {(time.perf_counter() - started)*1000:.1f}ms")
+        if known is None:
+            print("⚠ No apt lists found - package names were not checked against apt")
+        close_catalog()
+        started = time.perf_counter()
+        load_catalog()
+        print(f"  Index loads in {(time.perf_counter() - started)*1e6:.0f}µs")
+    elif action == 'show' and len(sys.argv) > 3:
+        entry = get_catalog_entry(sys.argv[3])
+        print(json.dumps(entry) if entry else f"✗ {sys.argv[3]} is not in the catalog")
+    elif action == 'category' and len(sys.argv) > 3:
+        print('\n'.join(get_category_apps(sys.argv[3])) or f"✗ No category {sys.argv[3]}")
+    else:
+        print(f"Usage: {sys.argv[0]} catalog [compile|show NAME|category NAME]")
+        sys.exit(1)
+
+def get_option(name, default=None, cast=str):
+    """Return the value of a --name VALUE command line option"""
+    flag = f"--{name}"
+    if flag in sys.argv[2:]:
+        index = sys.argv.index(flag)
+        if index + 1 < len(sys.argv):
+            return cast(sys.argv[index + 1])
+    return default
+
+def main_installation():
+    """Main installation process - runs in background"""
+    # Setup logging
+    logger = setup_logging()
+    load_config(logger)
+    ensure_state_dir()
+    try:
+        load_catalog(logger)
+    except (OSError, ValueError) as e:
+        logger.error(f"✗ Catalog rejected, not starting: {e}")
+        return
+    if CONFIG['engine'] == 'overlay':
+        set_backend(OverlayBackend(CONFIG['overlay_base'], CONFIG['overlay_dir']))
+    
+    asyncio.run(orchestrate(logger))
+
+def read_log_tail(path, lines=20, block=8192):
+    """Return the last lines of a file, reading it backwards from the end"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = position = f.tell()
+        data = b''
+        while position > 0 and data.count(b'\n') <= lines:
+            position = max(0, position - block)
+            f.seek(position)
+            data = f.read(end - position)
+    return data.decode('utf-8', errors='replace').splitlines()[-lines:]
+
+def show_live_status(live):
+    """Print the state a running daemon reported over the control socket"""
+    flags = ' [PAUSED]' if live['paused'] else ''
+    flags += ' [STOPPING]' if live['stop_requested'] else ''
+    print(f"✓ Heavy 2GB Batch Installer is RUNNING (PID: {live['pid']}, up {live['uptime']//60}m){flags}")
+    
+    phase = f"Phase: {live['phase']} (batch {live['batch']})"
+    if live['phase_until']:
+        phase += f", {max(0, live['phase_until'] - time.time())/60:.1f} minutes left"
+    else:
+        phase += f", for {(time.time() - live['phase_started'])/60:.1f} minutes"
+    print(phase)
+    if live['progress']:
+        print(f"Progress: {live['progress']['done']}/{live['progress']['total']}")
+    apt = live.get('apt')
+    if apt:
+        print(f"apt {apt['action']}: {apt['stage']} {apt['percent']:.0f}% - {apt['message']}")
+    if live['apps']:
+        print(f"Batch apps: {', '.join(live['apps'])}")
+    if live['installed']:
+        print(f"Installed:  {', '.join(live['installed'])}")
+    counters = live['counters']
+    if counters:
+        print(f"Batches completed: {counters['batches']}, apps installed/uninstalled: {counters['apps']}")
+    print(f"Disk: {live['disk_free_gb']:.1f}GB free ({live['disk_level']})")
+    downloaded = live['bytes'].get('net_received', 0)
+    if downloaded:
+        print(f"Downloaded: {downloaded/1024**3:.2f}GB")
+    schedule = live.get('schedule')
+    if schedule:
+        if schedule['target_gb_per_hour']:
+            target = f"{schedule['target_gb_per_hour']:.1f}GB/h"
+        elif schedule['target_batches_per_hour']:
+            target = f"{schedule['target_batches_per_hour']:.1f} batches/h"
+        else:
+            target = "none, random delays"
+        print(f"Churn: {schedule['achieved_gb_per_hour']:.1f}GB/h, {schedule['achieved_batches_per_hour']:.1f} batches/h "
+              f"achieved (target {target}), next batch {schedule['next_batch_mb']/1024:.1f}GB")
+    pressure = live.get('pressure')
+    if pressure:
+        print("Pressure (avg10/avg60): " + ", ".join(
+            f"{resource} {averages['avg10']:.1f}/{averages['avg60']:.1f}%" for resource, averages in sorted(pressure.items())))
+    throttle = live.get('throttle')
+    if throttle:
+        line = (f"Throttled: {throttle['waited_seconds']/60:.1f}m waiting between packages, "
+                f"{throttle['deprioritized_seconds']/60:.1f}m at idle priority")
+        if throttle['reasons']:
+            line += f" - now: {', '.join(throttle['reasons'])}"
+        print(line)
+    index = live.get('index')
+    if index and index['age_hours'] is not None:
+        print(f"Package lists: {index['age_hours']:.1f}h old, refreshed {index['refreshes']} times "
+              f"this run ({index['changes']} with changes)")
+    bandwidth = live['bandwidth']
+    target = f"{bandwidth['target_mb_s']:.1f}MB/s" if bandwidth['target_mb_s'] else "unlimited"
+    achieved = f"{bandwidth['achieved_mb_s']:.1f}MB/s" if bandwidth['achieved_mb_s'] else "n/a"
+    line = f"Bandwidth: {achieved} achieved vs {target} target"
+    if bandwidth['profile_mb_s'] is not None:
+        line += f" (profile now {bandwidth['profile_mb_s']:.1f}MB/s)"
+    line += f", {bandwidth['hour_mb']}MB in the last hour"
+    if bandwidth['budget_mb']:
+        line += f" of {bandwidth['budget_mb']}MB budget"
+    print(line)
+
 def show_status():
     """Show current status if running"""
+    live = control_request({'op': 'status'})
+    if live and live.get('ok'):
+        show_live_status(live)
+        print(f"\nLog file: {log_file}")
+        return
+    
     is_running, pid = check_existing_process()
     
     if is_running:
@@ -734,34 +4877,62 @@ def show_status():
     else:
         print("✗ Heavy 2GB Batch Installer is NOT running")
     
+    catalog_apps = get_catalog_apps()
+    installed = get_installed_apps_from_batch(catalog_apps)
+    print(f"Catalog apps currently installed: {len(installed)}/{len(catalog_apps)}")
+    if installed:
+        print(f"  {', '.join(installed)}")
+    
+    open_batch = journal_get_open_batch() if os.path.exists(journal_file) else None
+    if open_batch:
+        line = f"Journalled batch {open_batch['batch']}: {open_batch['state']}"
+        if open_batch['state'] == 'held' and open_batch['hold_until']:
+            line += f" until {datetime.fromtimestamp(open_batch['hold_until']).strftime('%H:%M:%S')}"
+        print(f"{line} ({', '.join(open_batch['apps'])})")
+        if not is_running:
+            print("  The next start resumes this batch instead of planning a new one")
+    
+    state = load_archive_cache_state()
+    lookups = state['hits'] + state['misses']
+    if lookups:
+        print(f"Archive cache: {state['hits'] / lookups * 100:.0f}% hit ratio, "
+              f"{state['bytes_saved']/1024**3:.2f}GB download saved")
+    
     print(f"\nLog file: {log_file}")
     
     if os.path.exists(log_file):
         print("\nLast 20 lines of log:")
         try:
-            with open(log_file, 'r') as f:
-                lines = f.readlines()[-20:]
-                for line in lines:
-                    print(line.strip())
+            for line in read_log_tail(log_file):
+                print(line.strip())
         except Exception as e:
             print(f"Could not read log file: {e}")
         
         # Show disk space
-        try:
-            result = subprocess.run(
-                ['df', '-h', '/'],
-                capture_output=True,
-                text=True
-            )
-            print(f"\nDisk space:")
-            print(result.stdout.strip())
-        except:
-            pass
+        print(f"\nDisk space:")
+        print(format_disk_usage())
     else:
         print("\nLog file does not exist yet")
 
+def send_control_command(op):
+    """Send stop/pause/resume to the daemon, return True if it answered"""
+    reply = control_request({'op': op})
+    if reply is None:
+        return False
+    if reply.get('ok'):
+        print(f"✓ {op.capitalize()} requested (daemon is {reply['phase']})")
+    else:
+        print(f"✗ Daemon refused {op}: {reply.get('error')}")
+    return True
+
 def stop_process():
     """Stop the running background process"""
+    # The daemon stops itself at the next safe point - never in the middle of dpkg
+    if send_control_command('stop'):
+        print("The daemon uninstalls the current batch and exits; follow it with:")
+        print(f"  {sys.argv[0]} events")
+        return
+    
     is_running, pid = check_existing_process()
     
     if not is_running:
@@ -820,7 +4991,7 @@ def show_summary():
     print("• Automatic cleanup")
     print("\nWARNINGS:")
     print("• Requires 15GB+ free disk space")
-    print("• Uses high bandwidth for downloads")
+    print("• Uses high bandwidth for downloads (cap it with bandwidth_profile in the config)")
     print("• Each batch takes 20-40 minutes")
     print("• System may be slow during installations")
     print(f"\nLog file: {log_file}")
@@ -830,6 +5001,14 @@ def show_summary():
     print(f"  Start:   sudo {sys.argv[0]} start")
     print(f"  Status:  {sys.argv[0]} status")
     print(f"  Stop:    {sys.argv[0]} stop")
+    print(f"  Pause:   {sys.argv[0]} pause | resume   (takes effect between batches)")
+    print(f"  Events:  {sys.argv[0]} events")
+    print(f"  Bench:   {sys.argv[0]} benchmark [--batches N] [--catalog-size N] [--seed N]")
+    print("             [--time-scale X] [--coordinator ADDRESS] [--mirror URL] [--engine apt|overlay]")
+    print(f"  Fleet:   {sys.argv[0]} coordinator [--listen unix:/path|host:port]")
+    print(f"  Mirror:  {sys.argv[0]} mirror [--listen host:port]   (stand-in for fleet tests)")
+    print(f"  Catalog: {sys.argv[0]} catalog [compile|show NAME|category NAME]")
+    print(f"  Predict: {sys.argv[0]} simulate [--batches N] [--seed N] [--runs N] [--history FILE]")
     print(f"  Help:    {sys.argv[0]} help")
     print("="*70 + "\n")
 
@@ -869,17 +5048,9 @@ if __name__ == "__main__":
                 sys.exit(1)
             
             # Check disk space
-            try:
-                result = subprocess.run(
-                    ['df', '-h', '/'],
-                    capture_output=True,
-                    text=True
-                )
-                print("\nCurrent disk space:")
-                print(result.stdout.strip())
-                print()
-            except:
-                pass
+            print("\nCurrent disk space:")
+            print(format_disk_usage())
+            print()
             
             # Confirm with warning
             print("WARNING: This will install and uninstall heavy applications.")
@@ -914,12 +5085,55 @@ if __name__ == "__main__":
         elif command == "status":
             show_status()
             
+        elif command in ["pause", "resume"]:
+            if not send_control_command(command):
+                print("✗ No daemon is answering on the control socket")
+                sys.exit(1)
+            
+        elif command == "events":
+            stream_control_events()
+            
+        elif command == "benchmark":
+            print("Running offline benchmark against a simulated apt backend...")
+            show_benchmark(run_benchmark(
+                batches=get_option('batches', 10, int),
+                catalog_size=get_option('catalog-size', None, int),
+                seed=get_option('seed', 0, int),
+                time_scale=get_option('time-scale', 0.0, float),
+                coordinator=get_option('coordinator'),
+                mirror_url=get_option('mirror'),
+                engine=get_option('engine', 'apt'),
+            ))
+            
+        elif command == "coordinator":
+            load_config()
+            address = get_option('listen', CONFIG['coordinator'] or 'unix:/tmp/heavy_2gb_installer.fleet.sock')
+            asyncio.run(run_coordinator(address, setup_console_logging('heavy_2gb_coordinator')))
+            
+        elif command == "mirror":
+            run_mirror(get_option('listen', '127.0.0.1:8099'), setup_console_logging('heavy_2gb_mirror'))
+            
+        elif command == "catalog":
+            run_catalog_command(setup_console_logging('heavy_2gb_catalog'))
+            
+        elif command == "simulate":
+            load_config()
+            CONFIG['target_gb_per_hour'] = get_option('target-gb-per-hour', CONFIG['target_gb_per_hour'], float)
+            CONFIG['target_batches_per_hour'] = get_option('target-batches-per-hour',
+                                                           CONFIG['target_batches_per_hour'], float)
+            history = load_phase_history(get_option('history'))
+            seed = get_option('seed', 0, int)
+            show_simulation([
+                simulate_run(get_option('batches', None, int), seed + run, history)
+                for run in range(get_option('runs', 1, int))
+            ])
+            
         elif command in ["help", "--help", "-h"]:
             show_summary()
             
         else:
             print(f"✗ Unknown command: {command}")
-            print(f"Usage: {sys.argv[0]} [start|stop|status|help]")
+            print(f"Usage: {sys.argv[0]} [start|stop|status|pause|resume|events|benchmark|simulate|catalog|coordinator|mirror|help]")
             sys.exit(1)
             
     else: